@@ -0,0 +1,128 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+
+# (connect, read) seconds, a Cq range query of several months takes a while
+TIMEOUT = (float(os.environ.get('TRACE_HTTP_CONNECT_TIMEOUT', 5)),
+           float(os.environ.get('TRACE_HTTP_READ_TIMEOUT', 120)))
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+POOL_SIZE = 10
+GOOGLE_CREDENTIALS = '../.env/google_credentials.json'
+# the drive scope reads the revision of the spreadsheet for the sheet cache
+GOOGLE_SCOPE = ['https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/drive.metadata.readonly']
+
+_sessions = dict()
+_session_pid = None
+_sheet_client = None
+_sheet_client_pid = None
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def get_session(idempotent=True):
+    """
+    return a process wide session: pooled keep-alive connections to the GraphQL
+    and write_date endpoints, retried with exponential backoff, for idempotent
+    requests failed connections, failed reads and 5xx responses, otherwise
+    (write_date records a date) only connections that could not be made
+    """
+    global _session_pid
+    with _lock:
+        # connections must not be shared with forked worker processes
+        if _session_pid != os.getpid():
+            _sessions.clear()
+            _session_pid = os.getpid()
+        if idempotent not in _sessions:
+            if idempotent:
+                retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                              status_forcelist=(500, 502, 503, 504), allowed_methods=None,
+                              raise_on_status=False)
+            else:
+                retry = Retry(total=RETRIES, connect=RETRIES, read=0, status=0, other=0,
+                              backoff_factor=BACKOFF_FACTOR, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[idempotent] = session
+        return _sessions[idempotent]
+
+
+def get_executor():
+    """
+    return the process wide I/O thread pool
+    """
+    global _executor, _executor_pid
+    with _lock:
+        # threads do not survive a fork, a forked process needs its own pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def counted(response):
+    metrics.count('http_requests')
+    metrics.count('http_response_bytes', len(response.content))
+    return response
+
+
+def post(url, idempotent=True, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    with metrics.timer('http'):
+        return counted(get_session(idempotent).post(url, **kwargs))
+
+
+def get(url, idempotent=True, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    with metrics.timer('http'):
+        return counted(get_session(idempotent).get(url, **kwargs))
+
+
+async def post_async(url, **kwargs):
+    """
+    post without blocking the event loop, the request runs in the I/O thread pool
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), metrics.bind(lambda: post(url, **kwargs)))
+
+
+async def get_async(url, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), metrics.bind(lambda: get(url, **kwargs)))
+
+
+def run_concurrently(*calls):
+    """
+    run independent blocking calls (mostly I/O) in the I/O thread pool,
+    return their results in order, the first exception is raised
+    """
+    executor = get_executor()
+    futures = [executor.submit(metrics.bind(call)) for call in calls]
+    return [future.result() for future in futures]
+
+
+def get_sheet_client():
+    """
+    return the process wide authorized gspread client, its token is refreshed when it expires
+    """
+    global _sheet_client, _sheet_client_pid
+    with _lock:
+        if _sheet_client is None or _sheet_client_pid != os.getpid():
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                GOOGLE_CREDENTIALS, GOOGLE_SCOPE)
+            _sheet_client = gspread.authorize(credentials)
+            _sheet_client_pid = os.getpid()
+        return _sheet_client
@@ -0,0 +1,149 @@
+import sys
+import copy
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from trace import Trace, autoPilotMulti, InvalidDateError
+from traceGraph import TraceGraph
+from cq_store import read_cqs, record_day
+from layer_update import TraceContext, setBuildingStatus, write_date
+
+
+def date_range(start_value, end_value):
+    """
+    return the m/d/y strings of every date from start_value to end_value
+    """
+    current = datetime.strptime(start_value, "%m/%d/%y")
+    end = datetime.strptime(end_value, "%m/%d/%y")
+    dates = []
+    while current <= end:
+        dates.append(current.strftime("%-m/%-d/%y"))
+        current += timedelta(days=1)
+    return dates
+
+
+# graph of a worker process, built once by init_worker
+_worker_graph = None
+
+
+def init_worker():
+    global _worker_graph
+    _worker_graph = TraceGraph()
+
+
+def trace_date(date_val, graph=None):
+    """
+    worker: trace all modes of one date on graph, the graph of the worker by default
+    """
+    try:
+        error_message, building_modes = autoPilotMulti(date_val, graph or _worker_graph)
+    except InvalidDateError:
+        error_message, building_modes = "invalid date", {}
+    return date_val, error_message, dict(building_modes)
+
+
+def trace_dates(dates, processes=4, graph=None):
+    """
+    yield (date, error message, building modes) as the traces finish,
+    in a process pool unless processes is 1 or processes are not available (Lambda),
+    every worker builds its graph once, serial traces share graph
+    """
+    executor = None
+    if processes > 1:
+        try:
+            executor = ProcessPoolExecutor(max_workers=processes, initializer=init_worker)
+            futures = [executor.submit(trace_date, date_val) for date_val in dates]
+        except OSError as error:
+            print("process pool not available, tracing serially:", error)
+            executor = None
+    if executor is not None:
+        with executor:
+            for future in as_completed(futures):
+                yield future.result()
+        return
+    graph = graph or TraceGraph()
+    for date_val in dates:
+        yield trace_date(date_val, graph)
+
+
+class BatchWriter:
+    """
+    add features to a layer in batches of batch_size with at most max_workers
+    requests in flight, counting the results per date
+    """
+
+    def __init__(self, arcgis, layer, batch_size=250, max_workers=4):
+        self.arcgis = arcgis
+        self.layer = layer
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = dict()
+        self.report = dict()
+
+    def collect(self, futures):
+        for future in futures:
+            date_val = self.pending.pop(future)
+            counts = self.report.setdefault(
+                date_val, {'add_success_count': 0, 'add_fail_count': 0, 'errors': []})
+            batch_report = future.result()
+            for key in counts:
+                counts[key] += batch_report[key]
+
+    def add(self, date_val, features):
+        for idx in range(0, len(features), self.batch_size):
+            # bound the features held in memory by the requests in flight
+            while len(self.pending) >= self.max_workers:
+                done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                self.collect(done)
+            batch = features[idx:idx + self.batch_size]
+            future = self.executor.submit(
+                self.arcgis.editInChunks, self.layer, batch, "add", self.batch_size)
+            self.pending[future] = date_val
+
+    def close(self):
+        self.collect(list(self.pending))
+        self.executor.shutdown()
+        return self.report
+
+
+def backfillHistorical(start_value, end_value, processes=4, batch_size=250, max_workers=4, context=None):
+    """
+    add the multi trace statuses of every date from start_value to end_value
+    to the historical layer, skipping dates without data or already recorded
+    """
+    dates = date_range(start_value, end_value)
+    start_date = datetime.strptime(start_value, "%m/%d/%y").date()
+    end_date = datetime.strptime(end_value, "%m/%d/%y").date()
+    # one bulk query fills the local Cq store, the traces then read it locally
+    records = read_cqs(start_date, end_date, Trace.fetch_cqs)
+    data_dates = set(record_day(record['date']).strftime("%-m/%-d/%y") for record in records)
+    report = {date_val: {'message': 'invalid date'} for date_val in dates if date_val not in data_dates}
+
+    context = context or TraceContext(historical=True)
+    features = context.getBuildingFeatures(historical=True)
+    writer = BatchWriter(context.getArcgis(), context.getLayer("historical_data_layer", 0),
+                         batch_size, max_workers)
+    for date_val, error_message, building_modes in trace_dates(
+            [date_val for date_val in dates if date_val in data_dates], processes, context.graph):
+        if error_message:
+            report[date_val] = {'message': error_message}
+            continue
+        reponse_json = write_date(date_val)
+        if reponse_json['message'] == 'already updated!':
+            report[date_val] = reponse_json
+            continue
+        date_features = copy.deepcopy(features)
+        setBuildingStatus(date_features, date_val, building_modes)
+        writer.add(date_val, date_features)
+    report.update(writer.close())
+    return None, report
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    if len(targets) < 3:
+        print("usage: python backfill.py <start m/d/y> <end m/d/y> [processes]")
+    else:
+        error_message, report = backfillHistorical(
+            targets[1], targets[2], int(targets[3]) if len(targets) > 3 else 4)
+        print(error_message, report)
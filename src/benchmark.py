@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import io
+import random
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from unittest import mock
+import fake_graphql
+from fake_graphql import FakeData, FakeBook
+from fake_arcgis import FakeGIS
+from network_artifact import load_network
+from synthetic_network import generate_network
+from traceGraph import TraceGraph, TraceEngine, ReachabilityIndex
+
+
+DEFAULT_NODE_COUNT = 10000
+# any day but a Sunday has fake Cq data
+BENCH_DATE = "6/7/21"
+TRACE_MODES = ["detection", "monitoring", "sampling", "paused monitoring"]
+
+
+def recursive_get_flow(graph, seg_loc, visited, res, origin, mode="downstream", only_mode=None):
+    # the former recursive TraceGraph.getFlow, kept as the baseline to compare against
+    if seg_loc in visited:
+        return
+    if ((seg_loc in graph.coords_to_manhole_map) and (graph.coords_to_manhole_map[seg_loc] in graph.barriers)):
+        return
+    visited.add(seg_loc)
+    if (seg_loc in graph.coords_to_manhole_map) and (graph.coords_to_manhole_map[seg_loc] != origin) and ((not only_mode) or only_mode == "manhole"):
+        res.add(graph.coords_to_manhole_map[seg_loc])
+    if (seg_loc in graph.coords_to_build_map) and (graph.coords_to_build_map[seg_loc] != origin) and ((not only_mode) or only_mode == "build"):
+        res.add(graph.coords_to_build_map[seg_loc])
+    next_segs = graph.edges if mode == "downstream" else graph.mirror_edges
+    for seg in next_segs.get(seg_loc, ()):
+        recursive_get_flow(graph, seg, visited, res, origin, mode, only_mode)
+
+
+def get_networks(scales, include_real=True):
+    """
+    return (name, network) pairs: the real network if it can be loaded and
+    synthetic networks scaled from its vertex count
+    """
+    networks = []
+    base_count = DEFAULT_NODE_COUNT
+    if include_real:
+        try:
+            real = load_network()
+            base_count = real.node_count
+            networks.append(("real", real))
+        except Exception as error:
+            print("real network not available:", error, file=sys.stderr)
+    for scale in scales:
+        networks.append(("synthetic_%sx" % scale, generate_network(int(base_count * scale))))
+    return networks
+
+
+def bench_traversal(name, network, max_origins=500):
+    """
+    time the buildGraph traversals (downstream manholes and upstream buildings
+    of every manhole) with the recursive and the iterative getFlow
+    """
+    graph = TraceGraph(network)
+    graph.getSewerEdge()
+    origins = graph.network.manhole_ids[:max_origins]
+
+    def run(get_flow):
+        start = time.perf_counter()
+        for manhole_id in origins:
+            get_flow(graph.manhole_to_coords_map[manhole_id], set(),
+                     set(), manhole_id, "downstream", "manhole")
+            get_flow(graph.manhole_to_coords_map[manhole_id], set(),
+                     set(), manhole_id, "upstream", "build")
+        return time.perf_counter() - start
+
+    result = {"benchmark": "traversal", "network": name, "nodes": network.node_count,
+              "edges": network.edge_count, "origins": len(origins)}
+    result["iterative_s"] = run(graph.getFlow)
+    try:
+        result["recursive_s"] = run(
+            lambda *args: recursive_get_flow(graph, *args))
+        result["speedup"] = result["recursive_s"] / result["iterative_s"]
+    except RecursionError:
+        result["recursive_error"] = "RecursionError"
+    return result
+
+
+def bench_reachability(name, network, queries=50, seed=0):
+    """
+    time barrier-aware traces of the vertex engine against the manhole index,
+    and membership queries of the index, on random origins and barriers
+    """
+    rng = random.Random(seed)
+    manhole_ids, building_ids = list(network.manhole_ids), list(network.building_ids)
+    start = time.perf_counter()
+    engine = TraceEngine(network)
+    engine_build_s = time.perf_counter() - start
+    start = time.perf_counter()
+    index = ReachabilityIndex(network)
+    index.getClosure("upstream")
+    index_build_s = time.perf_counter() - start
+    cases = [([rng.sample(manhole_ids, min(30, len(manhole_ids))) for _ in range(3)],
+              [set(rng.sample(manhole_ids, len(manhole_ids) // 4)) for _ in range(3)])
+             for _ in range(queries)]
+
+    def run(trace_engine):
+        start = time.perf_counter()
+        for origins, barriers in cases:
+            trace_engine.traceModes(origins, barriers, "upstream", "build")
+        return time.perf_counter() - start
+
+    result = {"benchmark": "reachability", "network": name, "nodes": network.node_count,
+              "manholes": len(manhole_ids), "queries": queries,
+              "engine_build_s": engine_build_s, "index_build_s": index_build_s}
+    result["engine_s"] = run(engine)
+    result["index_s"] = run(index)
+    result["speedup"] = result["engine_s"] / result["index_s"]
+    start = time.perf_counter()
+    for _ in range(queries):
+        index.reaches(rng.choice(building_ids or manhole_ids), rng.choice(manhole_ids))
+    result["membership_s"] = (time.perf_counter() - start) / queries
+    return result
+
+
+@contextlib.contextmanager
+def fake_backends(network, date_value=BENCH_DATE, arcgis_latency=0.0):
+    """
+    point the trace pipeline at a local fake GraphQL server, a fake wastewater
+    sheet and a fake ArcGIS built from the network, with an empty Cq store and
+    reference cache, yield (GraphQL data, sheet book, GIS)
+    """
+    import trace
+    import cq_store
+    from reference_cache import ReferenceCache
+    from sheet_cache import sheet_cache
+    data = FakeData(network)
+    book = FakeBook(data, [date_value])
+    gis = FakeGIS(network, arcgis_latency)
+    server = fake_graphql.serve(network, 0, data=data)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    with contextlib.ExitStack() as stack:
+        cache_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(mock.patch.object(trace, "QUERY_URL", url + "/query"))
+        stack.enter_context(mock.patch.object(
+            trace, "reference_cache", ReferenceCache(os.path.join(cache_dir, "reference"))))
+        stack.enter_context(mock.patch.multiple(
+            cq_store, STORE_PATH=os.path.join(cache_dir, "cq_store.sqlite"), _store=None))
+        stack.enter_context(mock.patch.multiple(sheet_cache, book=book, snapshots=dict(), checked_at=None))
+        try:
+            import layer_update
+        except ImportError as error:
+            print("layer updates not available:", error, file=sys.stderr)
+        else:
+            stack.enter_context(mock.patch.object(layer_update, "WRITE_DATE_URL", url + "/write_date"))
+            stack.enter_context(mock.patch.object(layer_update, "GIS", lambda *args: gis))
+            stack.enter_context(mock.patch.dict(os.environ, {"ARC_USER": "benchmark", "ARC_PASS": ""}))
+        try:
+            yield data, book, gis
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def network_result(benchmark, name, network):
+    return {"benchmark": benchmark, "network": name, "nodes": network.node_count,
+            "edges": network.edge_count, "manholes": len(network.manhole_ids),
+            "buildings": len(network.building_ids)}
+
+
+def bench_construction(name, network):
+    """
+    time the TraceGraph construction and its trace engine (the manhole index)
+    """
+    result = network_result("construction", name, network)
+    start = time.perf_counter()
+    graph = TraceGraph(network)
+    result["trace_graph_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    graph.getEngine()
+    result["engine_s"] = time.perf_counter() - start
+    return result
+
+
+def bench_build_graph(name, network):
+    """
+    time buildGraph, the downstream manholes and upstream buildings of every manhole
+    """
+    result = network_result("build_graph", name, network)
+    graph = TraceGraph(network)
+    start = time.perf_counter()
+    graph.buildGraph()
+    result["build_graph_s"] = time.perf_counter() - start
+    result["manhole_edges"] = len(graph.reach["manhole_graph"][1])
+    result["building_edges"] = len(graph.reach["trace_graph"][1])
+    return result
+
+
+def start_trace(result, network, date_value):
+    from trace import Trace
+    graph = TraceGraph(network)
+    graph.getEngine()
+    start = time.perf_counter()
+    graph.getCatchment()
+    result["catchment_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    tracing = Trace(date_value, graph)
+    result["trace_init_s"] = time.perf_counter() - start
+    return tracing
+
+
+def bench_affected_buildings(name, network, date_value=BENCH_DATE):
+    """
+    time get_affected_buildings of every mode after loading the Cq data
+    and reference tables from the fake GraphQL server
+    """
+    result = network_result("affected_buildings", name, network)
+    with fake_backends(network, date_value) as (data, book, gis):
+        tracing = start_trace(result, network, date_value)
+        for mode in TRACE_MODES:
+            start = time.perf_counter()
+            error_message, affected_buildings = tracing.get_affected_buildings(date_value, mode)
+            key = mode.replace(" ", "_")
+            result[key + "_s"] = time.perf_counter() - start
+            result[key + "_buildings"] = len(affected_buildings)
+        result["graphql_requests"] = data.request_count
+    return result
+
+
+def bench_manhole_trace(name, network, date_value=BENCH_DATE):
+    """
+    time MultiTraceManholes, the status and Cq of every manhole from the fake sheet
+    """
+    result = network_result("manhole_trace", name, network)
+    with fake_backends(network, date_value) as (data, book, gis):
+        tracing = start_trace(result, network, date_value)
+        start = time.perf_counter()
+        error_message, manholes = tracing.MultiTraceManholes(date_value)
+        result["multi_trace_manholes_s"] = time.perf_counter() - start
+        result["rows"] = len(manholes)
+        result["graphql_requests"] = data.request_count
+        result["sheet_requests"] = book.request_count
+    return result
+
+
+def bench_moving_average(name, network, date_value=BENCH_DATE, day_window=7):
+    """
+    time getMovingAverage with an empty Cq store and again once the window is stored
+    """
+    result = network_result("moving_average", name, network)
+    with fake_backends(network, date_value) as (data, book, gis):
+        tracing = start_trace(result, network, date_value)
+        for key in ("cold_s", "stored_s"):
+            start = time.perf_counter()
+            tracing.getMovingAverage(date_value, day_window)
+            result[key] = time.perf_counter() - start
+        result["graphql_requests"] = data.request_count
+    return result
+
+
+def bench_update_building(name, network, date_value=BENCH_DATE):
+    """
+    time the cron flow of updateBuilding (single, multi and historical layers
+    sharing one TraceContext) against the fake ArcGIS layers
+    """
+    result = network_result("update_building", name, network)
+    with fake_backends(network, date_value) as (data, book, gis):
+        try:
+            from layer_update import updateBuilding, TraceContext
+        except ImportError as error:
+            result["error"] = str(error)
+            return result
+        graph = TraceGraph(network)
+        graph.getEngine()
+        graph.getCatchment()
+        context = TraceContext(graph, historical=True)
+        start_all = time.perf_counter()
+        for trace_mode in ("single", "multi", "historical"):
+            start = time.perf_counter()
+            updateBuilding(date_value, trace_mode, context)
+            result[trace_mode + "_s"] = time.perf_counter() - start
+        result["total_s"] = time.perf_counter() - start_all
+        result["graphql_requests"] = data.request_count
+        result.update(gis.requestCounts())
+    return result
+
+
+BENCHMARKS = {"traversal": bench_traversal, "reachability": bench_reachability,
+              "construction": bench_construction, "build_graph": bench_build_graph,
+              "affected_buildings": bench_affected_buildings, "manhole_trace": bench_manhole_trace,
+              "moving_average": bench_moving_average, "update_building": bench_update_building}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the trace pipeline")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS))
+    parser.add_argument("--scales", nargs="*", type=float, default=[10, 100])
+    parser.add_argument("--nodes", nargs="*", type=int, default=[],
+                        help="synthetic networks of these vertex counts")
+    parser.add_argument("--no-real", action="store_true")
+    parser.add_argument("--output", help="write the results and the commit to this JSON file")
+    args = parser.parse_args()
+    networks = get_networks(args.scales, not args.no_real)
+    networks += [("synthetic_%d" % count, generate_network(count)) for count in args.nodes]
+    results = []
+    for name, network in networks:
+        for benchmark in args.benchmarks:
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = BENCHMARKS[benchmark](name, network)
+            except Exception as error:
+                result = {"benchmark": benchmark, "network": name, "error": repr(error)}
+            results.append(result)
+            print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"commit": get_commit(), "created": datetime.now().isoformat(),
+                       "python": sys.version.split()[0], "results": results}, output_file, indent=2)
@@ -0,0 +1,138 @@
+import os
+import sys
+import numpy as np
+from network_artifact import NETWORK_DIR
+
+
+CATCHMENT_NAME = 'catchment.npz'
+
+
+def catchment_path(network_dir=NETWORK_DIR):
+    return os.environ.get('TRACE_CATCHMENT_TABLE', os.path.join(network_dir, CATCHMENT_NAME))
+
+
+class CatchmentTable:
+    """
+    barrier free upstream catchment of every manhole (sampler) of a network,
+    rows indexed like network.manhole_ids, nothing excluded
+
+    building_ptr, building_idx: CSR of the buildings (index into building_ids) draining into it
+    manhole_ptr, manhole_idx: CSR of the manholes (index into manhole_ids) draining into it,
+    itself included, a barrier among them makes the catchment unusable for a trace
+    """
+    ARRAYS = ('building_ptr', 'building_idx', 'manhole_ptr', 'manhole_idx')
+
+    def __init__(self, network, arrays, fingerprint=None):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.network = network
+        self.fingerprint = fingerprint
+        self.manhole_labels = {manhole_id: label for label,
+                               manhole_id in enumerate(network.manhole_ids)}
+        self.rows = dict()
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, fingerprint=np.array(self.fingerprint),
+                 **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, network, path):
+        """
+        return the table saved at path, None if it is missing or was computed
+        for another network artifact, it is then computed again as a whole
+        """
+        fingerprint = network.fingerprint()
+        if fingerprint is None:
+            return None
+        try:
+            with np.load(path) as saved:
+                if str(saved['fingerprint']) != fingerprint:
+                    print("network artifact changed since the catchment table was computed, computing it again")
+                    return None
+                arrays = {name: saved[name] for name in cls.ARRAYS}
+        except (OSError, KeyError, ValueError):
+            return None
+        return cls(network, arrays, fingerprint)
+
+    def getRow(self, label):
+        # (building labels, manhole labels) of a manhole label as python sets
+        row = self.rows.get(label)
+        if row is None:
+            row = (set(self.building_idx[self.building_ptr[label]:self.building_ptr[label + 1]].tolist()),
+                   set(self.manhole_idx[self.manhole_ptr[label]:self.manhole_ptr[label + 1]].tolist()))
+            self.rows[label] = row
+        return row
+
+    def getBuildings(self, manhole_id):
+        """
+        return the buildings upstream of a manhole, empty for a manhole not in the network
+        """
+        label = self.manhole_labels.get(manhole_id)
+        if label is None:
+            return set()
+        return set(self.network.building_ids[building] for building in self.getRow(label)[0])
+
+    def getSamplers(self, building_id):
+        """
+        return the manholes whose catchment holds a building
+        """
+        try:
+            building = self.network.building_ids.index(building_id)
+        except ValueError:
+            return set()
+        counts = np.diff(self.building_ptr)
+        rows = np.repeat(np.arange(len(counts)), counts)[np.asarray(self.building_idx) == building]
+        return set(self.network.manhole_ids[label] for label in rows.tolist())
+
+    def traceBuildings(self, origins, barriers=()):
+        """
+        return the buildings upstream of the origin manholes as the union of their
+        catchments, None when a barrier or an origin id shared with a building
+        makes that differ from a trace and the network has to be walked
+        """
+        manhole_labels, node_manhole = self.manhole_labels, self.network.node_manhole
+        # a barrier only blocks the node it is the last manhole of, see TraceEngine.getBarrierNodes
+        blocked = set()
+        for manhole_id in barriers:
+            label = manhole_labels.get(manhole_id)
+            if label is not None and node_manhole[self.network.manhole_nodes[label]] == label:
+                blocked.add(label)
+        buildings = set()
+        for manhole_id in origins:
+            label = manhole_labels.get(manhole_id)
+            if label is None or label in blocked:
+                # not in the network, or skipped as a blocked origin
+                continue
+            row_buildings, row_manholes = self.getRow(label)
+            if not blocked.isdisjoint(row_manholes):
+                return None
+            buildings |= row_buildings
+        building_ids = self.network.building_ids
+        traced = set(building_ids[building] for building in buildings)
+        if not traced.isdisjoint(origins):
+            return None
+        return traced
+
+    def samplerCounts(self, residential_map):
+        """
+        return per manhole label the (upstream, residential upstream) building counts,
+        residential_map maps a building id to whether it is residential
+        """
+        flags = np.array([bool(residential_map.get(str(building_id), False))
+                          for building_id in self.network.building_ids], dtype=np.float64)
+        counts = np.diff(self.building_ptr)
+        rows = np.repeat(np.arange(len(counts)), counts)
+        residential = np.bincount(rows, weights=flags[np.asarray(self.building_idx)],
+                                  minlength=len(counts)).astype(np.int64)
+        return counts, residential
+
+
+if __name__ == "__main__":
+    from traceGraph import TraceGraph
+    from network_artifact import load_network
+    network_dir = sys.argv[1] if len(sys.argv) > 1 else NETWORK_DIR
+    table = TraceGraph(load_network(network_dir)).getCatchment(catchment_path(network_dir))
+    print("computed the catchments of %d manholes, %d building rows into %s" % (
+        len(table.network.manhole_ids), len(table.building_idx), catchment_path(network_dir)))
@@ -0,0 +1,143 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, date
+
+
+# set TRACE_CQ_STORE to an empty string to always read from the GraphQL endpoint
+STORE_PATH = os.environ.get('TRACE_CQ_STORE', os.path.join('/tmp', 'cq_store.sqlite'))
+# values of the most recent days can still change and are fetched again
+FRESHNESS_DAYS = int(os.environ.get('TRACE_CQ_FRESHNESS_DAYS', 3))
+
+_store = None
+_store_pid = None
+
+
+def record_day(date_string):
+    """
+    return the (UTC) day of a GraphQL date string such as 2021-06-07T00:00:00Z
+    """
+    return datetime.fromisoformat(date_string.replace("Z", "+00:00")).date()
+
+
+class CqStore:
+    """
+    local copy of the qPCR Cq values, one row per (date, manholeID, samplerID, cqValue),
+    and the days that have been synced with the time they were synced
+    """
+
+    def __init__(self, path=STORE_PATH, freshness_days=FRESHNESS_DAYS):
+        self.path = path
+        self.freshness_days = freshness_days
+        # shared by the threads of a process, guarded by the lock
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cq (day TEXT, date TEXT, manholeID TEXT, samplerID TEXT, cqValue REAL)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cq_day ON cq (day)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS synced (day TEXT PRIMARY KEY, synced_at TEXT)")
+
+    def getStaleRanges(self, start_date, end_date):
+        """
+        return the (start, end) date ranges that have to be fetched: days never synced,
+        or synced while they were still within the freshness horizon
+        """
+        synced = dict(self.connection.execute(
+            "SELECT day, synced_at FROM synced WHERE day BETWEEN ? AND ?",
+            (start_date.isoformat(), end_date.isoformat())))
+        ranges = []
+        current = start_date
+        while current <= end_date:
+            synced_at = synced.get(current.isoformat())
+            final_after = current + timedelta(days=self.freshness_days)
+            stale = (synced_at is None) or (date.fromisoformat(synced_at) < final_after)
+            if stale:
+                if ranges and ranges[-1][1] == current - timedelta(days=1):
+                    ranges[-1] = (ranges[-1][0], current)
+                else:
+                    ranges.append((current, current))
+            current += timedelta(days=1)
+        return ranges
+
+    def store(self, start_date, end_date, records, today=None):
+        """
+        replace the values of the days from start_date to end_date with the fetched records
+        """
+        today = today or date.today()
+        days = []
+        current = start_date
+        while current <= end_date:
+            days.append((current.isoformat(), today.isoformat()))
+            current += timedelta(days=1)
+        rows = [(record_day(record['date']).isoformat(), record['date'], record['manholeID'],
+                 record.get('samplerID'), record.get('cqValue')) for record in records]
+        rows = [row for row in rows if start_date.isoformat() <= row[0] <= end_date.isoformat()]
+        with self.connection:
+            self.connection.execute("DELETE FROM cq WHERE day BETWEEN ? AND ?",
+                                    (start_date.isoformat(), end_date.isoformat()))
+            self.connection.executemany(
+                "INSERT INTO cq VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO synced VALUES (?, ?)", days)
+
+    def load(self, start_date, end_date):
+        """
+        return the stored records from start_date to end_date in the GraphQL format
+        """
+        rows = self.connection.execute(
+            "SELECT date, manholeID, samplerID, cqValue FROM cq WHERE day BETWEEN ? AND ?",
+            (start_date.isoformat(), end_date.isoformat()))
+        return [{'date': row[0], 'manholeID': row[1], 'samplerID': row[2], 'cqValue': row[3]}
+                for row in rows]
+
+    def invalidate(self, start_date=None, end_date=None):
+        """
+        forget the synced days (all of them by default) so that they are fetched again
+        """
+        with self.connection:
+            if start_date is None:
+                self.connection.execute("DELETE FROM synced")
+            else:
+                self.connection.execute("DELETE FROM synced WHERE day BETWEEN ? AND ?",
+                                        (start_date.isoformat(), (end_date or start_date).isoformat()))
+
+
+def get_store():
+    """
+    return the process wide store, None if it is disabled or can not be opened
+    """
+    global _store, _store_pid
+    # a connection must not be shared with forked worker processes
+    if (_store is None or _store_pid != os.getpid()) and STORE_PATH:
+        try:
+            _store = CqStore(STORE_PATH)
+            _store_pid = os.getpid()
+        except sqlite3.Error as error:
+            print("Cq store not available:", error)
+    return _store
+
+
+def read_cqs(start_date, end_date, fetch, store=None):
+    """
+    return the Cq records from start_date to end_date, fetch(start, end) is only
+    called for the ranges the local store is missing or that may still change
+    """
+    store = store or get_store()
+    if store is None:
+        return fetch(start_date, end_date)
+    try:
+        with store.lock:
+            stale_ranges = store.getStaleRanges(start_date, end_date)
+        # the fetches run without the lock, other threads keep reading the store
+        fetched = [(range_start, range_end, fetch(range_start, range_end))
+                   for range_start, range_end in stale_ranges]
+        with store.lock:
+            for range_start, range_end, records in fetched:
+                store.store(range_start, range_end, records)
+            return store.load(start_date, end_date)
+    except sqlite3.Error as error:
+        print("Cq store failed, reading from the endpoint:", error)
+        return fetch(start_date, end_date)
@@ -0,0 +1,121 @@
+import time
+import threading
+
+
+class FakeFeature:
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+
+class FakeFeatureSet:
+    def __init__(self, features):
+        self.features = features
+
+
+class FakeProperties:
+    objectIdField = 'OBJECTID'
+
+    def __init__(self, max_record_count):
+        self.maxRecordCount = max_record_count
+
+
+class FakeLayer:
+    """
+    in-memory feature layer answering query and edit_features like an ArcGIS
+    Online layer, a page holds at most max_record_count records, every request
+    waits latency seconds and is counted
+    """
+
+    def __init__(self, rows, geometry=True, latency=0.0, max_record_count=2000):
+        self.rows = {row['OBJECTID']: row for row in rows}
+        self.geometry = geometry
+        self.latency = latency
+        self.properties = FakeProperties(max_record_count)
+        self.query_count = 0
+        self.edit_count = 0
+        self.edited_features = 0
+        self.lock = threading.Lock()
+
+    def getGeometry(self, object_id):
+        # a small square per building, enough to make whole feature reads pay for it
+        x, y = float(object_id % 1000), float(object_id // 1000)
+        return {'rings': [[[x, y], [x + 1, y], [x + 1, y + 1], [x, y + 1], [x, y]]]}
+
+    def query(self, where="1=1", out_fields="*", return_geometry=True, result_offset=None,
+              result_record_count=None, return_all_records=True, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.query_count += 1
+            rows = list(self.rows.values())
+        if not return_all_records and result_record_count is not None:
+            offset = result_offset or 0
+            rows = rows[offset:offset + min(result_record_count, self.properties.maxRecordCount)]
+        fields = None if out_fields == "*" else out_fields.split(",")
+        return FakeFeatureSet([FakeFeature(
+            {name: value for name, value in row.items() if fields is None or name in fields},
+            self.getGeometry(row['OBJECTID']) if (return_geometry and self.geometry) else None)
+            for row in rows])
+
+    def edit_features(self, updates=None, adds=None):
+        time.sleep(self.latency)
+        features = updates if updates is not None else (adds or [])
+        results = []
+        with self.lock:
+            self.edit_count += 1
+            self.edited_features += len(features)
+            for feat in features:
+                attributes = dict(feat['attributes'] if isinstance(feat, dict) else feat.attributes)
+                if updates is None:
+                    attributes['OBJECTID'] = len(self.rows) + 1
+                self.rows.setdefault(attributes['OBJECTID'], dict()).update(attributes)
+                results.append({'objectId': attributes['OBJECTID'], 'success': True})
+        return {('updateResults' if updates is not None else 'addResults'): results}
+
+
+class FakeItem:
+    def __init__(self, layers):
+        self.layers = layers
+
+
+class FakeContent:
+    def __init__(self, items):
+        self.items = items
+
+    def search(self, query):
+        # "<title> owner:<user>", the items are found by title only
+        item = self.items.get(query.split(" owner:")[0].strip())
+        return [item] if item is not None else []
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+
+class FakeGIS:
+    """
+    stand-in for arcgis.gis.GIS with the building layers of a sewer network:
+    TracedBuildings_oneday (layer 1), multi_trace_layer and an empty
+    historical_data_layer, one feature per building
+    """
+
+    def __init__(self, network, latency=0.0):
+        building_ids = [str(building_id) for building_id in network.building_ids]
+        single_rows = [{'OBJECTID': idx + 1, 'CAANtext': building_id, 'PossibleSource': "No",
+                        'CASE_DATE': None} for idx, building_id in enumerate(building_ids)]
+        multi_rows = [{'OBJECTID': idx + 1, 'CAANtext_INTERNAL': building_id, 'Status': None,
+                       'Date': None, 'Detection': "No", 'Monitoring': "No", 'Sampling': "No"}
+                      for idx, building_id in enumerate(building_ids)]
+        self.layers = {
+            'TracedBuildings_oneday': [FakeLayer([], latency=latency), FakeLayer(single_rows, latency=latency)],
+            'multi_trace_layer': [FakeLayer(multi_rows, latency=latency)],
+            'historical_data_layer': [FakeLayer([], latency=latency)]}
+        self.content = FakeContent({title: FakeItem(layers) for title, layers in self.layers.items()})
+
+    def requestCounts(self):
+        """
+        return the query, edit and edited feature counts summed over the layers
+        """
+        layers = [layer for item_layers in self.layers.values() for layer in item_layers]
+        return {'arcgis_queries': sum(layer.query_count for layer in layers),
+                'arcgis_edits': sum(layer.edit_count for layer in layers),
+                'arcgis_edited_features': sum(layer.edited_features for layer in layers)}
@@ -0,0 +1,179 @@
+import sys
+import json
+import random
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeData:
+    """
+    deterministic stand-in for the GraphQL database built from a sewer network:
+    every building is a CAAN, every third one residential, about a third of the
+    manholes are sampled on each day except Sundays
+    """
+
+    def __init__(self, network, sampled_ratio=0.3, positive_ratio=0.25, seed=0):
+        self.manhole_ids = [str(manhole_id) for manhole_id in network.manhole_ids]
+        self.caans = [str(building_id) for building_id in network.building_ids] or ['0']
+        self.sampled_ratio = sampled_ratio
+        self.positive_ratio = positive_ratio
+        self.seed = seed
+        self.written_dates = set()
+        self.request_count = 0
+
+    def getManholeCaanMappings(self, variables):
+        return [{'manholeID': manhole_id, 'internalCaan': [self.caans[idx % len(self.caans)]]}
+                for idx, manhole_id in enumerate(self.manhole_ids)]
+
+    def getBuildingInfo(self, variables):
+        return [{'internalCaan': caan, 'isResidential': idx % 3 == 0}
+                for idx, caan in enumerate(self.caans)]
+
+    def getQpcrCqs(self, variables):
+        current = datetime.fromisoformat(variables['startDate'].replace("Z", ""))
+        end = datetime.fromisoformat(variables['endDate'].replace("Z", ""))
+        records = []
+        while current <= end:
+            if current.weekday() != 6:
+                rng = random.Random(self.seed * 100003 + current.toordinal())
+                count = int(len(self.manhole_ids) * self.sampled_ratio)
+                for manhole_id in rng.sample(self.manhole_ids, count):
+                    positive = rng.random() < self.positive_ratio
+                    records.append({'date': current.isoformat() + "Z", 'manholeID': manhole_id,
+                                    'samplerID': 'AS' + manhole_id,
+                                    'cqValue': round(rng.uniform(25, 36), 2) if positive else 0})
+            current += timedelta(days=1)
+        return records
+
+    def query(self, body):
+        self.request_count += 1
+        for name in ('getQpcrCqs', 'getManholeCaanMappings', 'getBuildingInfo'):
+            if name in body.get('query', ''):
+                return {'data': {name: getattr(self, name)(body.get('variables', {}))}}
+        return {'errors': [{'message': 'query not supported by the fake server'}]}
+
+    def write_date(self, date_value):
+        if date_value in self.written_dates:
+            return {'message': 'already updated!'}
+        self.written_dates.add(date_value)
+        return {'message': 'updated!'}
+
+
+class FakeWorksheet:
+    def __init__(self, book, title):
+        self.book = book
+        self.title = title
+
+    def row_values(self, row):
+        return list(self.book.header) if row == self.book.header_row else []
+
+
+class FakeBook:
+    """
+    wastewater spreadsheet of the same data for the sheet cache: one row per
+    manhole with its sampler, building and area, and one Cq column per date
+    """
+
+    def __init__(self, data, dates, header_row=3):
+        self.data = data
+        self.header_row = header_row
+        self.header = ['SamplerID', 'ManholeID', 'Building(s)', 'Area', 'Residential'] + list(dates)
+        self.modified_time = datetime.now().isoformat()
+        self.id = 'fake'
+        self.request_count = 0
+        self.revision_count = 0
+
+    def get_lastUpdateTime(self):
+        # asked from Drive on every call, like gspread
+        self.revision_count += 1
+        return self.modified_time
+
+    def addDate(self, date_value):
+        """
+        add the Cq column of a date, as the lab does every day
+        """
+        self.header.append(date_value)
+        self.modified_time = datetime.now().isoformat() + '+%d' % len(self.header)
+
+    def worksheet(self, title):
+        return FakeWorksheet(self, title)
+
+    def getColumn(self, name):
+        manhole_ids, caans = self.data.manhole_ids, self.data.caans
+        if name == 'SamplerID':
+            return ['AS' + manhole_id for manhole_id in manhole_ids]
+        if name == 'ManholeID':
+            return list(manhole_ids)
+        if name == 'Building(s)':
+            return [caans[idx % len(caans)] for idx in range(len(manhole_ids))]
+        if name == 'Area':
+            return ['Area %d' % (idx % 10) for idx in range(len(manhole_ids))]
+        if name == 'Residential':
+            return ['Yes' if idx % 3 == 0 else 'No' for idx in range(len(manhole_ids))]
+        day = datetime.strptime(name, '%m/%d/%y').isoformat() + "Z"
+        cqs = {record['manholeID']: record['cqValue'] for record in self.data.getQpcrCqs(
+            {'startDate': day, 'endDate': day})}
+        return [str(cqs.get(manhole_id, '')) for manhole_id in manhole_ids]
+
+    def values_batch_get(self, ranges, params=None):
+        self.request_count += 1
+        value_ranges = []
+        for value_range in ranges:
+            # 'tab'!C4:C, one column from the first value row
+            letters = value_range.split('!')[1].split(':')[0].rstrip('0123456789')
+            col = 0
+            for letter in letters:
+                col = col * 26 + ord(letter) - ord('A') + 1
+            value_ranges.append({'range': value_range, 'values': [self.getColumn(self.header[col - 1])]})
+        return {'valueRanges': value_ranges}
+
+
+def make_handler(data):
+    class FakeHandler(BaseHTTPRequestHandler):
+        def reply(self, payload, status_code=200):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            if urlparse(self.path).path != '/query':
+                return self.reply({'message': 'not found'}, 404)
+            self.reply(data.query(json.loads(self.rfile.read(length) or b'{}')))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/write_date':
+                return self.reply({'message': 'not found'}, 404)
+            self.reply(data.write_date(parse_qs(url.query).get('date', [None])[0]))
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeHandler
+
+
+def serve(network, port=8081, host='127.0.0.1', data=None):
+    """
+    return a server, not yet serving, that answers /query like the GraphQL
+    endpoint and /write_date like the write_date service
+    """
+    return ThreadingHTTPServer((host, port), make_handler(data or FakeData(network)))
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    port = int(targets[1]) if len(targets) > 1 else 8081
+    if len(targets) > 2:
+        from synthetic_network import generate_network
+        network = generate_network(int(targets[2]))
+    else:
+        from network_artifact import load_network
+        network = load_network()
+    server = serve(network, port)
+    print("fake GraphQL server on http://127.0.0.1:%d/query, set TRACE_QUERY_URL and TRACE_WRITE_DATE_URL to use it" % port)
+    server.serve_forever()
@@ -0,0 +1,162 @@
+import csv
+import numpy as np
+import pandas as pd
+from xml.sax.saxutils import quoteattr
+from xml.etree import ElementTree
+
+
+# the manhole reachability graph is sparse, a dense adjacency grows with the square of the manholes
+EXPORT_FORMATS = {'.csv': 'edgelist', '.npz': 'npz', '.graphml': 'graphml', '.parquet': 'parquet'}
+GRAPHML_NS = '{http://graphml.graphdrawing.org/xmlns}'
+
+
+def graph_edges(graph):
+    """
+    return (nodes, sources, targets) of a graph given as a map of node to its
+    successors, the edges are int32 positions in nodes, nodes are in the order
+    networkx.DiGraph(graph) would list them
+    """
+    positions = {node: position for position, node in enumerate(graph)}
+    nodes, sources, targets = list(graph), [], []
+    for node, successors in graph.items():
+        source = positions[node]
+        for successor in successors:
+            if successor not in positions:
+                positions[successor] = len(nodes)
+                nodes.append(successor)
+            sources.append(source)
+            targets.append(positions[successor])
+    return nodes, np.array(sources, dtype=np.int32), np.array(targets, dtype=np.int32)
+
+
+def edge_frame(nodes, sources, targets):
+    """
+    return the edge table (source, target) of a graph with the node ids
+    """
+    return pd.DataFrame({'source': [nodes[source] for source in sources.tolist()],
+                         'target': [nodes[target] for target in targets.tolist()]},
+                        columns=['source', 'target'])
+
+
+def isolated_nodes(nodes, sources, targets):
+    linked = np.zeros(len(nodes), dtype=bool)
+    linked[sources] = True
+    linked[targets] = True
+    return np.flatnonzero(~linked).tolist()
+
+
+def to_csr(node_count, sources, targets):
+    """
+    return the (indptr, indices) arrays of the adjacency of the edges
+    """
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=indptr[1:])
+    return indptr, targets[order].astype(np.int32)
+
+
+def save_graph(path, nodes, sources, targets, export_format=None):
+    """
+    save a graph as an edge list csv (a node without edges is a row without target),
+    a CSR .npz readable by scipy.sparse.load_npz with the node ids in node_ids,
+    a GraphML file or a parquet edge table (needs pyarrow)
+    """
+    export_format = export_format or get_format(path)
+    names = [str(node) for node in nodes]
+    if export_format == 'edgelist':
+        with open(path, 'w', newline='') as export_file:
+            writer = csv.writer(export_file)
+            writer.writerow(['source', 'target'])
+            writer.writerows((names[source], names[target])
+                             for source, target in zip(sources.tolist(), targets.tolist()))
+            writer.writerows((names[node], '') for node in isolated_nodes(nodes, sources, targets))
+    elif export_format == 'npz':
+        indptr, indices = to_csr(len(nodes), sources, targets)
+        np.savez_compressed(path, format=np.array(b'csr'), shape=np.array([len(nodes), len(nodes)]),
+                            data=np.ones(len(indices), dtype=np.int8), indptr=indptr, indices=indices,
+                            node_ids=np.array(names, dtype=str))
+    elif export_format == 'graphml':
+        with open(path, 'w', encoding='utf-8') as export_file:
+            export_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                              '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                              '<graph id="G" edgedefault="directed">\n')
+            for name in names:
+                export_file.write('<node id=%s/>\n' % quoteattr(name))
+            for source, target in zip(sources.tolist(), targets.tolist()):
+                export_file.write('<edge source=%s target=%s/>\n' % (
+                    quoteattr(names[source]), quoteattr(names[target])))
+            export_file.write('</graph>\n</graphml>\n')
+    elif export_format == 'parquet':
+        isolated = isolated_nodes(nodes, sources, targets)
+        pd.DataFrame({
+            'source': [names[source] for source in sources.tolist()] + [names[node] for node in isolated],
+            'target': [names[target] for target in targets.tolist()] + [None] * len(isolated)
+        }).to_parquet(path, index=False)
+    else:
+        raise ValueError("unknown graph export format %s" % export_format)
+
+
+def get_format(path):
+    for extension, export_format in EXPORT_FORMATS.items():
+        if path.endswith(extension):
+            return export_format
+    raise ValueError("unknown graph export format of %s" % path)
+
+
+def edges_from_pairs(pairs):
+    positions = dict()
+    nodes, sources, targets = [], [], []
+    for source, target in pairs:
+        for node in (source, target):
+            if node and node not in positions:
+                positions[node] = len(nodes)
+                nodes.append(node)
+        if target:
+            sources.append(positions[source])
+            targets.append(positions[target])
+    return nodes, np.array(sources, dtype=np.int32), np.array(targets, dtype=np.int32)
+
+
+def load_graph(path, export_format=None):
+    """
+    return (node ids, sources, targets) of a graph saved by save_graph,
+    without networkx or scipy
+    """
+    export_format = export_format or get_format(path)
+    if export_format == 'edgelist':
+        with open(path, newline='') as export_file:
+            reader = csv.reader(export_file)
+            next(reader)
+            return edges_from_pairs((row[0], row[1]) for row in reader)
+    if export_format == 'npz':
+        with np.load(path) as loaded:
+            indptr, indices = loaded['indptr'], loaded['indices']
+            sources = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+            return loaded['node_ids'].tolist(), sources, indices.astype(np.int32)
+    if export_format == 'graphml':
+        positions = dict()
+        nodes, sources, targets = [], [], []
+        for _, element in ElementTree.iterparse(path):
+            if element.tag == GRAPHML_NS + 'node':
+                positions[element.get('id')] = len(nodes)
+                nodes.append(element.get('id'))
+            elif element.tag == GRAPHML_NS + 'edge':
+                sources.append(positions[element.get('source')])
+                targets.append(positions[element.get('target')])
+            element.clear()
+        return nodes, np.array(sources, dtype=np.int32), np.array(targets, dtype=np.int32)
+    if export_format == 'parquet':
+        table = pd.read_parquet(path)
+        return edges_from_pairs(zip(table['source'].tolist(), table['target'].tolist()))
+    raise ValueError("unknown graph export format %s" % export_format)
+
+
+def load_csr(path):
+    """
+    return (node ids, scipy.sparse.csr_matrix adjacency) of a saved graph
+    """
+    from scipy.sparse import csr_matrix
+    nodes, sources, targets = load_graph(path)
+    indptr, indices = to_csr(len(nodes), sources, targets)
+    return nodes, csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                             shape=(len(nodes), len(nodes)))
@@ -1,11 +1,28 @@
 import os
-from trace import autoPilot, autoPilotManhole
+from trace import autoPilot, autoPilotManhole, autoPilotMulti, count_modes, MODE_BITS, STATUS_TYPES
+from traceGraph import TraceGraph
 from env_setup import getArcCredentials
 from arcgis.gis import GIS
 import sys
 import datetime
 import json
+import time
+import backend_client
+import metrics
 import requests
+from urllib3.exceptions import NewConnectionError
+
+
+# point TRACE_WRITE_DATE_URL to a local fake_graphql.py server to test without the service
+WRITE_DATE_URL = os.environ.get(
+    'TRACE_WRITE_DATE_URL', 'http://34.170.60.95:5939/write_date')
+
+
+# features per edit_features request and retries of a failed request
+EDIT_CHUNK_SIZE = int(os.environ.get('TRACE_EDIT_CHUNK_SIZE', 500))
+EDIT_RETRIES = 3
+# records per query page, the ArcGIS Online default maxRecordCount
+FEATURE_PAGE_SIZE = int(os.environ.get('TRACE_FEATURE_PAGE_SIZE', 2000))
 
 
 class ArcgisError(Exception):
@@ -18,6 +35,43 @@ class InvalidLayerIdError(ArcgisError):
     pass
 
 
+def never_sent(error):
+    """
+    whether a failed edit request is known not to have reached ArcGIS: the
+    connection could not be made, so an add can be sent again without duplicating rows
+    """
+    if isinstance(error, (requests.exceptions.ConnectTimeout, ConnectionRefusedError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class FeatureRecord:
+    """
+    attributes, and geometry if it was queried, of a feature without the arcgis Feature overhead
+    """
+    __slots__ = ('attributes', 'geometry')
+
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+    def asDict(self):
+        feature = {'attributes': self.attributes}
+        if self.geometry is not None:
+            feature['geometry'] = self.geometry
+        return feature
+
+
+def feature_dict(feat):
+    # the edit payload of a feature dict, FeatureRecord or arcgis Feature
+    if isinstance(feat, dict):
+        return feat
+    return FeatureRecord(feat.attributes, getattr(feat, 'geometry', None)).asDict()
+
+
 class ArcgisOperation:
     def __init__(self):
         try:
@@ -27,8 +81,9 @@ class ArcgisOperation:
             getArcCredentials()
             self.arc_username = os.environ['ARC_USER']
             self.arc_password = os.environ['ARC_PASS']
-        self.gis = GIS("https://www.arcgis.com",
-                       self.arc_username, self.arc_password)
+        with metrics.timer('arcgis_login'):
+            self.gis = GIS("https://www.arcgis.com",
+                           self.arc_username, self.arc_password)
         print("login success")
 
     def getItemById(self, layer_id):
@@ -49,9 +104,53 @@ class ArcgisOperation:
         query_string = query + " " + "owner:" + owner
         return self.gis.content.search(query_string)
 
-    def getFeatures(self, layer):
-        features = layer.query().features
-        return features
+    def getObjectIdField(self, layer):
+        try:
+            return layer.properties.objectIdField
+        except (AttributeError, KeyError):
+            return 'OBJECTID'
+
+    def getMaxRecordCount(self, layer, default=FEATURE_PAGE_SIZE):
+        try:
+            return int(layer.properties.maxRecordCount)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return default
+
+    @metrics.timed('arcgis_query')
+    def getFeatures(self, layer, out_fields="*", return_geometry=True, page_size=None):
+        """
+        return the features of a layer, by default every field and the geometry,
+        a list of out_fields (the object id is always included) or no geometry
+        returns FeatureRecord objects, read page_size records per request,
+        at most the maxRecordCount of the layer
+        """
+        if out_fields == "*" and return_geometry and page_size is None:
+            features = layer.query().features
+            metrics.count('arcgis_query_requests')
+            metrics.count('arcgis_features_read', len(features))
+            return features
+        if out_fields != "*":
+            object_id_field = self.getObjectIdField(layer)
+            out_fields = [object_id_field] + [field for field in out_fields if field != object_id_field]
+        fields = out_fields if out_fields == "*" else ",".join(out_fields)
+        if page_size is not None:
+            # a short page ends the read, a page can not be longer than the layer allows
+            page_size = min(page_size, self.getMaxRecordCount(layer, page_size))
+        features, offset = [], 0
+        while True:
+            if page_size is None:
+                page = layer.query(out_fields=fields, return_geometry=return_geometry).features
+            else:
+                page = layer.query(out_fields=fields, return_geometry=return_geometry,
+                                   result_offset=offset, result_record_count=page_size,
+                                   return_all_records=False).features
+            features += [FeatureRecord(feat.attributes, feat.geometry if return_geometry else None)
+                         for feat in page]
+            metrics.count('arcgis_query_requests')
+            metrics.count('arcgis_features_read', len(page))
+            if page_size is None or len(page) < page_size:
+                return features
+            offset += page_size
 
     def addField(self, field_objects, layer):
         """
@@ -74,6 +173,165 @@ class ArcgisOperation:
         results = layer.edit_features(adds=features)
         return results
 
+    def getChangedFeatures(self, features, current_attributes, fields):
+        """
+        return the features whose fields differ from the current attributes,
+        given as a list of attribute dicts in the same order as features
+        """
+        return [feat for feat, current in zip(features, current_attributes)
+                if any(feat.attributes.get(field) != current.get(field) for field in fields)]
+
+    @metrics.timed('arcgis_edit')
+    def editInChunks(self, layer, features, operation="update", chunk_size=EDIT_CHUNK_SIZE, retries=EDIT_RETRIES):
+        """
+        update or add features in chunks of chunk_size, retrying a failed request with backoff,
+        return the success/fail counts across chunks, the object ids that failed and the errors
+
+        adds are not idempotent: a failed add is only retried when it never reached ArcGIS,
+        otherwise its chunk is reported as failed to be checked and re-run by hand
+        """
+        result_key = operation + 'Results'
+        report = {operation + '_success_count': 0, operation + '_fail_count': 0,
+                  'failed_object_ids': [], 'errors': []}
+        object_id_field = self.getObjectIdField(layer)
+        for idx in range(0, len(features), chunk_size):
+            chunk = [feature_dict(feat) for feat in features[idx:idx + chunk_size]]
+            edit_result = None
+            for attempt in range(retries + 1):
+                metrics.count('arcgis_edit_requests')
+                metrics.count('arcgis_features_sent', len(chunk))
+                try:
+                    if operation == "update":
+                        edit_result = layer.edit_features(updates=chunk)
+                    else:
+                        edit_result = layer.edit_features(adds=chunk)
+                    break
+                except Exception as error:
+                    if attempt == retries or (operation != "update" and not never_sent(error)):
+                        report['errors'].append(str(error))
+                        break
+                    time.sleep(2 ** attempt)
+            if edit_result is None:
+                report[operation + '_fail_count'] += len(chunk)
+                report['failed_object_ids'] += [feat['attributes'].get(object_id_field) for feat in chunk]
+                continue
+            # assumption: elem would always have key "success"
+            success_cnt = sum(int(elem['success'])
+                              for elem in edit_result[result_key])
+            report[operation + '_success_count'] += success_cnt
+            report[operation + '_fail_count'] += len(edit_result[result_key]) - success_cnt
+            report['failed_object_ids'] += [elem.get('objectId') for elem in edit_result[result_key]
+                                            if not elem['success']]
+            report['errors'] += [elem['error'].get('description', str(elem['error']))
+                                 for elem in edit_result[result_key] if elem.get('error')]
+        return report
+
+
+class TraceContext:
+    """
+    state shared by the layer updates of one invocation: a single ArcGIS
+    session, the fetched layers and features, the traced statuses by (date, mode) and
+    one graph for all its traces, graph when it is given, pass historical when the
+    invocation adds to the historical layer so that the multi trace layer is read once
+    for all writes
+    """
+
+    def __init__(self, graph=None, historical=False):
+        self.graph = graph
+        self.historical = historical
+        self.arcgis_operation = None
+        self.layers = dict()
+        self.features = dict()
+        # attributes of the features as they are on the server, to send only changes
+        self.attributes = dict()
+        self.statuses = dict()
+
+    def getArcgis(self):
+        if self.arcgis_operation is None:
+            self.arcgis_operation = ArcgisOperation()
+        return self.arcgis_operation
+
+    def getGraph(self):
+        if self.graph is None:
+            self.graph = TraceGraph()
+        return self.graph
+
+    def getLayer(self, query, index):
+        if (query, index) not in self.layers:
+            arcgis = self.getArcgis()
+            self.layers[query, index] = arcgis.contentSearch(
+                arcgis.arc_username, query)[0].layers[index]
+        return self.layers[query, index]
+
+    def featureKey(self, query, index, out_fields, return_geometry):
+        return (query, index, out_fields if out_fields == "*" else tuple(out_fields), return_geometry)
+
+    def getFeatures(self, query, index, out_fields="*", return_geometry=True):
+        """
+        return the features of a layer, fetched once per (layer, fields, geometry),
+        projected reads are paged and return FeatureRecord objects
+        """
+        key = self.featureKey(query, index, out_fields, return_geometry)
+        if key not in self.features:
+            page_size = None if (out_fields == "*" and return_geometry) else FEATURE_PAGE_SIZE
+            self.features[key] = self.getArcgis().getFeatures(
+                self.getLayer(query, index), out_fields, return_geometry, page_size)
+            self.attributes[key] = [dict(feat.attributes)
+                                    for feat in self.features[key]]
+        return self.features[key]
+
+    def getBuildingFields(self):
+        # (out_fields, return_geometry) of the multi trace layer read
+        return ("*", True) if self.historical else (MULTI_FIELDS, False)
+
+    def getBuildingFeatures(self, historical=False):
+        """
+        return the multi trace layer features, read once for the multi updates and
+        historical adds of the context: every field and the geometry when it adds
+        history, only MULTI_FIELDS otherwise
+        """
+        self.historical = self.historical or historical
+        return self.getFeatures("multi_trace_layer", 0, *self.getBuildingFields())
+
+    def updateChanged(self, query, index, fields, out_fields="*", return_geometry=True, send_fields=None):
+        """
+        send the features of a layer whose fields changed since they were fetched
+        or last sent, in chunks, return the aggregated report,
+        with send_fields only those columns and the object id are sent, without geometry
+        """
+        arcgis = self.getArcgis()
+        layer = self.getLayer(query, index)
+        object_id_field = arcgis.getObjectIdField(layer)
+        features = self.getFeatures(query, index, out_fields, return_geometry)
+        current_attributes = self.attributes[self.featureKey(query, index, out_fields, return_geometry)]
+        changed = set(id(feat) for feat in arcgis.getChangedFeatures(
+            features, current_attributes, fields))
+        changed_features = [feat for feat in features if id(feat) in changed]
+        if send_fields is not None:
+            names = [object_id_field] + list(send_fields)
+            changed_features = [FeatureRecord({name: feat.attributes.get(name) for name in names})
+                                for feat in changed_features]
+        report = arcgis.editInChunks(layer, changed_features)
+        report['update_unchanged_count'] = len(features) - len(changed)
+        failed = set(report['failed_object_ids'])
+        for idx, feat in enumerate(features):
+            if id(feat) in changed and feat.attributes.get(object_id_field) not in failed:
+                current_attributes[idx] = dict(feat.attributes)
+        return report
+
+    def getStatuses(self, date_val, mode):
+        """
+        return (error message, result) of the trace, mode "multi" gives the
+        building to mode mask map, any other mode the affected buildings
+        """
+        if (date_val, mode) not in self.statuses:
+            if mode == "multi":
+                self.statuses[date_val, mode] = autoPilotMulti(date_val, self.getGraph())
+            else:
+                self.statuses[date_val, mode] = autoPilot(
+                    date_val, mode=mode, graph=self.getGraph())
+        return self.statuses[date_val, mode]
+
 
 def write_json(date_value, filename="../data/historical_date.json"):
     # with open(filename) as json_file:
@@ -91,90 +349,87 @@ def check_exist(date_value, filename="../data/historical_date.json"):
     return date_value in data
 
 
-def updateBuilding(date_val, trace_mode="single"):
-    arcgis = ArcgisOperation()
-    black_list = set(['6176', '6143', '7277', '7278', '7705',
-                     '7700', '7701', '7702', '7703', '7704', '7279'])
+# buildings always reported as monitored but not sampled
+BLACK_LIST = set(['6176', '6143', '7277', '7278', '7705',
+                  '7700', '7701', '7702', '7703', '7704', '7279'])
+MODE_COLUMNS = {'detection': 'Detection',
+                'monitoring': 'Monitoring', 'sampling': 'Sampling'}
+# the columns the building updates read and write
+SINGLE_FIELDS = ['CAANtext', 'PossibleSource', 'CASE_DATE']
+MULTI_FIELDS = ['CAANtext_INTERNAL', 'Status', 'Date'] + list(MODE_COLUMNS.values())
+# the columns compared to send only changed buildings, the date columns are not
+# compared: they are only stamped on the rows sent, a quiet day sends nothing
+SINGLE_CHANGED_FIELDS = ['PossibleSource']
+MULTI_CHANGED_FIELDS = ['Status'] + list(MODE_COLUMNS.values())
+
+
+def setBuildingStatus(features, date_val, building_modes):
+    """
+    set the mode columns, Date and Status of the multi trace layer features
+    from the building to mode mask map of a date
+    """
+    for feat in features:
+        modes = building_modes.get(feat.attributes['CAANtext_INTERNAL'], 0)
+        for mode, name in MODE_COLUMNS.items():
+            feat.attributes[name] = "Yes" if modes & MODE_BITS[mode] else "No"
+        feat.attributes['Date'] = datetime.datetime.strptime(
+            date_val, '%m/%d/%y')+datetime.timedelta(days=1)  # add one day to counter UTC To PST difference
+        if feat.attributes['CAANtext_INTERNAL'] in BLACK_LIST:
+            feat.attributes['Status'] = STATUS_TYPES[1]
+        else:
+            if (count_modes(modes) == 0) and (modes & MODE_BITS["paused monitoring"]):
+                feat.attributes['Status'] = "Monitoring Paused Over Summer"
+            else:
+                feat.attributes['Status'] = STATUS_TYPES[count_modes(modes)]
+
+
+@metrics.timed('update_building')
+def updateBuilding(date_val, trace_mode="single", context=None):
+    """
+    update the building layers for a date, pass the same TraceContext to
+    reuse the ArcGIS session, features and traces across calls
+    """
+    context = context or TraceContext()
+    arcgis = context.getArcgis()
     # loop to update, default detection mode
     if trace_mode == "single":
-        building_layer = arcgis.contentSearch(
-            arcgis.arc_username, "TracedBuildings_oneday")[0].layers[1]
-        features = arcgis.getFeatures(building_layer)
-        error_message, affected_buildings = autoPilot(date_val)
+        features = context.getFeatures("TracedBuildings_oneday", 1, SINGLE_FIELDS, False)
+        error_message, affected_buildings = context.getStatuses(
+            date_val, "detection")
         affected_set = set(affected_buildings)
         if not error_message:
             for feat in features:
                 binary_check = "Yes" if feat.attributes['CAANtext'] in affected_set else "No"
                 feat.attributes['PossibleSource'] = binary_check
                 feat.attributes['CASE_DATE'] = date_val
-            update_result = building_layer.edit_features(updates=features)
-            success_cnt = sum(int(elem['success'])
-                              for elem in update_result['updateResults'])
-            fail_cnt = len(update_result['updateResults']) - success_cnt
-            report = {'update_success_count': success_cnt,
-                      'update_fail_count': fail_cnt}
+            # only buildings whose status changed are sent
+            report = context.updateChanged(
+                "TracedBuildings_oneday", 1, SINGLE_CHANGED_FIELDS, SINGLE_FIELDS, False)
             return error_message, report
         return error_message, {}
     else:
-        # check three modes
-        building_layer = arcgis.contentSearch(
-            arcgis.arc_username, "multi_trace_layer")[0].layers[0]
-        features = arcgis.getFeatures(building_layer)
-        mode_col_map = {'detection': 'Detection',
-                        'monitoring': 'Monitoring', 'sampling': 'Sampling'}
-        status_types = ["Not Currently Monitored", "Currently Monitored + Not Sampled",
-                        "Currently Monitored + Sampled + Not Detected", "Currently Monitored + Sampled + Detected"]
-        status_sign_cnt = [0]*len(features)
-        for mode, name in mode_col_map.items():
-            error_message, affected_buildings = autoPilot(date_val, mode=mode)
-            affected_set = set(affected_buildings)
-            if not error_message:
-                for idx, feat in enumerate(features):
-                    binary_check = "Yes" if feat.attributes['CAANtext_INTERNAL'] in affected_set else "No"
-                    if binary_check == "Yes":
-                        status_sign_cnt[idx] += 1
-                    feat.attributes[name] = binary_check
-                    feat.attributes['Date'] = datetime.datetime.strptime(
-                        date_val, '%m/%d/%y')+datetime.timedelta(days=1)  # add one day to counter UTC To PST difference
-            else:
-                return error_message, {}
-
-        # check if they are paused
-        _, paused_buildings = autoPilot(date_val, mode="paused monitoring")
-        pause_set = set(paused_buildings)
-
-        for idx, feat in enumerate(features):
-            if feat.attributes['CAANtext_INTERNAL'] in black_list:
-                feat.attributes['Status'] = status_types[1]
-            else:
-                if (status_sign_cnt[idx] == 0) and (feat.attributes['CAANtext_INTERNAL'] in pause_set):
-                    feat.attributes['Status'] = "Monitoring Paused Over Summer"
-                else:
-                    feat.attributes['Status'] = status_types[status_sign_cnt[idx]]
+        # check three modes, the multi update and the historical add share one read
+        # of the layer, whole features when the context adds history
+        features = context.getBuildingFeatures(trace_mode == "historical")
+        # all modes and the paused manholes are traced in one pass
+        error_message, building_modes = context.getStatuses(date_val, "multi")
+        if error_message:
+            return error_message, {}
+        setBuildingStatus(features, date_val, building_modes)
         if trace_mode == "multi":
-            update_result = building_layer.edit_features(updates=features)
-            # assumption: elem would always have key "success"
-            success_cnt = sum(int(elem['success'])
-                              for elem in update_result['updateResults'])
-            fail_cnt = len(update_result['updateResults']) - success_cnt
-            report = {'update_success_count': success_cnt,
-                      'update_fail_count': fail_cnt}
-            print(report)
+            # only buildings whose status changed are sent
+            report = context.updateChanged(
+                "multi_trace_layer", 0, MULTI_CHANGED_FIELDS, *context.getBuildingFields(),
+                send_fields=MULTI_FIELDS)
+            metrics.payload(report)
         elif trace_mode == "historical":
             reponse_json = write_date(date_val)
             if reponse_json['message'] == 'already updated!':
                 return None, reponse_json
             else:
-                historical_layer = arcgis.contentSearch(
-                    arcgis.arc_username, "historical_data_layer")[0].layers[0]
-                add_result = arcgis.addToTable(historical_layer, features)
-                # assumption: elem would always have key "success"
-                success_cnt = sum(int(elem['success'])
-                                  for elem in add_result['addResults'])
-                fail_cnt = len(add_result['addResults']) - success_cnt
-                report = {'add_success_count': success_cnt,
-                          'add_fail_count': fail_cnt}
-                print(report)
+                historical_layer = context.getLayer("historical_data_layer", 0)
+                report = arcgis.editInChunks(historical_layer, features, "add")
+                metrics.payload(report)
         return None, report
 
 
@@ -182,8 +437,8 @@ def write_date(date_val):
     params = (
         ('date', date_val),
     )
-    response = requests.get(
-        'http://34.170.60.95:5939/write_date', params=params)
+    # not retried once sent: a retry after the date was recorded answers 'already updated!'
+    response = backend_client.get(WRITE_DATE_URL, idempotent=False, params=params)
     reponse_json = response.json()
     print(reponse_json)
     return reponse_json
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+from collections import defaultdict
+
+
+# one JSON line per invocation with its stage timings and counters, 0 to disable
+LOG_METRICS = os.environ.get('TRACE_METRICS_LOG', '1') != '0'
+# whole results (trace lists, drop-in csv, edit reports) are only printed with 1
+LOG_PAYLOADS = os.environ.get('TRACE_LOG_PAYLOADS', '0') == '1'
+
+_local = threading.local()
+
+
+class Metrics:
+    """
+    stage timings (total seconds and calls) and counters (requests, bytes,
+    visited nodes ...) of one invocation, shared by the threads working for it
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.timers[stage] += seconds
+            self.calls[stage] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def asDict(self):
+        with self.lock:
+            return {'name': self.name,
+                    'total_s': round(time.time() - self.started, 6),
+                    'stages': {stage: {'s': round(seconds, 6), 'calls': self.calls[stage]}
+                               for stage, seconds in self.timers.items()},
+                    'counters': dict(self.counters)}
+
+
+def current():
+    """
+    return the metrics of the invocation running in this thread, None outside of one
+    """
+    return getattr(_local, 'metrics', None)
+
+
+@contextlib.contextmanager
+def activate(collected):
+    previous = current()
+    _local.metrics = collected
+    try:
+        yield collected
+    finally:
+        _local.metrics = previous
+
+
+@contextlib.contextmanager
+def collect(name):
+    """
+    record the stages and counters of an invocation, logged as one JSON line at the end
+    """
+    collected = Metrics(name)
+    with activate(collected):
+        try:
+            yield collected
+        finally:
+            if LOG_METRICS:
+                print(json.dumps({'trace_metrics': collected.asDict()}), flush=True)
+
+
+@contextlib.contextmanager
+def timer(stage):
+    collected = current()
+    if collected is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        collected.add(stage, time.perf_counter() - start)
+
+
+def count(name, value=1):
+    collected = current()
+    if collected is not None:
+        collected.count(name, value)
+
+
+def bind(call):
+    """
+    return call running under the metrics of the calling thread, for thread pools
+    """
+    collected = current()
+    if collected is None:
+        return call
+
+    def bound(*args, **kwargs):
+        with activate(collected):
+            return call(*args, **kwargs)
+    return bound
+
+
+def timed(stage, call=None):
+    """
+    return call timed as stage when it runs, without call a decorator
+    """
+    if call is None:
+        return lambda function: timed(stage, function)
+
+    @functools.wraps(call)
+    def run(*args, **kwargs):
+        with timer(stage):
+            return call(*args, **kwargs)
+    return run
+
+
+def payload(*values):
+    """
+    print a large result (trace lists, csv, reports) only when TRACE_LOG_PAYLOADS is set
+    """
+    if LOG_PAYLOADS:
+        print(*values)
@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+
+ARTIFACT_VERSION = 1
+MAGIC = b'SEWERNET'
+ALIGNMENT = 64
+NETWORK_DIR = os.path.join('..', 'data', 'network2')
+ARTIFACT_NAME = 'sewer_network.bin'
+SHAPEFILES = {'pipe': 'SewerPipe_1',
+              'manhole': 'MergedVertices_1',
+              'building': 'Sewer_Buildings_Project_1'}
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf')
+
+
+class ArtifactError(Exception):
+    """Base class for other exceptions"""
+    pass
+
+
+class InvalidArtifactError(ArtifactError):
+    """Raised when the artifact is missing, corrupted or of another version"""
+    pass
+
+
+class MissingBuildDependencyError(ArtifactError):
+    """Raised when the artifact has to be compiled in a runtime without geopandas"""
+    pass
+
+
+class SewerNetwork:
+    """
+    compact sewer network: integer node ids, CSR adjacency in both flow
+    directions and manhole/building id tables
+
+    coords: (n, 2) float64 coordinate of each node
+    down_ptr, down_idx: CSR of the pipe edges in flow direction
+    up_ptr, up_idx: CSR of the reversed pipe edges
+    node_manhole, node_building: index into manhole_ids/building_ids, -1 if none
+    manhole_nodes: node of every manhole in manhole_ids
+    building_ptr, building_idx: CSR of the nodes of every building in building_ids
+    """
+    ARRAYS = ('coords', 'down_ptr', 'down_idx', 'up_ptr', 'up_idx', 'node_manhole',
+              'node_building', 'manhole_nodes', 'building_ptr', 'building_idx')
+
+    def __init__(self, arrays, manhole_ids, building_ids, sources=None):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.manhole_ids = manhole_ids
+        self.building_ids = building_ids
+        self.sources = sources or {}
+
+    @property
+    def node_count(self):
+        return len(self.coords)
+
+    @property
+    def edge_count(self):
+        return len(self.down_idx)
+
+    def manhole_to_coords_map(self):
+        return {manhole_id: tuple(self.coords[node].tolist())
+                for manhole_id, node in zip(self.manhole_ids, self.manhole_nodes.tolist())}
+
+    def coords_to_manhole_map(self):
+        labelled = np.flatnonzero(np.asarray(self.node_manhole) >= 0)
+        return {tuple(self.coords[node].tolist()): self.manhole_ids[label]
+                for node, label in zip(labelled.tolist(), self.node_manhole[labelled].tolist())}
+
+    def build_to_coords_map(self):
+        ptr = self.building_ptr.tolist()
+        return {building_id: set(tuple(self.coords[node].tolist()) for node in self.building_idx[ptr[i]:ptr[i + 1]].tolist())
+                for i, building_id in enumerate(self.building_ids)}
+
+    def coords_to_build_map(self):
+        labelled = np.flatnonzero(np.asarray(self.node_building) >= 0)
+        return {tuple(self.coords[node].tolist()): self.building_ids[label]
+                for node, label in zip(labelled.tolist(), self.node_building[labelled].tolist())}
+
+    def fingerprint(self):
+        """
+        return a digest of the shapefiles the network was compiled from, None for
+        a network built in memory, tables derived from the network are keyed by it
+        """
+        if not self.sources:
+            return None
+        hashes = sorted((name, source['sha256']) for name, source in self.sources.items())
+        return hashlib.sha256(json.dumps([ARTIFACT_VERSION, hashes]).encode('utf-8')).hexdigest()
+
+    def edge_pairs(self, mode="downstream"):
+        """
+        return the (source, target) node arrays of the pipe edges
+        """
+        ptr, idx = (self.down_ptr, self.down_idx) if mode == "downstream" else (
+            self.up_ptr, self.up_idx)
+        sources = np.repeat(np.arange(len(ptr) - 1, dtype=np.int32), np.diff(ptr))
+        return sources, np.asarray(idx)
+
+
+def _plain(value):
+    # numpy scalars are not json serializable
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _to_csr(sources, targets, node_count):
+    order = np.lexsort((targets, sources))
+    ptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=ptr[1:])
+    return ptr, targets[order].astype(np.int32)
+
+
+def _file_fingerprint(path, with_hash=True):
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                sha.update(block)
+        fingerprint['sha256'] = sha.hexdigest()
+    return fingerprint
+
+
+def shapefile_paths(network_dir=NETWORK_DIR):
+    """
+    return a map of shapefile component name to path, only for existing files
+    """
+    paths = {}
+    for name in SHAPEFILES.values():
+        for part in SHAPEFILE_PARTS:
+            path = os.path.join(network_dir, name + part)
+            if os.path.exists(path):
+                paths[name + part] = path
+    return paths
+
+
+def sources_match(sources, network_dir=NETWORK_DIR):
+    """
+    check whether the shapefiles the artifact was compiled from are unchanged,
+    only hashing the files whose size or mtime differ
+    """
+    paths = shapefile_paths(network_dir)
+    if set(paths) != set(sources):
+        return False
+    for name, path in paths.items():
+        recorded = sources[name]
+        current = _file_fingerprint(path, with_hash=False)
+        if current == {'size': recorded['size'], 'mtime_ns': recorded['mtime_ns']}:
+            continue
+        if current['size'] != recorded['size'] or _file_fingerprint(path)['sha256'] != recorded['sha256']:
+            return False
+    return True
+
+
+def compile_network(network_dir=NETWORK_DIR):
+    """
+    read the three shapefiles and build the compact network,
+    geopandas is only needed here
+    """
+    import geopandas
+    df_pipe = geopandas.read_file(os.path.join(network_dir, SHAPEFILES['pipe'] + '.shp'))
+    df_manhole = geopandas.read_file(os.path.join(network_dir, SHAPEFILES['manhole'] + '.shp'))
+    df_buildings = geopandas.read_file(os.path.join(network_dir, SHAPEFILES['building'] + '.shp'))
+
+    node_ids = dict()
+
+    def intern(coord):
+        try:
+            return node_ids[coord]
+        except KeyError:
+            node_ids[coord] = len(node_ids)
+            return node_ids[coord]
+
+    sources, targets = [], []
+    for geometry in df_pipe['geometry']:
+        coords = [intern(tuple(coord)) for coord in geometry.coords]
+        sources.extend(coords[:-1])
+        targets.extend(coords[1:])
+
+    # a manhole id maps to its last coordinate and a coordinate to its last manhole
+    manhole_nodes = dict()
+    for manhole_id, geometry in zip(df_manhole['UCSD_ID'], df_manhole['geometry']):
+        manhole_nodes[_plain(manhole_id)] = intern((geometry.x, geometry.y))
+
+    building_nodes = dict()
+    for building_id, geometry in zip(df_buildings['BID'], df_buildings['geometry']):
+        if building_id:
+            building_nodes.setdefault(_plain(building_id), set()).add(
+                intern((geometry.x, geometry.y)))
+
+    fingerprints = {name: _file_fingerprint(path)
+                    for name, path in shapefile_paths(network_dir).items()}
+    return build_network(list(node_ids), sources, targets, manhole_nodes,
+                         building_nodes, fingerprints)
+
+
+def build_network(node_coords, sources, targets, manhole_nodes, building_nodes, fingerprints=None):
+    """
+    build the compact network from node coordinates, pipe edges (source to
+    target node) and maps of manhole id to node and building id to nodes
+    """
+    node_count = len(node_coords)
+    coords = np.array(node_coords, dtype=np.float64).reshape(node_count, 2)
+    manhole_ids = list(manhole_nodes)
+    node_manhole = np.full(node_count, -1, dtype=np.int32)
+    for label, node in enumerate(manhole_nodes.values()):
+        node_manhole[node] = label
+    building_ids = list(building_nodes)
+    building_nodes = [sorted(nodes) for nodes in building_nodes.values()]
+    node_building = np.full(node_count, -1, dtype=np.int32)
+    for label, nodes in enumerate(building_nodes):
+        node_building[nodes] = label
+
+    edges = np.unique(np.array([sources, targets], dtype=np.int64).reshape(2, -1), axis=1)
+    down_ptr, down_idx = _to_csr(edges[0], edges[1], node_count)
+    up_ptr, up_idx = _to_csr(edges[1], edges[0], node_count)
+    building_ptr = np.zeros(len(building_nodes) + 1, dtype=np.int64)
+    np.cumsum([len(nodes) for nodes in building_nodes], out=building_ptr[1:])
+    building_idx = np.array([node for nodes in building_nodes for node in nodes], dtype=np.int32)
+
+    arrays = {'coords': coords, 'down_ptr': down_ptr, 'down_idx': down_idx,
+              'up_ptr': up_ptr, 'up_idx': up_idx,
+              'node_manhole': node_manhole, 'node_building': node_building,
+              'manhole_nodes': np.array(list(manhole_nodes.values()), dtype=np.int32),
+              'building_ptr': building_ptr, 'building_idx': building_idx}
+    return SewerNetwork(arrays, manhole_ids, building_ids, fingerprints)
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_network(network, path):
+    """
+    write the network as one file: magic, version, json header, then the
+    raw arrays aligned so that they can be memory mapped
+    """
+    arrays = {name: np.ascontiguousarray(getattr(network, name))
+              for name in SewerNetwork.ARRAYS}
+    layout, offset = dict(), 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                        'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'version': ARTIFACT_VERSION, 'sources': network.sources,
+                         'arrays': layout, 'manhole_ids': network.manhole_ids,
+                         'building_ids': network.building_ids}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as artifact:
+        artifact.write(MAGIC)
+        artifact.write(np.array([ARTIFACT_VERSION, len(header)], dtype='<u4').tobytes())
+        artifact.write(header)
+        for name, array in arrays.items():
+            artifact.seek(data_start + layout[name]['offset'])
+            artifact.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_network(path):
+    """
+    memory map a network artifact, raise InvalidArtifactError if it can not be used
+    """
+    try:
+        with open(path, 'rb') as artifact:
+            magic = artifact.read(len(MAGIC))
+            version, header_len = np.frombuffer(artifact.read(8), dtype='<u4')
+            if magic != MAGIC or version != ARTIFACT_VERSION:
+                raise InvalidArtifactError
+            header = json.loads(artifact.read(int(header_len)).decode('utf-8'))
+    except (OSError, ValueError):
+        raise InvalidArtifactError
+    data_start = _aligned(len(MAGIC) + 8 + int(header_len))
+    arrays = dict()
+    for name in SewerNetwork.ARRAYS:
+        spec = header['arrays'][name]
+        shape = tuple(spec['shape'])
+        if 0 in shape:
+            arrays[name] = np.empty(shape, dtype=spec['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec['dtype'], mode='r',
+                                     offset=data_start + spec['offset'], shape=shape)
+    return SewerNetwork(arrays, header['manhole_ids'], header['building_ids'],
+                        header['sources'])
+
+
+def artifact_path(network_dir=NETWORK_DIR):
+    return os.environ.get('TRACE_NETWORK_ARTIFACT', os.path.join(network_dir, ARTIFACT_NAME))
+
+
+def geo_available():
+    """
+    whether the shapefiles can be compiled here, the runtime images only have the artifact
+    """
+    try:
+        import geopandas
+    except ImportError:
+        return False
+    return True
+
+
+def load_network(network_dir=NETWORK_DIR, path=None):
+    """
+    load the precompiled network, recompile it if it is missing, of another
+    version or the shapefiles changed since it was compiled
+
+    without geopandas (runtime image) a stale artifact is used as it is, a
+    missing or unusable one raises MissingBuildDependencyError
+    """
+    path = path or artifact_path(network_dir)
+    stale = None
+    try:
+        network = read_network(path)
+        # without shapefiles (runtime image) the artifact is the source of truth
+        if not shapefile_paths(network_dir) or sources_match(network.sources, network_dir):
+            return network
+        print("shapefiles changed since the network artifact was compiled")
+        stale = network
+    except InvalidArtifactError:
+        print("network artifact not usable, compiling from shapefiles")
+    if not geo_available():
+        if stale is not None:
+            print("geopandas is not installed, using the network artifact compiled from older shapefiles")
+            return stale
+        raise MissingBuildDependencyError(
+            "no usable network artifact at %s and geopandas is not installed, "
+            "compile it with python3 network_artifact.py in the build image" % path)
+    network = compile_network(network_dir)
+    try:
+        save_network(network, path)
+        return read_network(path)
+    except OSError as error:
+        # read-only file system, keep the compiled network in memory
+        print(error)
+        return network
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    network_dir = targets[1] if len(targets) > 1 else NETWORK_DIR
+    network = compile_network(network_dir)
+    save_network(network, artifact_path(network_dir))
+    print("compiled %d nodes, %d edges, %d manholes, %d buildings into %s" % (
+        network.node_count, network.edge_count, len(network.manhole_ids),
+        len(network.building_ids), artifact_path(network_dir)))
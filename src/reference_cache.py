@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+
+
+# the manhole to CAAN and residential tables change about once a quarter
+CACHE_DIR = os.environ.get('TRACE_REFERENCE_CACHE', os.path.join('/tmp', 'trace_reference'))
+TTL = float(os.environ.get('TRACE_REFERENCE_TTL', 24 * 3600))
+
+
+class ReferenceCache:
+    """
+    process level and on-disk cache of reference tables, entries expire after ttl seconds
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.entries = dict()
+        # one lock per name so that different tables can be fetched concurrently
+        self.lock = threading.Lock()
+        self.name_locks = defaultdict(threading.Lock)
+
+    def getPath(self, name):
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def readDisk(self, name):
+        try:
+            with open(self.getPath(name)) as cache_file:
+                entry = json.load(cache_file)
+            return entry['fetched_at'], entry['value']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def writeDisk(self, name, fetched_at, value):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self.getPath(name) + '.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'fetched_at': fetched_at, 'value': value}, cache_file)
+            os.replace(tmp_path, self.getPath(name))
+        except (OSError, TypeError) as error:
+            print("reference cache not written:", error)
+
+    def isFresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def get(self, name, fetch):
+        """
+        return the cached value of name, calling fetch() when it is missing or expired,
+        the value has to be json serializable
+        """
+        with self.lock:
+            name_lock = self.name_locks[name]
+        with name_lock:
+            entry = self.entries.get(name)
+            if not self.isFresh(entry):
+                entry = self.readDisk(name)
+                if not self.isFresh(entry):
+                    entry = (time.time(), fetch())
+                    self.writeDisk(name, *entry)
+                self.entries[name] = entry
+            return entry[1]
+
+    def invalidate(self, name=None):
+        """
+        drop one entry, or all of them, from memory and disk
+        """
+        with self.lock:
+            names = [name] if name else list(self.entries) + [
+                file_name[:-len('.json')] for file_name in self.listDisk()]
+            for entry_name in set(names):
+                self.entries.pop(entry_name, None)
+                try:
+                    os.remove(self.getPath(entry_name))
+                except OSError:
+                    pass
+
+    def listDisk(self):
+        try:
+            return [file_name for file_name in os.listdir(self.cache_dir) if file_name.endswith('.json')]
+        except OSError:
+            return []
+
+
+reference_cache = ReferenceCache()
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    if len(targets) > 1 and targets[1] == "invalidate":
+        reference_cache.invalidate(targets[2] if len(targets) > 2 else None)
+        print("reference cache invalidated")
+    else:
+        print("usage: python reference_cache.py invalidate [name]")
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from traceGraph import TraceGraph
+from trace import Trace, InvalidDateError, autoPilotDropIn, autoPilotMatrix
+from service import get_service_password, run_collected, parse_day_window
+
+
+# the Kubernetes deployment (trace-deploy.yml) exposes 8080
+PORT = int(os.environ.get('TRACE_SERVER_PORT', 8080))
+# traces and layer updates running at the same time, the others wait in the queue
+WORKERS = int(os.environ.get('TRACE_SERVER_WORKERS', 4))
+WARM_RETRY_SECONDS = 30
+# largest request body read before the password is checked
+MAX_BODY_BYTES = int(os.environ.get('TRACE_SERVER_MAX_BODY', 1 << 20))
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+HEADERS = {
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
+}
+
+
+class StreamingBody:
+    """
+    response body written while its chunks are produced, the connection is closed at the end
+    """
+
+    def __init__(self, chunks, content_type='application/json'):
+        self.chunks = chunks
+        self.content_type = content_type
+
+
+def json_string_chunks(chunks):
+    """
+    encode text chunks as pieces of one JSON string, the same body as json.dumps of the whole text
+    """
+    yield '"'
+    for chunk in chunks:
+        yield json.dumps(chunk)[1:-1]
+    yield '"'
+
+
+class TraceServer:
+    """
+    long running HTTP front end of the service modes: the sewer graph and the
+    reference tables are loaded once and shared by the requests, the blocking
+    trace work runs in a thread pool
+
+    GET /healthz    the process is up
+    GET /readyz     the graph and reference tables are loaded
+    POST /          same body as the Lambda handler: password, date, mode, day_window,
+                    metrics, the drop mode streams its csv (or parquet with "format": "parquet"),
+                    the trace_matrix mode returns parquet with "format": "parquet"
+    """
+
+    def __init__(self, workers=WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.graph = None
+        self.ready = False
+        self.service_password = None
+
+    def warm(self):
+        """
+        load the network, its trace engine, its catchment table and the reference tables
+        """
+        graph = TraceGraph()
+        graph.getEngine()
+        graph.getCatchment()
+        Trace.get_residential_map()
+        Trace.get_manhole_caan_map()
+        self.service_password = get_service_password()
+        self.graph = graph
+        self.ready = True
+        print("trace server ready:", graph.network.node_count, "nodes")
+
+    async def warmUntilReady(self):
+        loop = asyncio.get_running_loop()
+        while not self.ready:
+            try:
+                await loop.run_in_executor(self.executor, self.warm)
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(WARM_RETRY_SECONDS)
+
+    async def runMode(self, body):
+        """
+        return (status code, payload) of a service request
+        """
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            return 400, {"message": "Invalid JSON body"}
+        if not isinstance(request, dict):
+            return 400, {"message": "Invalid JSON body"}
+        if request.get("password", "wrong") != self.service_password:
+            return 403, "Wrong Password"
+        loop = asyncio.get_running_loop()
+        if request.get("mode") == "drop":
+            export_format = request.get("format", "csv")
+            error_message, chunks = await loop.run_in_executor(
+                self.executor, autoPilotDropIn, request.get("date", None), export_format, self.graph)
+            if error_message:
+                return 400, {"message": error_message}
+            if export_format == "parquet":
+                return 200, StreamingBody(chunks, 'application/vnd.apache.parquet')
+            return 200, StreamingBody(json_string_chunks(chunks))
+        if request.get("mode") == "trace_matrix" and request.get("format") == "parquet":
+            day_window = parse_day_window(request.get("day_window"))
+            if day_window is None:
+                return 400, {"message": "Invalid day_window"}
+            error_message, parquet = await loop.run_in_executor(
+                self.executor, autoPilotMatrix, request.get("date", None),
+                day_window, "parquet", self.graph)
+            if error_message:
+                return 400, {"message": error_message}
+            return 200, StreamingBody(iter([parquet]), 'application/vnd.apache.parquet')
+        error_message, results = await loop.run_in_executor(
+            self.executor, run_collected, request.get("mode", "affected_buildings"),
+            request.get("date", None), request.get("day_window", 7), self.graph,
+            request.get("metrics", False))
+        if error_message:
+            return 400, {"message": error_message}
+        return 200, results
+
+    async def route(self, method, path, body):
+        path = path.split('?')[0]
+        if method == 'OPTIONS':
+            return 200, "checking..."
+        if method == 'GET' and path == '/healthz':
+            return 200, {"status": "ok"}
+        if method == 'GET' and path == '/readyz':
+            return (200, {"status": "ready"}) if self.ready else (503, {"status": "loading"})
+        if method == 'POST' and path in ('/', '/trace'):
+            if not self.ready:
+                return 503, {"message": "Service is loading the sewer network"}
+            try:
+                return await self.runMode(body)
+            except InvalidDateError:
+                return 400, {"message": "Invalid date, please choose a date that exists in the wastewater sheet"}
+            except Exception as error:
+                traceback.print_exc()
+                return 500, {"message": str(error)}
+        return 404, {"message": "not found"}
+
+    def responseHead(self, status_code, headers):
+        lines = ['HTTP/1.1 %d %s' % (status_code, REASONS.get(status_code, ''))]
+        lines += ['%s: %s' % header for header in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def response(self, status_code, payload, keep_alive):
+        body = payload if isinstance(payload, str) else json.dumps(payload)
+        body = body.encode('utf-8')
+        headers = dict(HEADERS, **{'Content-Length': str(len(body)),
+                                   'Connection': 'keep-alive' if keep_alive else 'close'})
+        return self.responseHead(status_code, headers) + body
+
+    async def writeStream(self, writer, status_code, stream):
+        """
+        write the chunks as the worker pool produces them, the end of the body is
+        marked by closing the connection
+        """
+        loop = asyncio.get_running_loop()
+        writer.write(self.responseHead(status_code, dict(
+            HEADERS, **{'Content-Type': stream.content_type, 'Connection': 'close'})))
+        while True:
+            try:
+                chunk = await loop.run_in_executor(self.executor, next, stream.chunks, None)
+            except Exception:
+                # the head is sent, the client sees a truncated body when the connection closes
+                traceback.print_exc()
+                break
+            if chunk is None:
+                break
+            writer.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            await writer.drain()
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                if content_length < 0:
+                    writer.write(self.response(400, {"message": "Invalid Content-Length"}, False))
+                    await writer.drain()
+                    break
+                if content_length > MAX_BODY_BYTES:
+                    # the body is not read, the connection is closed after the answer
+                    writer.write(self.response(413, {"message": "Request body too large"}, False))
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(content_length)
+                status_code, payload = await self.route(method, path, body)
+                if isinstance(payload, StreamingBody):
+                    await self.writeStream(writer, status_code, payload)
+                    break
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(self.response(status_code, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='0.0.0.0', port=PORT):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        print("trace server listening on %s:%d" % (host, port))
+        # liveness is answered while the network loads, readiness once it is loaded
+        warming = asyncio.ensure_future(self.warmUntilReady())
+        async with server:
+            await server.serve_forever()
+        warming.cancel()
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    asyncio.run(TraceServer().serve(port=int(targets[1]) if len(targets) > 1 else PORT))
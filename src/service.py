@@ -2,14 +2,146 @@ import json
 import os
 import sys
 import subprocess
+import importlib
 from env_setup import getPassword
-from trace import autoPilot, autoPilotManhole, traceStats
-from layer_update import updateBuilding
+import metrics
 import stat
-import dateutil.parser
 import datetime
 
 
+# mode to (modules, runner), the trace and ArcGIS modules (pandas, numpy, arcgis ...)
+# are only imported by the modes that use them, not for a preflight
+MODES = dict()
+
+
+def get_service_password():
+    try:
+        return os.environ['SERVICE_PASS']
+    except KeyError:
+        # path not yet set
+        getPassword()
+        return os.environ['SERVICE_PASS']
+
+
+def register_mode(name, *modules):
+    """
+    register run(input_date, input_day_window, graph) as the runner of a mode,
+    the modules it needs are imported when the mode is first run
+    """
+    def register(run):
+        MODES[name] = (modules, run)
+        return run
+    return register
+
+
+def load_mode(name):
+    """
+    import the modules of a mode, return its runner
+    """
+    modules, run = MODES[name]
+    for module in modules:
+        importlib.import_module(module)
+    return run
+
+
+def parse_day_window(input_day_window, default=7):
+    """
+    return the day window of a request as a positive int, the default when it is
+    not given, None when it is not a positive integer
+    """
+    if input_day_window is None or input_day_window == "":
+        return default
+    try:
+        day_window = int(input_day_window)
+    except (TypeError, ValueError):
+        return None
+    return day_window if day_window > 0 else None
+
+
+@register_mode("affected_buildings", "trace")
+def run_affected_buildings(input_date, input_day_window=None, graph=None):
+    from trace import autoPilot
+    return autoPilot(input_date, graph=graph)
+
+
+@register_mode("multi_update", "trace", "layer_update")
+def run_multi_update(input_date, input_day_window=None, graph=None):
+    from layer_update import updateBuilding, TraceContext
+    return updateBuilding(
+        input_date, trace_mode="multi", context=TraceContext(graph))
+
+
+@register_mode("historical", "trace", "layer_update")
+def run_historical(input_date, input_day_window=None, graph=None):
+    from layer_update import updateBuilding, TraceContext
+    return updateBuilding(
+        input_date, trace_mode="historical", context=TraceContext(graph, historical=True))
+
+
+@register_mode("update", "trace", "layer_update")
+def run_update(input_date, input_day_window=None, graph=None):
+    from layer_update import updateBuilding, TraceContext
+    return updateBuilding(input_date, context=TraceContext(graph))
+
+
+@register_mode("drop", "trace")
+def run_drop(input_date, input_day_window=None, graph=None):
+    from trace import autoPilot
+    return autoPilot(input_date, True, graph=graph)
+
+
+@register_mode("secondary_api", "trace")
+def run_secondary_api(input_date, input_day_window=None, graph=None):
+    from trace import autoPilotManhole
+    return autoPilotManhole(input_date, graph)
+
+
+@register_mode("trace_matrix", "trace")
+def run_trace_matrix(input_date, input_day_window=None, graph=None):
+    from trace import autoPilotMatrix
+    day_window = parse_day_window(input_day_window)
+    if day_window is None:
+        return "Invalid day_window", None
+    return autoPilotMatrix(input_date, day_window, graph=graph)
+
+
+@register_mode("sampler_coverage", "trace")
+def run_sampler_coverage(input_date, input_day_window=None, graph=None):
+    from trace import autoPilotSamplerCoverage
+    return autoPilotSamplerCoverage(input_date, graph)
+
+
+@register_mode("stats", "trace")
+def run_stats(input_date, input_day_window=None, graph=None):
+    from trace import traceStats
+    day_window = parse_day_window(input_day_window)
+    if day_window is None:
+        return "Invalid day_window", None
+    return traceStats(input_date, day_window, graph)
+
+
+def run_mode(input_mode, input_date, input_day_window=None, graph=None):
+    """
+    run one of the manual modes, return (error message, results),
+    traces use graph when it is given
+    """
+    if input_mode not in MODES:
+        return "Methods not supported", None
+    return load_mode(input_mode)(input_date, input_day_window, graph)
+
+
+def run_collected(input_mode, input_date, input_day_window=None, graph=None, return_metrics=False):
+    """
+    run_mode recording its stage timings and counters, logged as one JSON line,
+    with return_metrics the results are returned as {"results": ..., "metrics": ...}
+    """
+    with metrics.collect(input_mode) as collected:
+        error_message, results = run_mode(input_mode, input_date, input_day_window, graph)
+    if return_metrics and not error_message:
+        results = {"results": results, "metrics": collected.asDict()}
+    return error_message, results
+
+
 def handler(event, context):
     try:
         if event['httpMethod'] == 'OPTIONS':
@@ -28,54 +160,54 @@ def handler(event, context):
         try:
             # Cron job workflow, separate from manual ones
             if event["detail-type"] == "Scheduled Event":
-                # If it is a Cron job
-                current_date_obj_utc = dateutil.parser.parse(event["time"])
-                current_date_str = (
-                    current_date_obj_utc-datetime.timedelta(days=1)).strftime('%-m/%-d/%y')
-                current_date_obj_pst = dateutil.parser.parse(current_date_str)
-                print(current_date_str)
-                message, status_code = None, 200
-                # if it is Monday, updates Sunday as well(only need to do this for historical mode)
-                if current_date_obj_pst.weekday() == 0:
-                    sun_date_str = (
-                        current_date_obj_utc-datetime.timedelta(days=2)).strftime('%-m/%-d/%y')
-                    error_message_sun, results = updateBuilding(
-                        sun_date_str, trace_mode="historical")
-                    print(results)
-                    print("sunday string", sun_date_str,
-                          " sunday error message ", error_message_sun)
-                    if error_message_sun:
-                        print(error_message_sun)
-                        message = error_message_sun
+                # If it is a Cron job, its stage timings and counters are logged as one JSON line
+                with metrics.collect("cron"):
+                    import dateutil.parser
+                    from layer_update import updateBuilding, TraceContext
+                    current_date_obj_utc = dateutil.parser.parse(event["time"])
+                    current_date_str = (
+                        current_date_obj_utc-datetime.timedelta(days=1)).strftime('%-m/%-d/%y')
+                    current_date_obj_pst = dateutil.parser.parse(current_date_str)
+                    print(current_date_str)
+                    message, status_code = None, 200
+                    # one ArcGIS session, one graph and one trace per date for all layer writes
+                    trace_context = TraceContext(historical=True)
+                    # if it is Monday, updates Sunday as well(only need to do this for historical mode)
+                    if current_date_obj_pst.weekday() == 0:
+                        sun_date_str = (
+                            current_date_obj_utc-datetime.timedelta(days=2)).strftime('%-m/%-d/%y')
+                        error_message_sun, results = updateBuilding(
+                            sun_date_str, trace_mode="historical", context=trace_context)
+                        metrics.payload(results)
+                        print("sunday string", sun_date_str,
+                              " sunday error message ", error_message_sun)
+                        if error_message_sun:
+                            print(error_message_sun)
+                            message = error_message_sun
+                            status_code = 400
+                    # update normal weekdays + Saturday
+                    error_message_multi, results = updateBuilding(
+                        current_date_str, trace_mode="multi", context=trace_context)
+                    error_message_historical, results = updateBuilding(
+                        current_date_str, trace_mode="historical", context=trace_context)
+                    if message is None and (error_message_multi or error_message_historical):
+                        message = error_message_multi or error_message_historical
+                        print(message, "inside, block")
                         status_code = 400
-                # update normal weekdays + Saturday
-                error_message_multi, results = updateBuilding(
-                    current_date_str, trace_mode="multi")
-                error_message_historical, results = updateBuilding(
-                    current_date_str, trace_mode="historical")
-                if message is None and (error_message_multi or error_message_historical):
-                    message = error_message_multi or error_message_historical
-                    print(message, "inside, block")
-                    status_code = 400
-                if message is None:
-                    message = json.dumps({"message": "Cron ran smoothly"})
-                return {
-                    "statusCode": status_code,
-                    "body": message,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                }
+                    if message is None:
+                        message = json.dumps({"message": "Cron ran smoothly"})
+                    return {
+                        "statusCode": status_code,
+                        "body": message,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                    }
         except:
             pass
 
-    try:
-        service_password = os.environ['SERVICE_PASS']
-    except KeyError:
-        # path not yet set
-        getPassword()
-        service_password = os.environ['SERVICE_PASS']
+    service_password = get_service_password()
     print(event)
     try:
         input_pass = json.loads(event["body"] or "{}").get("password", "wrong")
@@ -84,34 +216,20 @@ def handler(event, context):
             "mode", "affected_buildings")
         input_day_window = json.loads(event["body"] or "{}").get(
             "day_window", 7)
+        input_metrics = json.loads(event["body"] or "{}").get("metrics", False)
     except:
         input_pass = event["body"].get("password", "wrong")
         input_date = event["body"].get("date", None)
         input_mode = event["body"].get("mode", "affected_buildings")
         input_day_window = event["body"].get("day_window", None)
+        input_metrics = event["body"].get("metrics", False)
     if input_pass != service_password:
         message = "Wrong Password"
         status_code = 403
     else:
         message, status_code = "Place Holder", 200
-        if input_mode == "affected_buildings":
-            error_message, results = autoPilot(input_date)
-        elif input_mode == "multi_update":
-            error_message, results = updateBuilding(
-                input_date, trace_mode="multi")
-        elif input_mode == "historical":
-            error_message, results = updateBuilding(
-                input_date, trace_mode="historical")
-        elif input_mode == "update":
-            error_message, results = updateBuilding(input_date)
-        elif input_mode == "drop":
-            error_message, results = autoPilot(input_date, True)
-        elif input_mode == "secondary_api":
-            error_message, results = autoPilotManhole(input_date)
-        elif input_mode == "stats":
-            error_message, results = traceStats(input_date)
-        else:
-            error_message = "Methods not supported"
+        error_message, results = run_collected(
+            input_mode, input_date, input_day_window, return_metrics=input_metrics)
         if error_message:
             message = json.dumps({"message": error_message})
             status_code = 400
@@ -127,3 +245,46 @@ def handler(event, context):
             'Access-Control-Allow-Origin': '*'
         },
     }
+
+
+# imports timed in a fresh interpreter: the handler module, then the modules of a mode
+IMPORT_COST_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import service
+handler_s, handler_modules = time.perf_counter() - start, len(sys.modules)
+start = time.perf_counter()
+if len(sys.argv) > 1:
+    service.load_mode(sys.argv[1])
+print(json.dumps({'handler_s': handler_s, 'mode_s': time.perf_counter() - start,
+                  'modules': len(sys.modules) - handler_modules}))
+"""
+
+
+def import_cost(mode=None):
+    """
+    return the seconds to import the handler and then the modules of a mode (none for
+    a preflight), and the number of modules the mode adds, in a fresh interpreter
+    """
+    process = subprocess.run([sys.executable, "-c", IMPORT_COST_CODE] + ([mode] if mode else []),
+                             capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    if process.returncode != 0:
+        return {'error': (process.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def import_report():
+    """
+    return the import cost of a preflight and of every mode
+    """
+    return [dict(mode=mode or "OPTIONS", **import_cost(mode)) for mode in [None] + list(MODES)]
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    if len(targets) > 1 and targets[1] == "import-report":
+        for cost in import_report():
+            print(json.dumps(cost))
+    else:
+        print("usage: python service.py import-report")
@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+import pandas as pd
+import backend_client
+import metrics
+
+
+SPREADSHEET_KEY = '1mKOeKWf8f_mUmxbDQeHMA-P6lk6SfZf4Q9CRBH44EHU'
+# the third row holds the column names, the values start on the fourth
+HEADER_ROW = 3
+# seconds between two checks of the spreadsheet revision
+CHECK_SECONDS = float(os.environ.get('TRACE_SHEET_CHECK_SECONDS', 60))
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/'
+
+
+def column_letter(col):
+    """
+    return the A1 letters of a 1-based column index
+    """
+    letters = ''
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+class SheetCache:
+    """
+    snapshot of the worksheet columns read so far, dropped when the revision
+    (last modification time) of the spreadsheet changes
+    """
+
+    def __init__(self, spreadsheet_key=SPREADSHEET_KEY, check_seconds=CHECK_SECONDS):
+        self.spreadsheet_key = spreadsheet_key
+        self.check_seconds = check_seconds
+        self.book = None
+        self.revision = None
+        self.checked_at = None
+        # tab name to {'header': column names, 'columns': column name to values}
+        self.snapshots = dict()
+        self.lock = threading.Lock()
+
+    def getBook(self):
+        if self.book is None:
+            self.book = backend_client.get_sheet_client().open_by_key(self.spreadsheet_key)
+        return self.book
+
+    def getRevision(self, book):
+        """
+        return the last modification time of the spreadsheet, asked from Drive on every
+        check (book.lastUpdateTime is only read when the book is opened), None if it
+        can not be read
+        """
+        try:
+            metrics.count('sheet_revision_requests')
+            if hasattr(book, 'get_lastUpdateTime'):
+                return book.get_lastUpdateTime()
+            # gspread before 6
+            response = book.client.request(
+                'get', DRIVE_FILES_URL + book.id, params={'fields': 'modifiedTime'})
+            return response.json()['modifiedTime']
+        except Exception as error:
+            print("sheet revision not available, snapshots expire after %d seconds:" % self.check_seconds, error)
+            return None
+
+    def refresh(self):
+        """
+        drop the snapshots if the spreadsheet changed, checked at most every check_seconds
+        """
+        now = time.time()
+        if self.checked_at is not None and now - self.checked_at < self.check_seconds:
+            return
+        revision = self.getRevision(self.getBook())
+        if revision is None or revision != self.revision:
+            self.snapshots = dict()
+        self.revision, self.checked_at = revision, now
+
+    def read(self, tab_name, columns=None):
+        """
+        return a frame of the given columns (all of them by default) of a worksheet,
+        only the columns missing from the snapshot are downloaded
+        """
+        with self.lock, metrics.timer('sheet_read'):
+            self.refresh()
+            book = self.getBook()
+            snapshot = self.snapshots.get(tab_name)
+            if snapshot is None:
+                header = book.worksheet(tab_name).row_values(HEADER_ROW)
+                metrics.count('sheet_requests')
+                snapshot = self.snapshots[tab_name] = {'header': header, 'columns': dict()}
+            header = snapshot['header']
+            names = list(dict.fromkeys(header if columns is None else columns))
+            if any(name not in header for name in names):
+                # a column added since the last revision check, the header row is read again
+                header = book.worksheet(tab_name).row_values(HEADER_ROW)
+                metrics.count('sheet_requests')
+                if header != snapshot['header']:
+                    snapshot = self.snapshots[tab_name] = {'header': header, 'columns': dict()}
+            missing = [name for name in names if name not in snapshot['columns']]
+            for name in missing:
+                if name not in header:
+                    raise KeyError(name)
+            if missing:
+                ranges = []
+                for name in missing:
+                    letter = column_letter(header.index(name) + 1)
+                    ranges.append("'%s'!%s%d:%s" % (tab_name, letter, HEADER_ROW + 1, letter))
+                response = book.values_batch_get(ranges, params={'majorDimension': 'COLUMNS'})
+                metrics.count('sheet_requests')
+                for name, value_range in zip(missing, response['valueRanges']):
+                    values = value_range.get('values') or [[]]
+                    snapshot['columns'][name] = values[0]
+                    metrics.count('sheet_cells', len(values[0]))
+            # trailing empty cells are not returned
+            length = max([len(snapshot['columns'][name]) for name in names] + [0])
+            return pd.DataFrame({name: snapshot['columns'][name] + [''] * (length - len(snapshot['columns'][name]))
+                                 for name in names}, columns=names)
+
+    def invalidate(self):
+        with self.lock:
+            self.snapshots = dict()
+            self.checked_at = None
+
+
+sheet_cache = SheetCache()
@@ -0,0 +1,40 @@
+import sys
+import random
+from network_artifact import build_network, save_network
+
+
+def generate_network(node_count, seed=0, chain_ratio=0.98, manhole_every=8, outlets=1):
+    """
+    return a random sewer network of node_count pipe vertices draining
+    towards the outlets: mostly long pipe chains with occasional branches,
+    a manhole every few vertices and buildings on the upstream ends
+    """
+    rng = random.Random(seed)
+    node_coords = [(float(node), float(seed)) for node in range(node_count)]
+    sources, targets = [], []
+    has_upstream = [False] * node_count
+    for node in range(outlets, node_count):
+        downstream = node - 1 if rng.random() < chain_ratio else rng.randrange(node)
+        sources.append(node)
+        targets.append(downstream)
+        has_upstream[downstream] = True
+    manhole_nodes = {'S%07d' % node: node for node in range(0, node_count, manhole_every)}
+    building_nodes = dict()
+    for node in range(node_count):
+        if not has_upstream[node]:
+            # a few buildings drain through more than one lateral
+            building_id = 'B%07d' % (node // 2 if rng.random() < 0.2 else node)
+            building_nodes.setdefault(building_id, set()).add(node)
+    return build_network(node_coords, sources, targets, manhole_nodes, building_nodes)
+
+
+if __name__ == "__main__":
+    targets = sys.argv
+    if len(targets) < 3:
+        print("usage: python synthetic_network.py <node count> <artifact path> [seed]")
+    else:
+        network = generate_network(int(targets[1]),
+                                   int(targets[3]) if len(targets) > 3 else 0)
+        save_network(network, targets[2])
+        print("saved %d nodes, %d manholes, %d buildings to %s" % (
+            network.node_count, len(network.manhole_ids), len(network.building_ids), targets[2]))
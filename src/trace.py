@@ -1,9 +1,13 @@
 import pandas as pd
-import gspread
 from traceGraph import TraceGraph
-from oauth2client.service_account import ServiceAccountCredentials
+from cq_store import read_cqs
+from reference_cache import reference_cache
+import backend_client
+import metrics
+from sheet_cache import sheet_cache
 from pandas.io.json import json_normalize
 import requests
+import io
 import json
 from datetime import datetime, timedelta, date
 import numpy as np
@@ -11,6 +15,28 @@ import sys
 import os
 
 
+# point TRACE_QUERY_URL to a local fake_graphql.py server to test without the database
+QUERY_URL = os.environ.get('TRACE_QUERY_URL', 'http://35.202.222.136:8080/query')
+
+# bit of every mode in the masks returned by Trace.get_mode_masks
+MODE_BITS = {"detection": 1, "monitoring": 2,
+             "sampling": 4, "paused monitoring": 8}
+MONITORED_MODES = ["detection", "monitoring", "sampling"]
+STATUS_TYPES = ["Not Currently Monitored", "Currently Monitored + Not Sampled",
+                "Currently Monitored + Sampled + Not Detected", "Currently Monitored + Sampled + Detected"]
+# rows per chunk of the streamed drop-in csv
+DROP_IN_CHUNK_ROWS = 1000
+# longest date range of a trace matrix
+MAX_MATRIX_DAYS = 366
+
+
+def count_modes(mask):
+    """
+    number of monitored modes (detection, monitoring, sampling) set in a mode mask
+    """
+    return sum(1 for mode in MONITORED_MODES if mask & MODE_BITS[mode])
+
+
 class TraceError(Exception):
     """Base class for other exceptions"""
     pass
@@ -22,123 +48,266 @@ class InvalidDateError(TraceError):
 
 
 class Trace:
-    def __init__(self, date_value):
-        self.read_db(date_value)
-        self.mh_graph = TraceGraph()
-        self.residential_map = self.get_residential_map()
-        self.manhole_caan_mapping = self.get_manhole_caan_map()
+    def __init__(self, date_value, graph=None, start_value=None):
+        # the Cq data (of every date from start_value if given), the network and
+        # the reference tables are loaded at the same time
+        _, self.mh_graph, self.residential_map, self.manhole_caan_mapping = backend_client.run_concurrently(
+            metrics.timed('cq_read', lambda: self.read_db(date_value, start_value)),
+            # a long running server passes its warm graph, the traces do not modify it
+            lambda: graph if graph is not None else TraceGraph(),
+            metrics.timed('residential_map', self.get_residential_map),
+            metrics.timed('manhole_caan_map', self.get_manhole_caan_map))
         self.manhole_residential_map = {manhole:sum(self.residential_map[caan] for caan in caans) > 0 for manhole, caans in self.manhole_caan_mapping.items()}
+        self.sampler_table = None
     
-    def get_manhole_caan_map(self):
-        ip = 'http://35.202.222.136:8080/query'
-        data_string = '{"query": "query getManholeCaanMappings {getManholeCaanMappings { manholeID internalCaan }}"}'
-        r = requests.post(ip, data=data_string, headers={"Content-Type":"application/json"})
-        r_json = r.json()
-        manhole_map = {elem['manholeID']:set(elem['internalCaan']) for elem in r_json['data']['getManholeCaanMappings']}
+    @staticmethod
+    def fetch_reference(query_name, fields):
+        """
+        return the records of a reference table query from the GraphQL endpoint
+        """
+        ip = QUERY_URL
+        data_string = '{"query": "query %s {%s { %s }}"}' % (query_name, query_name, fields)
+        with metrics.timer('graphql_' + query_name):
+            r = backend_client.post(ip, data=data_string, headers={"Content-Type":"application/json"})
+            r_json = r.json()
+        return r_json['data'][query_name]
+
+    @staticmethod
+    def get_manhole_caan_map():
+        # cached for TRACE_REFERENCE_TTL seconds in the process and on disk
+        records = reference_cache.get('getManholeCaanMappings', lambda: Trace.fetch_reference(
+            'getManholeCaanMappings', 'manholeID internalCaan'))
+        manhole_map = {elem['manholeID']:set(elem['internalCaan']) for elem in records}
         return manhole_map
 
-    def get_residential_map(self):
-        ip = 'http://35.202.222.136:8080/query'
-        data_string = '{"query": "query getBuildingInfo {getBuildingInfo { internalCaan isResidential }}"}'
-        r = requests.post(ip, data=data_string, headers={"Content-Type":"application/json"})
-        r_json = r.json()
-        return {elem['internalCaan']:elem['isResidential'] for elem in r_json['data']['getBuildingInfo']}
-
-    def read_sheet(self, tab_name="Results_for_test"):
-        """
-        return a panda dataframe of the newest spread sheet
-        """
-        scope = ['https://spreadsheets.google.com/feeds']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            '../.env/google_credentials.json', scope)
-        gc = gspread.authorize(credentials)
-        spreadsheet_key = '1mKOeKWf8f_mUmxbDQeHMA-P6lk6SfZf4Q9CRBH44EHU'
-        book = gc.open_by_key(spreadsheet_key)
-        worksheet = book.worksheet(tab_name)
-        table = worksheet.get_all_values()
-        return pd.DataFrame(table[3:], columns=table[2])
+    @staticmethod
+    def get_residential_map():
+        records = reference_cache.get('getBuildingInfo', lambda: Trace.fetch_reference(
+            'getBuildingInfo', 'internalCaan isResidential'))
+        return {elem['internalCaan']:elem['isResidential'] for elem in records}
+
+    def read_sheet(self, tab_name="Results_for_test", columns=None):
+        """
+        return a panda dataframe of the newest spread sheet, only with the given columns
+        if any, downloaded again only when the spread sheet changed
+        """
+        return sheet_cache.read(tab_name, columns)
     
-    def read_db(self, date_value):
-        ip = 'http://35.202.222.136:8080/query'
-        date_formatted = datetime.strptime(date_value, "%m/%d/%y").isoformat() + "Z"
-        data_string = '{"query": "query getQpcrCqs($startDate: Time!, $endDate: Time!) { getQpcrCqs(startDate: $startDate, endDate: $endDate) { date manholeID samplerID cqValue } }", "variables": {"startDate": "' + date_formatted + '", "endDate": "' + date_formatted + '"}}'
+    @staticmethod
+    def fetch_cqs(start_date, end_date):
+        """
+        return the Cq records from start_date to end_date from the GraphQL endpoint
+        """
+        ip = QUERY_URL
+        start_formatted = datetime.combine(start_date, datetime.min.time()).isoformat() + "Z"
+        end_formatted = datetime.combine(end_date, datetime.min.time()).isoformat() + "Z"
+        data_string = '{"query": "query getQpcrCqs($startDate: Time!, $endDate: Time!) { getQpcrCqs(startDate: $startDate, endDate: $endDate) { date manholeID samplerID cqValue } }", "variables": {"startDate": "' + start_formatted + '", "endDate": "' + end_formatted + '"}}'
         # Exception will be thrown if the request failed
-        r = requests.post(ip, data=data_string, headers={"Content-Type":"application/json"})
-        r.raise_for_status()
-        r_json = r.json()
-        r_json = r_json['data']['getQpcrCqs']
+        with metrics.timer('graphql_getQpcrCqs'):
+            r = backend_client.post(ip, data=data_string, headers={"Content-Type":"application/json"})
+            r.raise_for_status()
+            r_json = r.json()
+        metrics.count('cq_records_fetched', len(r_json['data']['getQpcrCqs']))
+        return r_json['data']['getQpcrCqs']
+
+    def query_cqs(self, start_value, end_value):
+        """
+        return a frame of (date, manholeID, samplerID, cqValue) for every date
+        from start_value to end_value, dates formatted as m/d/y,
+        throw an InvalidDateError if there is no data in the range
+
+        past dates are read from the local Cq store, only missing or recent ones are fetched
+        """
+        start_date = datetime.strptime(start_value, "%m/%d/%y").date()
+        end_date = datetime.strptime(end_value, "%m/%d/%y").date()
+        r_json = read_cqs(start_date, end_date, self.fetch_cqs)
         db_df = pd.DataFrame.from_dict(r_json)
         try:
-            dates = db_df['date'].unique()
+            db_df['date'] = [datetime.fromisoformat(i.replace("Z", "+00:00")).strftime("%-m/%-d/%y") for i in db_df['date']]
         except KeyError:
             raise InvalidDateError
+        return db_df
+
+    def read_db(self, date_value, start_value=None):
+        """
+        read the Cq values of a date, or of every date from start_value to
+        date_value, into a frame with one column per date
+        """
+        db_df = self.query_cqs(start_value or date_value, date_value)
+        self.db_df = db_df
+        self.df = self.pivot_dates(db_df)
+
+    @staticmethod
+    def pivot_dates(db_df):
+        """
+        return a frame of ManholeID and one Cq column per date of a frame from query_cqs,
+        0 where a manhole was not sampled on a date
+        """
         df = pd.pivot_table(db_df,index=['manholeID'], columns='date',values='cqValue', fill_value=0)
-        df.columns = [datetime.fromisoformat(i.replace("Z", "+00:00")).strftime("%-m/%-d/%y") for i in df.columns]
+        df.columns = list(df.columns)
         df = df.reset_index()
         df.rename(columns = {"manholeID": "ManholeID"}, inplace=True)
-        
-        self.df = df
+        return df
 
+    def get_sampler_table(self):
+        """
+        return a frame indexed by manhole (sampler) id: residential from manhole_residential_map,
+        upstream_buildings and residential_buildings counted from the catchment table
+        """
+        if self.sampler_table is None:
+            network = self.mh_graph.network
+            counts, residential = self.mh_graph.getCatchment().samplerCounts(self.residential_map)
+            catchments = pd.DataFrame({'upstream_buildings': counts, 'residential_buildings': residential},
+                                      index=pd.Index(network.manhole_ids, name='ManholeID'))
+            flags = pd.Series(self.manhole_residential_map, name='residential', dtype=bool)
+            table = catchments.join(flags, how='outer')
+            table['residential'] = table['residential'].fillna(False).astype(bool)
+            table[['upstream_buildings', 'residential_buildings']] = table[
+                ['upstream_buildings', 'residential_buildings']].fillna(0).astype(np.int64)
+            table.index.name = 'ManholeID'
+            self.sampler_table = table
+        return self.sampler_table
+
+    @metrics.timed('sampler_coverage')
+    def getSamplerCoverage(self, date_value):
+        """
+        return a record per sampler of a date: its residential flag, upstream and
+        residential upstream building counts (see get_sampler_table) and whether
+        it was sampled and positive on the date
+        """
+        try:
+            manhole_ids, status = self.get_manhole_status(date_value)
+        except InvalidDateError:
+            return "Invalid date, please choose a date that exists in the wastewater sheet", []
+        table = self.get_sampler_table().reindex(manhole_ids)
+        result = []
+        for manhole_id, residential, upstream, residential_upstream, sampled, positive in zip(
+                manhole_ids.tolist(), table['residential'].fillna(False).tolist(),
+                table['upstream_buildings'].fillna(0).tolist(),
+                table['residential_buildings'].fillna(0).tolist(),
+                status["sampling"].tolist(), status["detection"].tolist()):
+            result.append({'MANHOLE_ID': manhole_id, 'RESIDENTIAL': bool(residential),
+                           'UPSTREAM_BUILDINGS': int(upstream),
+                           'RESIDENTIAL_UPSTREAM_BUILDINGS': int(residential_upstream),
+                           'SAMPLED': sampled == 1, 'POSITIVE': positive == 1})
+        metrics.payload(result)
+        return None, result
+
+    def get_daily_counts(self, db_df):
+        """
+        return the positivity counts of every date in a frame from query_cqs,
+        one row per date, most recent date first
+        """
+        cqs = pd.to_numeric(db_df['cqValue'], errors='coerce').fillna(0)
+        # manholes x dates, NaN where a manhole was not sampled that day
+        day_df = cqs.groupby([db_df['manholeID'], db_df['date']]).mean().unstack()
+        sampled = day_df.notna().to_numpy()
+        positive = (day_df > 0).to_numpy()
+        residential = day_df.index.map(self.manhole_residential_map).to_series().fillna(
+            False).astype(bool).to_numpy()[:, None]
+        counts = pd.DataFrame({
+            'total_cnt': sampled.sum(axis=0),
+            'total_pos_cnt': positive.sum(axis=0),
+            'r_total_cnt': (sampled & residential).sum(axis=0),
+            'nr_total_cnt': (sampled & ~residential).sum(axis=0),
+            'r_pos_cnt': (positive & residential).sum(axis=0),
+            'nr_pos_cnt': (positive & ~residential).sum(axis=0)},
+            index=pd.to_datetime(day_df.columns, format="%m/%d/%y"))
+        return counts.sort_index(ascending=False)
+
+    @metrics.timed('positivity_counts')
     def getPositivityCounts(self, day):
         try:
-            self.read_db(day)
+            daily_counts = self.get_daily_counts(self.query_cqs(day, day))
         except requests.exceptions.RequestException:
             return "failed to read from DB", {}
         except InvalidDateError:
             return "invalid date", {"r_total_cnt": 0, "nr_total_cnt":0, "r_pos_cnt":0, "nr_pos_cnt":0, "total_cnt":0, "total_pos_cnt":0}
+        return None, {key: int(value) for key, value in daily_counts.iloc[0].items()}
 
-        mh_map = self.get_manhole_map(day)
-        total_cnt = len(mh_map)
-        total_pos_cnt = sum([mh_map[val] > 0 for val in mh_map])
-        r_total_cnt = sum([self.manhole_residential_map[val] for val in mh_map])
-        nr_total_cnt = sum([not self.manhole_residential_map[val] for val in mh_map])
-        r_pos_cnt = sum([(mh_map[val] > 0) and (self.manhole_residential_map[val]) for val in mh_map])
-        nr_pos_cnt = sum([(mh_map[val] > 0) and (not self.manhole_residential_map[val]) for val in mh_map])
-        return None, {"r_total_cnt": r_total_cnt, "nr_total_cnt":nr_total_cnt, "r_pos_cnt":r_pos_cnt, "nr_pos_cnt":nr_pos_cnt, "total_cnt":total_cnt, "total_pos_cnt":total_pos_cnt}
-
-    def getMovingAverage(self, day):
+    @metrics.timed('moving_average')
+    def getMovingAverage(self, day, day_window=7, max_lookback=366):
+        """
+        positivity rates of the most recent day with data and averaged over the last
+        day_window days with data, fetched in as few range queries as possible
+        """
         result = {
-        "7-day total positivity rate avg": -1, 
-        "7-day residential positivity rate avg": -1, 
-        "7-day non-residential positivity rate avg": -1,
+        "%d-day total positivity rate avg" % day_window: -1,
+        "%d-day residential positivity rate avg" % day_window: -1,
+        "%d-day non-residential positivity rate avg" % day_window: -1,
         "total positivity rate": -1, 
         "residential positivity rate": -1, 
         "non-residential positivity rate": -1}
-        
-        #Calculate 7 day averages.
-        cnts = []
-        start_date = datetime.strptime(day, "%m/%d/%y")
-        counter = 0
-        success_counter = 0
-        while success_counter < 7 :
-            current_date = start_date - timedelta(days=counter)
-            current_day_string = current_date.strftime("%-m/%-d/%y")
-            error_message, current_day_stats = self.getPositivityCounts(current_day_string)
-            counter += 1
-            if error_message:
-                if error_message == "invalid date":
-                    continue
-                else:
-                    return error_message, result
-            cnts.append(current_day_stats)
-            success_counter += 1
-        
-        result["non-residential positivity rate"] = '{:.2f}%'.format((cnts[0]["nr_pos_cnt"]/cnts[0]["nr_total_cnt"])*100) if cnts[0]["nr_total_cnt"] > 0 else "N/A"
-        result["residential positivity rate"] = '{:.2f}%'.format((cnts[0]["r_pos_cnt"]/cnts[0]["r_total_cnt"])*100) if cnts[0]["r_total_cnt"] > 0 else "N/A"
-        result["total positivity rate"] = '{:.2f}%'.format((cnts[0]["total_pos_cnt"]/cnts[0]["total_cnt"])*100) if cnts[0]["total_cnt"] > 0 else "N/A"
-        
-        
-        total_pos_case_7 = sum([cnt["total_pos_cnt"] for cnt in cnts])
-        total_r_pos_case_7 = sum([cnt["r_pos_cnt"] for cnt in cnts])
-        total_nr_pos_case_7 = sum([cnt["nr_pos_cnt"] for cnt in cnts])
-        total_case_7 = sum([cnt["total_cnt"] for cnt in cnts])
-        total_r_case_7 = sum([cnt["r_total_cnt"] for cnt in cnts])
-        total_nr_case_7 = sum([cnt["nr_total_cnt"] for cnt in cnts])
-        result["7-day non-residential positivity rate avg"] = '{:.2f}%'.format((total_nr_pos_case_7/total_nr_case_7)*100) if total_nr_case_7 > 0 else "N/A"
-        result["7-day residential positivity rate avg"] = '{:.2f}%'.format((total_r_pos_case_7/total_r_case_7)*100) if total_r_case_7 > 0 else "N/A"
-        result["7-day total positivity rate avg"] = '{:.2f}%'.format((total_pos_case_7/total_case_7)*100) if total_case_7 > 0 else "N/A"
+
+        # days without samples are skipped, widen the range until it has day_window days
+        end_date = datetime.strptime(day, "%m/%d/%y")
+        fetch_days = 2 * day_window
+        while True:
+            start_date = end_date - timedelta(days=fetch_days - 1)
+            try:
+                daily_counts = self.get_daily_counts(self.query_cqs(
+                    start_date.strftime("%-m/%-d/%y"), day))
+            except requests.exceptions.RequestException:
+                return "failed to read from DB", result
+            except InvalidDateError:
+                daily_counts = pd.DataFrame()
+            if len(daily_counts) >= day_window or fetch_days >= max_lookback:
+                break
+            fetch_days = min(2 * fetch_days, max_lookback)
+        if daily_counts.empty:
+            return "invalid date", result
+        cnts = daily_counts.iloc[:day_window]
+        latest = cnts.iloc[0]
+        totals = cnts.sum()
+
+        result["non-residential positivity rate"] = '{:.2f}%'.format((latest["nr_pos_cnt"]/latest["nr_total_cnt"])*100) if latest["nr_total_cnt"] > 0 else "N/A"
+        result["residential positivity rate"] = '{:.2f}%'.format((latest["r_pos_cnt"]/latest["r_total_cnt"])*100) if latest["r_total_cnt"] > 0 else "N/A"
+        result["total positivity rate"] = '{:.2f}%'.format((latest["total_pos_cnt"]/latest["total_cnt"])*100) if latest["total_cnt"] > 0 else "N/A"
+
+        result["%d-day non-residential positivity rate avg" % day_window] = '{:.2f}%'.format((totals["nr_pos_cnt"]/totals["nr_total_cnt"])*100) if totals["nr_total_cnt"] > 0 else "N/A"
+        result["%d-day residential positivity rate avg" % day_window] = '{:.2f}%'.format((totals["r_pos_cnt"]/totals["r_total_cnt"])*100) if totals["r_total_cnt"] > 0 else "N/A"
+        result["%d-day total positivity rate avg" % day_window] = '{:.2f}%'.format((totals["total_pos_cnt"]/totals["total_cnt"])*100) if totals["total_cnt"] > 0 else "N/A"
         return None, result
 
+    def get_manhole_status(self, date_value, df=None):
+        """
+        classify every manhole of a date for the three modes at once,
+        return the manhole ids and a map of mode to an int8 array of
+        1 (positive), -1 (negative barrier) or 0 (empty),
+        throw an InvalidDateError if the date is invalid,
+        df is the frame of read_db by default
+        """
+        try:
+            day_data = (self.df if df is None else df)[[date_value, "ManholeID"]]
+        except:
+            raise InvalidDateError
+        values = day_data[date_value]
+        cqs = pd.to_numeric(values, errors='coerce')
+        if pd.api.types.is_numeric_dtype(values):
+            empty = np.zeros(len(values), dtype=bool)
+        else:
+            empty = cqs.isna().to_numpy()
+            # float() also reads texts to_numeric does not, such as 'nan', only the
+            # cells it fails on are empty
+            for row in np.flatnonzero(empty):
+                try:
+                    cqs.iloc[row] = float(values.iloc[row])
+                    empty[row] = False
+                except (TypeError, ValueError):
+                    pass
+        # if the current sheet doesn't contain the data, raise error
+        if empty.all():
+            raise InvalidDateError
+        positive = (cqs > 0).to_numpy()
+        status = {
+            # negative samplers are barriers in detection mode
+            "detection": np.where(empty, 0, np.where(positive, 1, -1)).astype(np.int8),
+            # if monitoring mode => treat all samplers as positive
+            "monitoring": np.ones(len(values), dtype=np.int8),
+            # if sampling mode => treat sampled samplers as positive
+            "sampling": np.where(empty, 0, 1).astype(np.int8)}
+        return day_data["ManholeID"].to_numpy(), status
+
     def get_manhole_map(self, date_value, mode="detection"):
         """
         get a map of manholes to whether they are positive given a particular date,
@@ -147,29 +316,9 @@ class Trace:
         three modes:
         detection, monitoring, sampling
         """
-        day_map = {}
-        try:
-            day_data = self.df[[date_value, "ManholeID"]]
-        except:
-            raise InvalidDateError
-        empty_count = 0
-        for _, row in day_data.iterrows():
-            try:
-                # if sampler/monitor mode, then treat samplers as positive if they are negative
-                sm_tag = -1 if mode == "detection" else 1
-                day_map[row["ManholeID"]] = int(
-                    float(row[date_value]) > 0) or sm_tag
-            except:
-                empty_count += 1
-                # if monitoring or sampling mode => treat all samplers as positive
-                if mode == "monitoring":
-                    day_map[row["ManholeID"]] = 1
-                else:
-                    day_map[row["ManholeID"]] = 0
-        # if the current sheet doesn't contain the data, raise error
-        if empty_count == len(day_data):
-            raise InvalidDateError
-        return day_map
+        manhole_ids, status = self.get_manhole_status(date_value)
+        # any other mode treats samplers like the sampling mode
+        return dict(zip(manhole_ids.tolist(), status.get(mode, status["sampling"]).tolist()))
 
     def get_positive_manholes(self, date_value, mode="detection"):
         """
@@ -202,6 +351,7 @@ class Trace:
         paused_manholes_in_float = []
         return set(paused_manholes_in_float)
 
+    @metrics.timed('affected_buildings')
     def get_affected_buildings(self, date_value, mode="detection"):
         """
         get a list of affected buildings
@@ -219,19 +369,14 @@ class Trace:
         error_message, barriers = self.get_negative_barriers(date_value, mode)
         if error_message:
             return error_message, affected_buildings
-        print("barriers, ", barriers)
-        self.mh_graph.barriers = barriers
+        metrics.payload("barriers, ", barriers)
         if mode != "paused monitoring":
-            self.mh_graph.barriers = self.mh_graph.barriers.union(
-                self.get_paused_manholes())
-        self.mh_graph.buildGraph()
-        for mh_case in pos_mh_list:
-            try:
-                affected_buildings += list(self.mh_graph.trace_graph[mh_case])
-            except KeyError:
-                pass
-        return error_message, list(set(affected_buildings))
+            barriers = barriers.union(self.get_paused_manholes())
+        affected_buildings = self.mh_graph.traceFrom(
+            pos_mh_list, "upstream", "build", barriers)
+        return error_message, list(affected_buildings)
 
+    @metrics.timed('affected_manholes')
     def get_affected_manholes(self, date_value, mode="detection"):
         """
         get a list of affected manholes
@@ -245,25 +390,116 @@ class Trace:
         error_message, barriers = self.get_negative_barriers(date_value, mode)
         if error_message:
             return error_message, affected_manholes
-        self.mh_graph.barriers = barriers.union(self.get_paused_manholes())
-        self.mh_graph.buildGraph()
-        for mh_case in pos_mh_list:
+        barriers = barriers.union(self.get_paused_manholes())
+        affected_manholes = self.mh_graph.traceFrom(
+            pos_mh_list, "downstream", "manhole", barriers)
+        return error_message, list(affected_manholes.union(pos_mh_list))
+
+    @metrics.timed('mode_masks')
+    def get_mode_masks(self, date_value, direction="upstream", df=None):
+        """
+        trace all modes (detection, monitoring, sampling, paused monitoring) in one pass
+        return a map of affected building (upstream) or manhole (downstream) to the
+        bitmask of MODE_BITS affecting it, and an error message if any
+        """
+        paused = self.get_paused_manholes()
+        origins, barriers = [], []
+        try:
+            manhole_ids, status = self.get_manhole_status(date_value, df)
+            for mode in MONITORED_MODES:
+                origins.append(manhole_ids[status[mode] > 0].tolist())
+                barriers.append(
+                    set(manhole_ids[status[mode] < 0].tolist()).union(paused))
+        except InvalidDateError:
+            return "Invalid date, please choose a date that exists in the wastewater sheet", {}
+        if direction == "upstream":
+            origins.append(paused)
+            barriers.append(set())
+            return None, self.mh_graph.traceModes(origins, barriers, "upstream", "build")
+        masks = self.mh_graph.traceModes(
+            origins, barriers, "downstream", "manhole")
+        # positive manholes are affected themselves
+        for mode, mode_origins in zip(MONITORED_MODES, origins):
+            for manhole_id in mode_origins:
+                masks[manhole_id] |= MODE_BITS[mode]
+        return None, masks
+
+    @metrics.timed('mode_matrix')
+    def get_mode_matrix(self, dates):
+        """
+        trace every date of the Cq data read by read_db, the network index is reused,
+        return the building ids, a (buildings, dates) uint8 array of the MODE_BITS
+        affecting every building on every date and the dates without data
+        """
+        building_ids = list(self.mh_graph.network.building_ids)
+        positions = {building_id: idx for idx, building_id in enumerate(building_ids)}
+        matrix = np.zeros((len(building_ids), len(dates)), dtype=np.uint8)
+        missing_dates = []
+        # one frame per date as read_db makes it for a single date, the range frame
+        # has 0 (negative) for the manholes not sampled on a date
+        day_frames = {date_value: self.pivot_dates(rows) for date_value, rows in self.db_df.groupby('date')}
+        for day, date_value in enumerate(dates):
+            if date_value not in day_frames:
+                missing_dates.append(date_value)
+                continue
+            error_message, building_modes = self.get_mode_masks(date_value, "upstream", day_frames[date_value])
+            if error_message:
+                missing_dates.append(date_value)
+                continue
+            for building_id, modes in building_modes.items():
+                matrix[positions[building_id], day] = modes
+        return building_ids, matrix, missing_dates
+
+    def getTraceMatrix(self, start_value, end_value, export_format="json"):
+        """
+        return the affected buildings of every mode and date from start_value to end_value,
+        as json {"dates", "missing_dates", "buildings", "modes": {mode: one string per
+        building of 1 (affected), 0 or - (no data) per date}}, or as the parquet bytes
+        of a (building, date, one boolean column per mode) table of the dates with data
+        """
+        start_date = datetime.strptime(start_value, "%m/%d/%y")
+        end_date = datetime.strptime(end_value, "%m/%d/%y")
+        day_count = (end_date - start_date).days + 1
+        if day_count < 1 or day_count > MAX_MATRIX_DAYS:
+            return "Invalid date range, choose at most %d days" % MAX_MATRIX_DAYS, None
+        dates = [(start_date + timedelta(days=day)).strftime("%-m/%-d/%y") for day in range(day_count)]
+        building_ids, matrix, missing_dates = self.get_mode_matrix(dates)
+        if len(missing_dates) == len(dates):
+            return "Invalid date, please choose a date that exists in the wastewater sheet", None
+        has_data = np.array([date_value not in missing_dates for date_value in dates])
+        if export_format == "parquet":
+            rows = np.broadcast_to(has_data, matrix.shape).ravel()
+            table = pd.DataFrame({
+                'building': np.repeat(np.array(building_ids, dtype=object), len(dates))[rows],
+                'date': np.tile(np.array(dates, dtype=object), len(building_ids))[rows]})
+            for mode, bit in MODE_BITS.items():
+                table[mode] = (matrix.ravel()[rows] & bit) > 0
+            buffer = io.BytesIO()
             try:
-                affected_manholes += list(self.mh_graph.manhole_graph[mh_case])
-            except KeyError:
-                pass
-        return error_message, list(set(affected_manholes+pos_mh_list))
-
-    def exportDropIn(self, date_value):
-        year = date.today().year
-        saved_path = '/tmp/dropin%s.csv' % (
-            "".join(date_value.split("/"))+str(year))
+                table.to_parquet(buffer, index=False)
+            except ImportError:
+                return "Parquet export needs pyarrow or fastparquet", None
+            return None, buffer.getvalue()
+        if export_format != "json":
+            return "Export format not supported", None
+        modes = dict()
+        for mode, bit in MODE_BITS.items():
+            cells = np.where(has_data, np.where(matrix & bit, '1', '0'), '-')
+            modes[mode] = [''.join(row) for row in cells.tolist()]
+        return None, {"dates": dates, "missing_dates": missing_dates,
+                      "buildings": building_ids, "modes": modes}
+
+    @metrics.timed('drop_in')
+    def getDropIn(self, date_value):
+        """
+        return the drop-in table of a date: the status and Cq of every manhole
+        with its sampler, building, area and residential columns
+        """
         error_message, barriers = self.get_negative_barriers(date_value)
         if error_message:
-            return error_message, saved_path
-        self.mh_graph.barriers = barriers
-        self.mh_graph.buildGraph()
-        waste_df = self.read_sheet()
+            return error_message, None
+        waste_df = self.read_sheet(
+            columns=['SamplerID', 'ManholeID', 'Building(s)', 'Area', 'Residential'])
         drop_in = waste_df[['SamplerID', 'ManholeID', 'Building(s)', 'Area', 'Residential']]
         drop_in.columns = ['SAMPLE_ID', 'MANHOLE_ID', 'BUILDING', 'AREA', 'RESIDENTIAL']
         _, manhole_trace_list = self.MultiTraceManholes(date_value)
@@ -271,75 +507,115 @@ class Trace:
         full_mh_trace_df['TEST_DATE'] = date_value
         drop_in = pd.merge(full_mh_trace_df, drop_in,
                            on='MANHOLE_ID', how='left')
-        drop_in.to_csv(saved_path, index=False)
-        print("dropin csv has been saved to the tmp folder")
-        return None, saved_path
+        return None, drop_in
+
+    def exportDropIn(self, date_value, export_format="csv"):
+        """
+        return the drop-in table of a date as an iterator of csv text chunks of
+        DROP_IN_CHUNK_ROWS rows, or of parquet bytes, without an intermediate file
+        """
+        error_message, drop_in = self.getDropIn(date_value)
+        if error_message:
+            return error_message, None
+        if export_format == "parquet":
+            buffer = io.BytesIO()
+            try:
+                drop_in.to_parquet(buffer, index=False)
+            except ImportError:
+                return "Parquet export needs pyarrow or fastparquet", None
+            return None, iter([buffer.getvalue()])
+        if export_format != "csv":
+            return "Export format not supported", None
+        return None, (drop_in.iloc[idx:idx + DROP_IN_CHUNK_ROWS].to_csv(index=False, header=(idx == 0))
+                      for idx in range(0, max(len(drop_in), 1), DROP_IN_CHUNK_ROWS))
 
     def getCQManholeMap(self, date_val):
-        waste_df = self.read_sheet()
+        waste_df = self.read_sheet(columns=['ManholeID', date_val])
         manhole_ids = list(waste_df['ManholeID'])
         manhole_cqs = list(waste_df[date_val])
         manhole_cq_map = dict(zip(manhole_ids, manhole_cqs))
         return manhole_cq_map
 
+    @metrics.timed('multi_trace_manholes')
     def MultiTraceManholes(self, date_val):
-        mode_col_map = {'detection': 'Detection',
-                        'monitoring': 'Monitoring', 'sampling': 'Sampling'}
-        status_types = ["Not Currently Monitored", "Currently Monitored + Not Sampled",
-                        "Currently Monitored + Sampled + Not Detected", "Currently Monitored + Sampled + Detected"]
-        self.mh_graph.buildGraph()
-        status_sign_cnt = [0]*len(self.mh_graph.manhole_graph)
-        manhole_ids = list(self.mh_graph.manhole_graph.keys())
+        manhole_ids = list(self.mh_graph.network.manhole_ids)
         manhole_cq_map = self.getCQManholeMap(date_val)
-        for mode, _ in mode_col_map.items():
-            error_message, affected_manholes = self.get_affected_manholes(
-                date_val, mode=mode)
-            affected_set = set(affected_manholes)
-            if not error_message:
-                for idx, manhole_id in enumerate(manhole_ids):
-                    binary_check = "Yes" if manhole_id in affected_set else "No"
-                    if binary_check == "Yes":
-                        status_sign_cnt[idx] += 1
-            else:
-                return error_message, {}
+        error_message, manhole_modes = self.get_mode_masks(
+            date_val, "downstream")
+        if error_message:
+            return error_message, {}
         result = []
-        for idx, manhole_id in enumerate(manhole_ids):
+        for manhole_id in manhole_ids:
             info_json = {}
             info_json['MANHOLE_ID'] = manhole_id
-            info_json['STATUS'] = status_types[status_sign_cnt[idx]]
+            info_json['STATUS'] = STATUS_TYPES[count_modes(
+                manhole_modes.get(manhole_id, 0))]
             info_json['CQ'] = manhole_cq_map.get(manhole_id, "")
             result.append(info_json)
-        print(result)
+        metrics.payload(result)
         return None, result
 
 
-def autoPilotManhole(date_value):
-    tracing = Trace()
+def autoPilotManhole(date_value, graph=None):
+    tracing = Trace(date_value, graph)
     return tracing.MultiTraceManholes(date_value)
 
 
-def autoPilot(date_value, drop=False, mode="detection"):
-    tracing = Trace(date_value)
+def autoPilot(date_value, drop=False, mode="detection", graph=None):
+    tracing = Trace(date_value, graph)
     if drop:
-        error_message, path = tracing.exportDropIn(date_value)
+        error_message, chunks = tracing.exportDropIn(date_value)
         if error_message:
             return error_message, None
-        with open(path, 'r') as file:
-            message = file.read()
-            print(message)
-        try:
-            os.remove(path)
-            print("% s removed successfully" % path)
-        except OSError as error:
-            print(error)
-            print("File path can not be removed")
-            error_message = "File path can not be removed"
-        return error_message, message
+        message = "".join(chunks)
+        metrics.payload(message)
+        return None, message
     return tracing.get_affected_buildings(date_value, mode)
 
-def traceStats(date):
-    tracing = Trace(date)
-    return tracing.getMovingAverage(date)
+
+def autoPilotDropIn(date_value, export_format="csv", graph=None):
+    """
+    return the drop-in export of a date as an iterator of chunks, see Trace.exportDropIn
+    """
+    tracing = Trace(date_value, graph)
+    return tracing.exportDropIn(date_value, export_format)
+
+def autoPilotMatrix(date_value, day_window=7, export_format="json", graph=None):
+    """
+    return the trace matrix of the day_window days up to date_value, the Cq data of
+    the range is read in one go, see Trace.getTraceMatrix
+    """
+    # checked before the range is fetched
+    if not isinstance(day_window, int) or not 1 <= day_window <= MAX_MATRIX_DAYS:
+        return "Invalid day_window, choose 1 to %d days" % MAX_MATRIX_DAYS, None
+    try:
+        start_value = (datetime.strptime(date_value, "%m/%d/%y") - timedelta(
+            days=day_window - 1)).strftime("%-m/%-d/%y")
+    except (TypeError, ValueError):
+        return "Invalid date, please use the m/d/y format", None
+    tracing = Trace(date_value, graph, start_value)
+    return tracing.getTraceMatrix(start_value, date_value, export_format)
+
+
+def autoPilotMulti(date_value, graph=None):
+    """
+    return a map of affected building to the bitmask of modes affecting it
+    """
+    tracing = Trace(date_value, graph)
+    return tracing.get_mode_masks(date_value)
+
+
+def autoPilotSamplerCoverage(date_value, graph=None):
+    """
+    return the catchment counts and the status of every sampler of a date
+    """
+    tracing = Trace(date_value, graph)
+    return tracing.getSamplerCoverage(date_value)
+
+
+def traceStats(date, day_window=7, graph=None):
+    tracing = Trace(date, graph)
+    return tracing.getMovingAverage(date, day_window or 7)
 
 if __name__ == "__main__":
     targets = sys.argv
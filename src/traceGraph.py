@@ -1,6 +1,14 @@
-import geopandas
+from array import array
 from collections import defaultdict
-import networkx as nx
+import numpy as np
+import metrics
+from network_artifact import load_network
+from catchment import CatchmentTable, catchment_path
+from graph_export import graph_edges, edge_frame, save_graph
+
+
+# marks a coordinate without a manhole or building
+NO_LABEL = object()
 
 
 class MirrorMap:
@@ -21,122 +29,711 @@ class MirrorMap:
                         self.mirror[n] = key
 
 
+def int_array(values):
+    # 4 bytes an entry instead of a list slot and an int object
+    compact = array('i')
+    compact.frombytes(np.ascontiguousarray(values, dtype=np.int32).tobytes())
+    return compact
+
+
+# start node of a node reached from several start nodes, see TraceEngine.traceStarts
+MANY_STARTS = -1
+
+
+class TraceEngine:
+    # barrier independent adjacency of the network, built once and queried per barrier set
+    def __init__(self, network):
+        self.adjacency = {
+            "downstream": (int_array(network.down_ptr), int_array(network.down_idx)),
+            "upstream": (int_array(network.up_ptr), int_array(network.up_idx))}
+        self.node_manhole = int_array(network.node_manhole)
+        self.node_building = int_array(network.node_building)
+        self.manhole_nodes = int_array(network.manhole_nodes)
+        self.manhole_ids = network.manhole_ids
+        self.building_ids = network.building_ids
+        self.manhole_labels = {manhole_id: label for label,
+                               manhole_id in enumerate(self.manhole_ids)}
+        self.building_labels = set(self.building_ids)
+        self.loop_nodes = None
+
+    def getNode(self, manhole_id):
+        label = self.manhole_labels.get(manhole_id)
+        return None if label is None else self.manhole_nodes[label]
+
+    def getBarrierNodes(self, barriers):
+        # a coordinate shared by several manholes only carries the last one
+        nodes = set()
+        for manhole_id in barriers:
+            node = self.getNode(manhole_id)
+            if node is not None and self.manhole_ids[self.node_manhole[node]] == manhole_id:
+                nodes.add(node)
+        return nodes
+
+    def getLabels(self, node, only_mode=None):
+        labels = []
+        if ((not only_mode) or only_mode == "manhole") and self.node_manhole[node] >= 0:
+            labels.append(self.manhole_ids[self.node_manhole[node]])
+        if ((not only_mode) or only_mode == "build") and self.node_building[node] >= 0:
+            labels.append(self.building_ids[self.node_building[node]])
+        return labels
+
+    def trace(self, origins, barriers=(), mode="upstream", only_mode="build"):
+        """
+        return the manholes and/or buildings reachable from the origin manholes
+        without crossing a barrier, only the reachable part of the network is visited
+        """
+        masks = self.traceModes([origins], [barriers], mode, only_mode)
+        return set(masks)
+
+    def traceModes(self, origins, barriers, mode="upstream", only_mode="build"):
+        """
+        trace several origin lists, each with its own barriers, in one traversal
+        return a map of reached manhole/building to the bitmask of the lists reaching it
+        """
+        ptr, idx = self.adjacency[mode]
+        blocked = dict()
+        for bit, mode_barriers in enumerate(barriers):
+            for node in self.getBarrierNodes(mode_barriers):
+                blocked[node] = blocked.get(node, 0) | (1 << bit)
+        masks, reached = dict(), dict()
+        start_origins = defaultdict(set)
+        stack = []
+        for bit, mode_origins in enumerate(origins):
+            for manhole_id in mode_origins:
+                node = self.getNode(manhole_id)
+                if node is None or (blocked.get(node, 0) >> bit) & 1:
+                    continue
+                start_origins[node, bit].add(manhole_id)
+                if not (masks.get(node, 0) >> bit) & 1:
+                    masks[node] = masks.get(node, 0) | (1 << bit)
+                    stack.append((node, 1 << bit))
+        edge_count = 0
+        while stack:
+            node, bits = stack.pop()
+            edge_count += ptr[node + 1] - ptr[node]
+            for next_node in idx[ptr[node]:ptr[node + 1]]:
+                reached[next_node] = reached.get(next_node, 0) | bits
+                new_bits = bits & ~blocked.get(next_node, 0) & ~masks.get(next_node, 0)
+                if new_bits:
+                    masks[next_node] = masks.get(next_node, 0) | new_bits
+                    stack.append((next_node, new_bits))
+        metrics.count('trace_nodes_visited', len(masks))
+        metrics.count('trace_edges_visited', edge_count)
+        res = defaultdict(int)
+        for node, mask in masks.items():
+            for label in self.getLabels(node, only_mode):
+                res[label] |= mask
+        return self.excludeOrigins(
+            res, origins, barriers, mode, only_mode,
+            lambda node, bit: (reached.get(node, 0) >> bit) & 1,
+            lambda node, bit: start_origins.get((node, bit), ()))
+
+    def getLoopNodes(self):
+        """
+        return the nodes on a pipe loop, the only nodes a walk can come back to
+        """
+        if self.loop_nodes is None:
+            ptr, idx = self.adjacency["downstream"]
+            loop_nodes = set()
+            for component in strongly_connected_components(len(ptr) - 1, ptr, idx):
+                node = component[0]
+                if len(component) > 1 or node in idx[ptr[node]:ptr[node + 1]]:
+                    loop_nodes.update(component)
+            self.loop_nodes = loop_nodes
+        return self.loop_nodes
+
+    def excludeOrigins(self, res, origins, barriers, mode, only_mode, reached, node_origins):
+        """
+        drop from res (label to mask) the label of every origin that no other origin of
+        its list reaches, as getFlow leaves the origin out of its own trace,
+        reached(node, bit) tells whether the walk entered the node over a pipe and
+        node_origins(node, bit) gives the origins starting at the node
+        """
+        # (origin, bit) to the start node of the origin's own walk, None if it has none
+        own_nodes = dict()
+        for bit, mode_origins in enumerate(origins):
+            for origin in set(mode_origins):
+                if not (res.get(origin, 0) >> bit) & 1:
+                    continue
+                node = self.getNode(origin)
+                own_node = node if (node is not None and set(node_origins(node, bit)) == {origin}) else None
+                if (origin not in self.building_labels and node is not None
+                        and self.manhole_ids[self.node_manhole[node]] == origin):
+                    # the label is only on the origin coordinate
+                    if own_node is None:
+                        # another origin starts there
+                        continue
+                    if not reached(node, bit):
+                        res[origin] &= ~(1 << bit)
+                        continue
+                    if node not in self.getLoopNodes():
+                        # a walk only comes back to its own start over a loop
+                        continue
+                own_nodes[origin, bit] = own_node
+        if own_nodes:
+            # a loop, or a building named like the origin: find who reaches its label
+            kept = set()
+            bits = set(bit for _, bit in own_nodes)
+            for (node, bit), start in self.traceStarts(origins, barriers, mode, bits).items():
+                for label in self.getLabels(node, only_mode):
+                    if (label, bit) in own_nodes and start != own_nodes[label, bit]:
+                        kept.add((label, bit))
+            for origin, bit in own_nodes:
+                if (origin, bit) not in kept:
+                    res[origin] &= ~(1 << bit)
+        for label in [label for label, mask in res.items() if not mask]:
+            del res[label]
+        return res
+
+    def traceStarts(self, origins, barriers, mode, bits):
+        """
+        walk the lists of the given bits node by node, return a map of (node, bit) to the
+        start node it is reached from, MANY_STARTS once it is reached from two start nodes
+        """
+        ptr, idx = self.adjacency[mode]
+        starts, stack = dict(), []
+        for bit in bits:
+            blocked = self.getBarrierNodes(barriers[bit])
+            for manhole_id in origins[bit]:
+                node = self.getNode(manhole_id)
+                if node is not None and node not in blocked and (node, bit) not in starts:
+                    starts[node, bit] = node
+                    stack.append(node)
+            while stack:
+                node = stack.pop()
+                start = starts[node, bit]
+                for next_node in idx[ptr[node]:ptr[node + 1]]:
+                    if next_node in blocked:
+                        continue
+                    current = starts.get((next_node, bit))
+                    if current is None:
+                        starts[next_node, bit] = start
+                    elif current != start and current != MANY_STARTS:
+                        starts[next_node, bit] = MANY_STARTS
+                    else:
+                        continue
+                    stack.append(next_node)
+        return starts
+
+
+def strongly_connected_components(count, ptr, idx):
+    """
+    return the strongly connected components of a CSR graph, every component
+    after the components it reaches (iterative Tarjan)
+    """
+    index, low = [-1] * count, [0] * count
+    on_stack = [False] * count
+    stack, components, counter = [], [], 0
+    for root in range(count):
+        if index[root] >= 0:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, ptr[root])]
+        while work:
+            node, pos = work[-1]
+            if pos < ptr[node + 1]:
+                work[-1] = (node, pos + 1)
+                next_node = idx[pos]
+                if index[next_node] < 0:
+                    index[next_node] = low[next_node] = counter
+                    counter += 1
+                    stack.append(next_node)
+                    on_stack[next_node] = True
+                    work.append((next_node, ptr[next_node]))
+                elif on_stack[next_node]:
+                    low[node] = min(low[node], index[next_node])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+class ReachabilityIndex(TraceEngine):
+    """
+    trace engine over the manholes: the network is cut at the manhole coordinates
+    (units), every unit keeps the buildings it reaches before the next units and
+    those units, traces walk the units only and stop at the barriers
+
+    the units reachable from every unit without barriers are precomputed as bit
+    rows, membership queries without a reachable barrier are answered from them
+    """
+
+    def __init__(self, network):
+        super().__init__(network)
+        self.unit_nodes = array('i', [node for node, label in enumerate(self.node_manhole) if label >= 0])
+        self.node_unit = {node: unit for unit, node in enumerate(self.unit_nodes)}
+        self.regions = {mode: self.getRegions(mode) for mode in self.adjacency}
+        self.closures = dict()
+        self.label_units = dict()
+
+    def getRegions(self, mode):
+        """
+        return CSR arrays (build_ptr, build_idx, next_ptr, next_idx) of the buildings
+        reached from every unit before the next units, the unit coordinate itself
+        excluded, and of the next units
+        """
+        ptr, idx = self.adjacency[mode]
+        node_unit, node_building = self.node_unit, self.node_building
+        build_ptr, build_idx, next_ptr, next_idx = array('i', [0]), array('i'), array('i', [0]), array('i')
+        for unit_node in self.unit_nodes:
+            buildings, next_units = set(), set()
+            seen = {unit_node}
+            stack = [unit_node]
+            while stack:
+                node = stack.pop()
+                if node != unit_node and node_building[node] >= 0:
+                    buildings.add(node_building[node])
+                for next_node in idx[ptr[node]:ptr[node + 1]]:
+                    unit = node_unit.get(next_node)
+                    if unit is not None:
+                        next_units.add(unit)
+                    elif next_node not in seen:
+                        seen.add(next_node)
+                        stack.append(next_node)
+            build_idx.extend(sorted(buildings))
+            build_ptr.append(len(build_idx))
+            next_idx.extend(sorted(next_units))
+            next_ptr.append(len(next_idx))
+        return build_ptr, build_idx, next_ptr, next_idx
+
+    def getBarrierUnits(self, barriers):
+        return set(self.node_unit[node] for node in self.getBarrierNodes(barriers))
+
+    def traceModes(self, origins, barriers, mode="upstream", only_mode="build"):
+        """
+        trace several origin lists, each with its own barriers, in one walk over the units
+        return a map of reached manhole/building to the bitmask of the lists reaching it
+        """
+        build_ptr, build_idx, next_ptr, next_idx = self.regions[mode]
+        blocked = dict()
+        for bit, mode_barriers in enumerate(barriers):
+            for unit in self.getBarrierUnits(mode_barriers):
+                blocked[unit] = blocked.get(unit, 0) | (1 << bit)
+        masks, reached = dict(), dict()
+        start_origins = defaultdict(set)
+        stack = []
+        for bit, mode_origins in enumerate(origins):
+            for manhole_id in mode_origins:
+                node = self.getNode(manhole_id)
+                if node is None:
+                    continue
+                unit = self.node_unit[node]
+                if (blocked.get(unit, 0) >> bit) & 1:
+                    continue
+                start_origins[unit, bit].add(manhole_id)
+                if not (masks.get(unit, 0) >> bit) & 1:
+                    masks[unit] = masks.get(unit, 0) | (1 << bit)
+                    stack.append((unit, 1 << bit))
+        edge_count = 0
+        while stack:
+            unit, bits = stack.pop()
+            edge_count += next_ptr[unit + 1] - next_ptr[unit]
+            for next_unit in next_idx[next_ptr[unit]:next_ptr[unit + 1]]:
+                reached[next_unit] = reached.get(next_unit, 0) | bits
+                new_bits = bits & ~blocked.get(next_unit, 0) & ~masks.get(next_unit, 0)
+                if new_bits:
+                    masks[next_unit] = masks.get(next_unit, 0) | new_bits
+                    stack.append((next_unit, new_bits))
+        metrics.count('trace_units_visited', len(masks))
+        metrics.count('trace_unit_edges_visited', edge_count)
+        add_build = (not only_mode) or only_mode == "build"
+        res = defaultdict(int)
+        for unit, mask in masks.items():
+            for label in self.getLabels(self.unit_nodes[unit], only_mode):
+                res[label] |= mask
+            if add_build:
+                for building in build_idx[build_ptr[unit]:build_ptr[unit + 1]]:
+                    res[self.building_ids[building]] |= mask
+        node_unit = self.node_unit
+        return self.excludeOrigins(
+            res, origins, barriers, mode, only_mode,
+            lambda node, bit: (reached.get(node_unit[node], 0) >> bit) & 1,
+            lambda node, bit: start_origins.get((node_unit[node], bit), ()))
+
+    def getClosure(self, mode):
+        """
+        return (rows, unit to row) of the units reachable from every unit without
+        barriers, itself included, as big endian packed bit rows
+        """
+        if mode not in self.closures:
+            _, _, next_ptr, next_idx = self.regions[mode]
+            unit_count = len(self.unit_nodes)
+            components = strongly_connected_components(unit_count, next_ptr, next_idx)
+            unit_row = np.empty(unit_count, dtype=np.int64)
+            rows = np.zeros((len(components), (unit_count + 7) // 8), dtype=np.uint8)
+            for row_index, component in enumerate(components):
+                unit_row[component] = row_index
+                row = rows[row_index]
+                for unit in component:
+                    row[unit >> 3] |= 0x80 >> (unit & 7)
+                    # components reached from this one have lower rows, already complete
+                    for next_unit in next_idx[next_ptr[unit]:next_ptr[unit + 1]]:
+                        if unit_row[next_unit] != row_index:
+                            row |= rows[unit_row[next_unit]]
+            self.closures[mode] = rows, unit_row
+        return self.closures[mode]
+
+    def getLabelUnits(self, mode):
+        """
+        return a map of manhole/building label to the units whose walk reaches it
+        """
+        if mode not in self.label_units:
+            build_ptr, build_idx, _, _ = self.regions[mode]
+            label_units = defaultdict(list)
+            for unit, unit_node in enumerate(self.unit_nodes):
+                labels = set(self.getLabels(unit_node, None))
+                labels.update(self.building_ids[building]
+                              for building in build_idx[build_ptr[unit]:build_ptr[unit + 1]])
+                for label in labels:
+                    label_units[label].append(unit)
+            self.label_units[mode] = label_units
+        return self.label_units[mode]
+
+    def reaches(self, label, manhole_id, barriers=(), mode="upstream"):
+        """
+        return whether a building or manhole label is traced from a manhole without
+        crossing a barrier, e.g. whether a building can drain into the manhole (upstream)
+        """
+        node = self.getNode(manhole_id)
+        if node is None:
+            return False
+        unit = self.node_unit[node]
+        barrier_units = self.getBarrierUnits(barriers)
+        if unit in barrier_units:
+            return False
+        rows, unit_row = self.getClosure(mode)
+        row = rows[unit_row[unit]]
+        if label == manhole_id or any(row[barrier >> 3] & (0x80 >> (barrier & 7)) for barrier in barrier_units):
+            # a barrier may cut the way, or the origin exclusion applies, walk the units
+            return label in self.trace([manhole_id], barriers, mode, None)
+        return any(row[other >> 3] & (0x80 >> (other & 7))
+                   for other in self.getLabelUnits(mode).get(label, ()))
+
+
+class GraphView:
+    """
+    TraceGraph attribute materialized from the integer network when it is first
+    read, it can be assigned like a plain attribute
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, graph, owner=None):
+        if graph is None:
+            return self
+        if self.name not in graph.views:
+            graph.materialize(self.name)
+        return graph.views[self.name]
+
+    def __set__(self, graph, value):
+        graph.views[self.name] = value
+
+
 class TraceGraph:
+    # the network keeps coordinates as integer nodes with CSR adjacency and label
+    # arrays, the coordinate keyed dicts below are only built when they are read
+    manhole_to_coords_map = GraphView()
+    coords_to_manhole_map = GraphView()
+    build_to_coords_map = GraphView()
+    coords_to_build_map = GraphView()
+    edges = GraphView()
+    mirror_edges = GraphView()
+    # might not include all downstream but simplify graph
+    graph_without_all_downstream = GraphView()
+    manhole_graph = GraphView()
+    trace_graph = GraphView()
+    graph = GraphView()
+
     # Assuming the network folder in the same path
-    def __init__(self):
-        self.graph = None
-        self.manhole_graph = None
-        self.trace_graph = None
-        self.df_pipe = geopandas.read_file('../data/network2/SewerPipe_1.shp')
-        self.df_manhole = geopandas.read_file(
-            '../data/network2/MergedVertices_1.shp')
-        self.df_buildings = geopandas.read_file(
-            '../data/network2/Sewer_Buildings_Project_1.shp')
-        self.manhole_to_coords_map = {elem['UCSD_ID']: (
-            elem['geometry'].x, elem['geometry'].y) for _, elem in self.df_manhole[["UCSD_ID", "geometry"]].iterrows()}
-        self.coords_to_manhole_map = MirrorMap(
-            self.manhole_to_coords_map).mirror
-        self.build_to_coords_map = defaultdict(set)
-        for _, elem in self.df_buildings[["BID", "geometry"]].iterrows():
-            if elem['BID']:
-                self.build_to_coords_map[elem['BID']].add(
-                    (elem['geometry'].x, elem['geometry'].y))
-        self.coords_to_build_map = MirrorMap(
-            self.build_to_coords_map, True).mirror
-        self.edges = None
-        self.mirror_edges = None
-        # might not include all downstream but simplify graph
-        self.graph_without_all_downstream = dict()
+    def __init__(self, network=None):
+        self.views = dict()
+        # precompiled from the shapefiles, recompiled when they change
+        if network is None:
+            with metrics.timer('network_load'):
+                network = load_network()
+        self.network = network
+        self.engine = None
         self.barriers = set()
+        # CSR (ptr, label idx) of the downstream manholes and upstream buildings of every manhole
+        self.reach = None
+        # (nodes, sources, targets) of the graphs of buildGraph, by graph type
+        self.graph_edges = dict()
+        # barrier free upstream buildings and manholes of every manhole, see getCatchment
+        self.catchment = None
+
+    def materialize(self, name):
+        network = self.network
+        if name == "manhole_to_coords_map":
+            self.views[name] = network.manhole_to_coords_map()
+        elif name == "coords_to_manhole_map":
+            self.views[name] = network.coords_to_manhole_map()
+        elif name == "build_to_coords_map":
+            self.views[name] = defaultdict(set, network.build_to_coords_map())
+        elif name == "coords_to_build_map":
+            self.views[name] = network.coords_to_build_map()
+        elif name in ("edges", "mirror_edges", "graph_without_all_downstream"):
+            self.getSewerEdge()
+        elif self.reach is None:
+            # not built yet, see buildGraph
+            self.views[name] = None
+        elif name == "graph":
+            self.views[name] = self.getMainGraph()
+        else:
+            ptr, idx = self.reach[name]
+            ptr, label_ids = ptr.tolist(), network.manhole_ids if name == "manhole_graph" else network.building_ids
+            self.views[name] = {manhole_id: set(label_ids[label] for label in idx[ptr[k]:ptr[k + 1]].tolist())
+                                for k, manhole_id in enumerate(network.manhole_ids)}
 
     def getSewerEdge(self):
         sewer_edges = defaultdict(set)
-        for index, row in self.df_pipe.iterrows():
-            for idx in range(1, len(row['geometry'].coords)):
-                previous_coord, curr_coord = row['geometry'].coords[idx -
-                                                                    1], row['geometry'].coords[idx]
-                sewer_edges[previous_coord].add(curr_coord)
-                graph_key = self.coords_to_manhole_map.get(
-                    previous_coord, previous_coord)
-                graph_val = self.coords_to_manhole_map.get(
-                    curr_coord, curr_coord)
-                self.graph_without_all_downstream[graph_key] = graph_val
+        graph_without_all_downstream = dict()
+        coords = [tuple(coord) for coord in self.network.coords.tolist()]
+        coords_to_manhole_map = self.coords_to_manhole_map
+        sources, targets = self.network.edge_pairs()
+        for source, target in zip(sources.tolist(), targets.tolist()):
+            previous_coord, curr_coord = coords[source], coords[target]
+            sewer_edges[previous_coord].add(curr_coord)
+            graph_key = coords_to_manhole_map.get(
+                previous_coord, previous_coord)
+            graph_val = coords_to_manhole_map.get(
+                curr_coord, curr_coord)
+            graph_without_all_downstream[graph_key] = graph_val
         self.edges = sewer_edges
         self.mirror_edges = MirrorMap(self.edges).mirror
+        self.graph_without_all_downstream = graph_without_all_downstream
 
     def getFlow(self, seg_loc, visited, res, origin, mode="downstream", only_mode=None):
-        # check if already visit or the current location is a barrier(a negative manhole)
-        if seg_loc in visited:
-            return
-        if ((seg_loc in self.coords_to_manhole_map) and (self.coords_to_manhole_map[seg_loc] in self.barriers)):
-            return
-        visited.add(seg_loc)
-        if (seg_loc in self.coords_to_manhole_map) and (self.coords_to_manhole_map[seg_loc] != origin) and ((not only_mode) or only_mode == "manhole"):
-            res.add(self.coords_to_manhole_map[seg_loc])
-        if (seg_loc in self.coords_to_build_map) and (self.coords_to_build_map[seg_loc] != origin) and ((not only_mode) or only_mode == "build"):
-            res.add(self.coords_to_build_map[seg_loc])
+        # iterative depth first search, long trunk lines would exceed the recursion limit
+        next_segs = self.edges if mode == "downstream" else self.mirror_edges
+        coords_to_manhole_map, coords_to_build_map = self.coords_to_manhole_map, self.coords_to_build_map
+        barriers = self.barriers
+        add_manhole = (not only_mode) or only_mode == "manhole"
+        add_build = (not only_mode) or only_mode == "build"
+        stack = [seg_loc]
+        while stack:
+            seg_loc = stack.pop()
+            # check if already visit or the current location is a barrier(a negative manhole)
+            if seg_loc in visited:
+                continue
+            manhole_id = coords_to_manhole_map.get(seg_loc, NO_LABEL)
+            if manhole_id in barriers:
+                continue
+            visited.add(seg_loc)
+            if add_manhole and (manhole_id is not NO_LABEL) and (manhole_id != origin):
+                res.add(manhole_id)
+            if add_build:
+                build_id = coords_to_build_map.get(seg_loc, NO_LABEL)
+                if (build_id is not NO_LABEL) and (build_id != origin):
+                    res.add(build_id)
+            stack.extend(next_segs.get(seg_loc, ()))
+
+    def getEngine(self):
+        if self.engine is None:
+            with metrics.timer('engine_build'):
+                self.engine = ReachabilityIndex(self.network)
+        return self.engine
+
+    @metrics.timed('trace')
+    def traceFrom(self, origins, mode="upstream", only_mode="build", barriers=None):
+        """
+        trace from a set of manholes with the given (by default the current) barriers
+        without building the full graph
+        """
+        if barriers is None:
+            barriers = self.barriers
+        if mode == "upstream" and only_mode == "build":
+            # a join of the catchment table when no barrier is upstream of the origins
+            buildings = self.getCatchment().traceBuildings(origins, barriers)
+            if buildings is not None:
+                metrics.count('catchment_joins')
+                return buildings
+        return self.getEngine().trace(origins, barriers, mode, only_mode)
+
+    @metrics.timed('trace')
+    def traceModes(self, origins, barriers, mode="upstream", only_mode="build"):
+        """
+        trace several origin lists with their own barriers in one pass, see TraceEngine.traceModes
+        """
+        return self.getEngine().traceModes(origins, barriers, mode, only_mode)
+
+    def reaches(self, label, manhole_id, mode="upstream", barriers=None):
+        """
+        return whether a building or manhole is traced from a manhole with the given
+        (by default the current) barriers, see ReachabilityIndex.reaches
+        """
+        if barriers is None:
+            barriers = self.barriers
+        return self.getEngine().reaches(label, manhole_id, barriers, mode)
+
+    def flowLabels(self, mode, node_label, label_ids, blocked, exclude_origin=True):
+        """
+        return CSR (ptr, label idx) of the labels found from every manhole without
+        crossing a blocked node, the manhole itself excluded as getFlow does unless
+        exclude_origin is False
+        """
+        network = self.network
         if mode == "downstream":
-            for seg in self.edges[seg_loc]:
-                self.getFlow(seg, visited, res, origin, mode, only_mode)
+            ptr, idx = network.down_ptr.tolist(), network.down_idx.tolist()
         else:
-            for seg in self.mirror_edges[seg_loc]:
-                self.getFlow(seg, visited, res, origin, mode, only_mode)
+            ptr, idx = network.up_ptr.tolist(), network.up_idx.tolist()
+        labels_ptr, labels_idx = array('q', [0]), array('i')
+        visited_count = 0
+        for manhole_id, origin_node in zip(network.manhole_ids, network.manhole_nodes.tolist()):
+            found, visited = set(), set()
+            stack = [origin_node]
+            while stack:
+                node = stack.pop()
+                if node in visited or node in blocked:
+                    continue
+                visited.add(node)
+                label = node_label[node]
+                if label >= 0 and not (exclude_origin and label_ids[label] == manhole_id):
+                    found.add(label)
+                stack.extend(idx[ptr[node]:ptr[node + 1]])
+            labels_idx.extend(sorted(found))
+            labels_ptr.append(len(labels_idx))
+            visited_count += len(visited)
+        metrics.count('build_graph_nodes_visited', visited_count)
+        return np.frombuffer(labels_ptr, dtype=np.int64), np.frombuffer(labels_idx, dtype=np.int32)
 
+    def getCatchment(self, path=None):
+        """
+        return the catchment table of the network, read from path (by default
+        next to the network artifact) and computed again when the artifact changed
+        """
+        if self.catchment is not None:
+            return self.catchment
+        path = path or catchment_path()
+        with metrics.timer('catchment_load'):
+            table = CatchmentTable.load(self.network, path)
+        if table is None:
+            with metrics.timer('catchment_build'):
+                network = self.network
+                building_ptr, building_idx = self.flowLabels(
+                    "upstream", network.node_building.tolist(), network.building_ids, set(), False)
+                manhole_ptr, manhole_idx = self.flowLabels(
+                    "upstream", network.node_manhole.tolist(), network.manhole_ids, set(), False)
+                table = CatchmentTable(network, {
+                    'building_ptr': building_ptr, 'building_idx': building_idx,
+                    'manhole_ptr': manhole_ptr, 'manhole_idx': manhole_idx}, network.fingerprint())
+            if table.fingerprint is not None:
+                try:
+                    table.save(path)
+                except OSError as error:
+                    # read-only file system, keep the table in memory
+                    print(error)
+        self.catchment = table
+        return table
+
+    @metrics.timed('build_graph')
     def buildGraph(self):
-        self.getSewerEdge()
-        visited = set()
-        graph = dict()
-        # Build downward manhole graph
-        for manhole_id in self.df_manhole['UCSD_ID']:
-            if manhole_id not in visited:
-                visited.add(manhole_id)
-                component_sewer = set()
-                self.getFlow(self.manhole_to_coords_map[manhole_id], set(
-                ), component_sewer, manhole_id, "downstream", "manhole")
-                graph[manhole_id] = component_sewer
-        self.manhole_graph = graph
-        print("trace UCSD IDs for manholes", self.df_manhole['UCSD_ID'])
-        # Build upward tracing graph
-        visited = set()
-        graph = dict()
-        for manhole_id in self.df_manhole['UCSD_ID']:
-            if manhole_id not in visited:
-                visited.add(manhole_id)
-                component_sewer = set()
-                self.getFlow(self.manhole_to_coords_map[manhole_id], set(
-                ), component_sewer, manhole_id, "upstream", "build")
-                graph[manhole_id] = component_sewer
-        self.trace_graph = graph
-        # Build the main graph
-        visited = set()
+        """
+        trace the downstream manholes and the upstream buildings of every manhole
+        with the current barriers on the integer network, manhole_graph, trace_graph
+        and graph are materialized from the result when they are read
+        """
+        network = self.network
+        node_manhole = network.node_manhole.tolist()
+        blocked = set(node for node, label in enumerate(node_manhole)
+                      if label >= 0 and network.manhole_ids[label] in self.barriers)
+        self.reach = {
+            "manhole_graph": self.flowLabels("downstream", node_manhole, network.manhole_ids, blocked),
+            "trace_graph": self.flowLabels("upstream", network.node_building.tolist(), network.building_ids, blocked)}
+        metrics.payload("trace UCSD IDs for manholes", self.network.manhole_ids)
+        for name in ("manhole_graph", "trace_graph", "graph"):
+            self.views.pop(name, None)
+        self.graph_edges = dict()
+
+    def getMainGraph(self):
+        """
+        return the map of every coordinate label (its manhole, else its building,
+        else the coordinate) to the labels of its upstream neighbors
+        """
+        network = self.network
+        node_manhole, node_building = network.node_manhole.tolist(), network.node_building.tolist()
+        coords = network.coords
+
+        def label(node):
+            if node_manhole[node] >= 0:
+                return network.manhole_ids[node_manhole[node]]
+            if node_building[node] >= 0:
+                return network.building_ids[node_building[node]]
+            return tuple(coords[node].tolist())
+
         graph = defaultdict(set)
-        for key, value in self.mirror_edges.items():
-            temp_key = key
-            if (key in self.coords_to_build_map):
-                temp_key = self.coords_to_build_map[key]
-            if (key in self.coords_to_manhole_map):
-                temp_key = self.coords_to_manhole_map[key]
-            for val in value:
-                temp_val = val
-                if (val in self.coords_to_build_map):
-                    temp_val = self.coords_to_build_map[val]
-                if (val in self.coords_to_manhole_map):
-                    temp_val = self.coords_to_manhole_map[val]
-                graph[temp_key].add(temp_val)
-        self.graph = graph
+        ptr, idx = network.up_ptr.tolist(), network.up_idx.tolist()
+        for node in range(network.node_count):
+            if ptr[node] < ptr[node + 1]:
+                graph[label(node)].update(label(next_node) for next_node in idx[ptr[node]:ptr[node + 1]])
+        return graph
+
+    def getEdges(self, g_type="manhole"):
+        """
+        return (nodes, sources, targets) of a graph built by buildGraph, the edges
+        as positions in nodes, see graph_export.graph_edges
+        """
+        if g_type not in self.graph_edges:
+            if g_type in ("manhole", "trace") and self.reach is not None:
+                self.graph_edges[g_type] = self.getReachEdges(g_type)
+            else:
+                self.graph_edges[g_type] = graph_edges(self.graph)
+        return self.graph_edges[g_type]
+
+    def getReachEdges(self, g_type):
+        # straight from the CSR of buildGraph, the manholes first then the other labels
+        # that are reached, as graph_edges lists them
+        ptr, idx = self.reach["manhole_graph" if g_type == "manhole" else "trace_graph"]
+        label_ids = self.network.manhole_ids if g_type == "manhole" else self.network.building_ids
+        nodes = list(self.network.manhole_ids)
+        positions = {node: position for position, node in enumerate(nodes)}
+        reached = np.unique(idx)
+        label_positions = np.zeros(len(label_ids), dtype=np.int32)
+        for label in reached.tolist():
+            label_id = label_ids[label]
+            if label_id not in positions:
+                positions[label_id] = len(nodes)
+                nodes.append(label_id)
+            label_positions[label] = positions[label_id]
+        sources = np.repeat(np.arange(len(ptr) - 1, dtype=np.int32), np.diff(ptr))
+        targets = label_positions[idx] if len(idx) else np.array([], dtype=np.int32)
+        return nodes, sources, targets
 
     def toNetworkGraph(self, g_type="manhole"):
-        if g_type == "manhole":
-            return nx.DiGraph(self.manhole_graph)
-        if g_type == "trace":
-            return nx.DiGraph(self.trace_graph)
-        return nx.DiGraph(self.graph)
-
-    def toDF(self):
-        G = self.toNetworkGraph()
-        return nx.to_pandas_adjacency(G)
-
-    def exportCSV(self):
-        df = self.toDF()
-        df.to_csv('data/downstream_graph.csv', index=False)
-        print("graph csv has been saved to the data folder")
+        # networkx is only needed by the callers of this method
+        import networkx as nx
+        nodes, sources, targets = self.getEdges(g_type)
+        G = nx.DiGraph()
+        G.add_nodes_from(nodes)
+        G.add_edges_from((nodes[source], nodes[target])
+                         for source, target in zip(sources.tolist(), targets.tolist()))
+        return G
+
+    def toDF(self, g_type="manhole"):
+        """
+        return the edge table (source, target) of a graph, a dense adjacency
+        matrix grows with the square of the manholes
+        """
+        return edge_frame(*self.getEdges(g_type))
+
+    def exportCSV(self, path='data/downstream_graph.csv', export_format=None, g_type="manhole"):
+        """
+        save a graph as an edge list csv, a CSR .npz, GraphML or parquet,
+        by default from the extension of path, see graph_export.load_graph to read it
+        """
+        save_graph(path, *self.getEdges(g_type), export_format)
+        print("graph has been saved to", path)
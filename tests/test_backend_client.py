@@ -0,0 +1,50 @@
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import backend_client
+
+
+class FailingHandler(BaseHTTPRequestHandler):
+    # every request is counted and answered 503
+    def do_GET(self):
+        self.server.request_count += 1
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FailingHandler)
+        self.server.request_count = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/write_date' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_not_idempotent_request_is_sent_once(self):
+        response = backend_client.get(self.url, idempotent=False, params={'date': '6/7/21'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.request_count, 1)
+
+    def test_idempotent_request_is_retried(self):
+        response = backend_client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.request_count, backend_client.RETRIES + 1)
+
+    def test_sessions_per_kind(self):
+        self.assertIs(backend_client.get_session(), backend_client.get_session(True))
+        self.assertIsNot(backend_client.get_session(False), backend_client.get_session(True))
+
+
+if __name__ == "__main__":
+    unittest.main()
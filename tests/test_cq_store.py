@@ -0,0 +1,83 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import date, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from cq_store import CqStore, read_cqs
+
+
+def day_record(day, manhole_id, cq_value=30.0):
+    return {'date': day.isoformat() + "T00:00:00Z", 'manholeID': manhole_id,
+            'samplerID': 'AS' + manhole_id, 'cqValue': cq_value}
+
+
+class CqStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = CqStore(os.path.join(self.dir, 'cq.sqlite'), freshness_days=3)
+        self.start = date(2021, 6, 1)
+
+    def tearDown(self):
+        self.store.connection.close()
+        shutil.rmtree(self.dir)
+
+    def test_stale_ranges(self):
+        end = self.start + timedelta(days=9)
+        self.assertEqual(self.store.getStaleRanges(self.start, end), [(self.start, end)])
+        # days 2 to 4 synced long after they were final, day 6 while it could still change
+        self.store.store(self.start + timedelta(days=2), self.start + timedelta(days=4), [],
+                         today=self.start + timedelta(days=30))
+        self.store.store(self.start + timedelta(days=6), self.start + timedelta(days=6), [],
+                         today=self.start + timedelta(days=8))
+        self.assertEqual(self.store.getStaleRanges(self.start, end), [
+            (self.start, self.start + timedelta(days=1)),
+            (self.start + timedelta(days=5), end)])
+
+    def test_freshness_horizon(self):
+        day = self.start
+        # synced on the last day its values could change, and on the first day they are final
+        self.store.store(day, day, [], today=day + timedelta(days=2))
+        self.assertEqual(self.store.getStaleRanges(day, day), [(day, day)])
+        self.store.store(day, day, [], today=day + timedelta(days=3))
+        self.assertEqual(self.store.getStaleRanges(day, day), [])
+        self.store.invalidate(day)
+        self.assertEqual(self.store.getStaleRanges(day, day), [(day, day)])
+
+    def test_store_replaces_days(self):
+        end = self.start + timedelta(days=1)
+        self.store.store(self.start, end, [day_record(self.start, 'M1'), day_record(end, 'M2'),
+                                           day_record(end + timedelta(days=1), 'M3')])
+        self.assertEqual(sorted(record['manholeID'] for record in self.store.load(self.start, end)),
+                         ['M1', 'M2'])
+        self.store.store(end, end, [day_record(end, 'M4', 0)])
+        self.assertEqual(sorted((record['manholeID'], record['cqValue'])
+                                for record in self.store.load(self.start, end)),
+                         [('M1', 30.0), ('M4', 0.0)])
+
+    def test_read_fetches_stale_ranges_without_lock(self):
+        fetched = []
+
+        def fetch(start_date, end_date):
+            self.assertFalse(self.store.lock.locked())
+            fetched.append((start_date, end_date))
+            day, records = start_date, []
+            while day <= end_date:
+                records.append(day_record(day, 'M1'))
+                day += timedelta(days=1)
+            return records
+
+        end = self.start + timedelta(days=4)
+        self.store.store(self.start + timedelta(days=2), self.start + timedelta(days=2),
+                         [day_record(self.start + timedelta(days=2), 'M2')],
+                         today=self.start + timedelta(days=30))
+        records = read_cqs(self.start, end, fetch, self.store)
+        self.assertEqual(fetched, [(self.start, self.start + timedelta(days=1)),
+                                   (self.start + timedelta(days=3), end)])
+        self.assertEqual(sorted(record['manholeID'] for record in records), ['M1'] * 4 + ['M2'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import unittest
+import importlib.util
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from benchmark import fake_backends
+from synthetic_network import generate_network
+from traceGraph import TraceGraph
+from fake_arcgis import FakeFeature, FakeLayer
+
+
+NETWORK = generate_network(600, 3, chain_ratio=0.9, manhole_every=4)
+# a Monday and the Tuesday after it
+DAY, NEXT_DAY = "6/7/21", "6/8/21"
+
+
+def same_cqs_every_day(data, day):
+    # a quiet stretch: every day has the Cq values of day
+    get_cqs = data.getQpcrCqs
+    day_start = datetime.strptime(day, "%m/%d/%y")
+
+    def getQpcrCqs(variables):
+        records, current = [], datetime.fromisoformat(variables['startDate'].replace("Z", ""))
+        end = datetime.fromisoformat(variables['endDate'].replace("Z", ""))
+        while current <= end:
+            records += [dict(record, date=current.isoformat() + "Z") for record in get_cqs(
+                {'startDate': day_start.isoformat() + "Z", 'endDate': day_start.isoformat() + "Z"})]
+            current += timedelta(days=1)
+        return records
+    data.getQpcrCqs = getQpcrCqs
+
+
+@unittest.skipIf(importlib.util.find_spec('arcgis') is None, "the layer updates need arcgis")
+class QuietDayTest(unittest.TestCase):
+
+    def test_quiet_day_sends_nothing(self):
+        from layer_update import updateBuilding, TraceContext
+        graph = TraceGraph(NETWORK)
+        with fake_backends(NETWORK, DAY) as (data, book, gis):
+            same_cqs_every_day(data, DAY)
+            reports = dict()
+            for date_val in (DAY, NEXT_DAY):
+                # one context per invocation, as the cron does
+                context = TraceContext(graph)
+                reports[date_val] = {trace_mode: updateBuilding(date_val, trace_mode, context)
+                                     for trace_mode in ("single", "multi")}
+            building_count = len(NETWORK.building_ids)
+            for trace_mode in ("single", "multi"):
+                error_message, first = reports[DAY][trace_mode]
+                self.assertIsNone(error_message)
+                self.assertGreater(first['update_success_count'], 0)
+                error_message, second = reports[NEXT_DAY][trace_mode]
+                self.assertIsNone(error_message)
+                self.assertEqual(second['update_success_count'], 0)
+                self.assertEqual(second['update_unchanged_count'], building_count)
+            # the rows sent on the first day keep its date
+            multi_rows = gis.layers['multi_trace_layer'][0].rows.values()
+            self.assertEqual(set(row['Date'] for row in multi_rows if row['Status'] is not None),
+                             {datetime(2021, 6, 8)})
+
+
+class FailingLayer(FakeLayer):
+    # a layer keyed by FID whose edit requests all fail
+    def __init__(self):
+        super().__init__([])
+        self.properties.objectIdField = 'FID'
+        self.payloads = []
+
+    def edit_features(self, updates=None, adds=None):
+        self.payloads.append(updates if updates is not None else adds)
+        raise ValueError("edit rejected")
+
+
+@unittest.skipIf(importlib.util.find_spec('arcgis') is None, "the layer updates need arcgis")
+class EditInChunksTest(unittest.TestCase):
+
+    def test_features_sent_as_dicts(self):
+        from layer_update import ArcgisOperation, FeatureRecord
+        with fake_backends(NETWORK, DAY) as (data, book, gis):
+            arcgis = ArcgisOperation()
+            layer = FailingLayer()
+            # whole arcgis features (historical adds, backfill copies), records and dicts
+            features = [FakeFeature({'FID': 1, 'Status': "a"}, {'x': 1}), FakeFeature({'FID': 2}),
+                        FeatureRecord({'FID': 3}), FeatureRecord({'FID': 4}, {'x': 4}),
+                        {'attributes': {'FID': 5}}]
+            report = arcgis.editInChunks(layer, features, "update", chunk_size=3, retries=0)
+            self.assertEqual(report['update_fail_count'], 5)
+            self.assertEqual(report['failed_object_ids'], [1, 2, 3, 4, 5])
+            self.assertEqual(report['errors'], ["edit rejected"] * 2)
+            self.assertEqual(layer.payloads[0], [
+                {'attributes': {'FID': 1, 'Status': "a"}, 'geometry': {'x': 1}},
+                {'attributes': {'FID': 2}}, {'attributes': {'FID': 3}}])
+            self.assertEqual(layer.payloads[1], [
+                {'attributes': {'FID': 4}, 'geometry': {'x': 4}}, {'attributes': {'FID': 5}}])
+
+
+
+@unittest.skipIf(importlib.util.find_spec('arcgis') is None, "the layer updates need arcgis")
+class GetFeaturesTest(unittest.TestCase):
+
+    def test_pages_limited_by_max_record_count(self):
+        from layer_update import ArcgisOperation
+        with fake_backends(NETWORK, DAY) as (data, book, gis):
+            arcgis = ArcgisOperation()
+            rows = [{'OBJECTID': idx + 1, 'Status': str(idx)} for idx in range(250)]
+            for max_record_count, page_size, query_count in ((100, 2000, 3), (2000, 100, 3), (50, 50, 6)):
+                layer = FakeLayer(rows, max_record_count=max_record_count)
+                features = arcgis.getFeatures(layer, ['Status'], False, page_size)
+                self.assertEqual([feat.attributes['Status'] for feat in features],
+                                 [row['Status'] for row in rows])
+                self.assertEqual(layer.query_count, query_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from reference_cache import ReferenceCache
+
+
+class ReferenceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fetch(self, value):
+        def fetch():
+            self.calls.append(value)
+            return value
+        return fetch
+
+    def test_fetched_once_within_ttl(self):
+        cache = ReferenceCache(self.dir, ttl=60)
+        self.assertEqual(cache.get('table', self.fetch([1])), [1])
+        self.assertEqual(cache.get('table', self.fetch([2])), [1])
+        # another process reads the disk copy
+        self.assertEqual(ReferenceCache(self.dir, ttl=60).get('table', self.fetch([3])), [1])
+        self.assertEqual(self.calls, [[1]])
+
+    def test_expired_entry_is_fetched_again(self):
+        cache = ReferenceCache(self.dir, ttl=60)
+        cache.get('table', self.fetch([1]))
+        # age the entry in memory and on disk past the ttl
+        fetched_at = time.time() - 61
+        cache.entries['table'] = (fetched_at, [1])
+        with open(cache.getPath('table'), 'w') as cache_file:
+            json.dump({'fetched_at': fetched_at, 'value': [1]}, cache_file)
+        self.assertEqual(cache.get('table', self.fetch([2])), [2])
+        self.assertEqual(ReferenceCache(self.dir, ttl=60).get('table', self.fetch([3])), [2])
+        self.assertEqual(self.calls, [[1], [2]])
+
+    def test_invalidate(self):
+        cache = ReferenceCache(self.dir, ttl=60)
+        cache.get('table', self.fetch([1]))
+        cache.get('other', self.fetch([2]))
+        cache.invalidate('table')
+        self.assertFalse(os.path.exists(cache.getPath('table')))
+        self.assertEqual(cache.get('table', self.fetch([3])), [3])
+        self.assertEqual(cache.get('other', self.fetch([4])), [2])
+        # all entries, also the ones only on disk
+        ReferenceCache(self.dir, ttl=60).get('disk_only', self.fetch([5]))
+        cache.invalidate()
+        self.assertEqual(cache.listDisk(), [])
+        self.assertEqual(cache.get('other', self.fetch([6])), [6])
+        self.assertEqual(self.calls, [[1], [2], [3], [5], [6]])
+
+    def test_unreadable_disk_copy_is_fetched(self):
+        cache = ReferenceCache(self.dir, ttl=60)
+        with open(cache.getPath('table'), 'w') as cache_file:
+            cache_file.write('{not json')
+        self.assertEqual(cache.get('table', self.fetch([1])), [1])
+        self.assertEqual(ReferenceCache(self.dir, ttl=60).get('table', self.fetch([2])), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import asyncio
+import contextlib
+import threading
+import unittest
+import http.client
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import server
+from benchmark import fake_backends
+from synthetic_network import generate_network
+from traceGraph import TraceGraph
+from trace import autoPilotDropIn
+
+
+NETWORK = generate_network(600, 4, chain_ratio=0.9, manhole_every=4)
+# any day but a Sunday has fake Cq data
+DAY = "6/7/21"
+
+
+class TraceServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backends = fake_backends(NETWORK, DAY)
+        cls.backends.__enter__()
+        cls.graph = TraceGraph(NETWORK)
+        # ready without warm(), which loads the network artifact
+        cls.server = server.TraceServer(workers=2)
+        cls.server.graph, cls.server.service_password, cls.server.ready = cls.graph, "pw", True
+        cls.loop = asyncio.new_event_loop()
+        cls.listener = cls.loop.run_until_complete(
+            asyncio.start_server(cls.server.handleConnection, '127.0.0.1', 0))
+        cls.port = cls.listener.sockets[0].getsockname()[1]
+        threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.listener.close)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.server.executor.shutdown()
+        cls.backends.__exit__(None, None, None)
+
+    def request(self, method, path, body=None, connection=None):
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            with contextlib.closing(connection):
+                return self.request(method, path, body, connection)
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        return response.status, response.getheader('Connection'), response.read()
+
+    def test_health_and_readiness(self):
+        self.assertEqual(self.request('GET', '/healthz')[0], 200)
+        self.assertEqual(self.request('GET', '/readyz')[0], 200)
+        self.assertEqual(self.request('GET', '/missing')[0], 404)
+        self.assertEqual(self.request('OPTIONS', '/')[0], 200)
+
+    def test_not_ready(self):
+        self.server.ready = False
+        try:
+            self.assertEqual(self.request('GET', '/readyz')[0], 503)
+            self.assertEqual(self.request('POST', '/', json.dumps({"password": "pw"}))[0], 503)
+        finally:
+            self.server.ready = True
+
+    def test_wrong_password(self):
+        status, _, body = self.request('POST', '/', json.dumps({"password": "x", "date": DAY}))
+        self.assertEqual((status, body), (403, b"Wrong Password"))
+        status, _, body = self.request('POST', '/', json.dumps({"date": DAY}))
+        self.assertEqual(status, 403)
+
+    def test_invalid_body(self):
+        self.assertEqual(self.request('POST', '/', b'{not json')[0], 400)
+        self.assertEqual(self.request('POST', '/', b'[1, 2]')[0], 400)
+
+    def test_body_too_large(self):
+        with mock.patch.object(server, 'MAX_BODY_BYTES', 64):
+            status, connection, body = self.request(
+                'POST', '/', json.dumps({"password": "pw", "date": DAY, "pad": "x" * 100}))
+        self.assertEqual(status, 413)
+        self.assertEqual(connection, 'close')
+        self.assertEqual(json.loads(body), {"message": "Request body too large"})
+
+    def test_keep_alive(self):
+        with contextlib.closing(http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)) as connection:
+            for _ in range(3):
+                status, header, _ = self.request('GET', '/healthz', connection=connection)
+                self.assertEqual((status, header), (200, 'keep-alive'))
+
+    def test_mode_results(self):
+        status, _, body = self.request('POST', '/', json.dumps(
+            {"password": "pw", "date": DAY, "mode": "affected_buildings"}))
+        self.assertEqual(status, 200)
+        self.assertTrue(set(json.loads(body)) <= set(NETWORK.building_ids))
+        status, _, body = self.request('POST', '/', json.dumps({"password": "pw", "date": DAY, "mode": "bogus"}))
+        self.assertEqual((status, json.loads(body)), (400, {"message": "Methods not supported"}))
+
+    def test_drop_stream(self):
+        status, connection, body = self.request('POST', '/', json.dumps(
+            {"password": "pw", "date": DAY, "mode": "drop"}))
+        self.assertEqual((status, connection), (200, 'close'))
+        # the streamed body is the JSON string of the whole csv
+        error_message, chunks = autoPilotDropIn(DAY, graph=self.graph)
+        self.assertIsNone(error_message)
+        csv_text = "".join(chunks)
+        self.assertEqual(json.loads(body), csv_text)
+        self.assertEqual(len(csv_text.splitlines()), len(NETWORK.manhole_ids) + 1)
+
+    def test_drop_invalid_date(self):
+        status, _, body = self.request('POST', '/', json.dumps(
+            {"password": "pw", "date": "6/6/21", "mode": "drop"}))
+        self.assertEqual(status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
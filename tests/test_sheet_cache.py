@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from fake_graphql import FakeData, FakeBook
+from sheet_cache import SheetCache
+from synthetic_network import generate_network
+
+
+NETWORK = generate_network(300, 5, chain_ratio=0.9, manhole_every=4)
+TAB = "Results_for_test"
+
+
+class SheetCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.book = FakeBook(FakeData(NETWORK), ["6/7/21"])
+
+    def makeCache(self, check_seconds):
+        cache = SheetCache(check_seconds=check_seconds)
+        cache.book = self.book
+        return cache
+
+    def test_columns_read_once_per_revision(self):
+        cache = self.makeCache(0)
+        first = cache.read(TAB, ['ManholeID', '6/7/21'])
+        requests = self.book.request_count
+        self.assertTrue(first.equals(cache.read(TAB, ['ManholeID', '6/7/21'])))
+        self.assertEqual(self.book.request_count, requests)
+        # the revision is asked from Drive on every check
+        self.assertEqual(self.book.revision_count, 2)
+
+    def test_new_revision_reads_the_new_header(self):
+        cache = self.makeCache(0)
+        cache.read(TAB, ['ManholeID', '6/7/21'])
+        self.book.addDate("6/8/21")
+        frame = cache.read(TAB, ['ManholeID', '6/8/21'])
+        self.assertEqual(list(frame['6/8/21']), self.book.getColumn('6/8/21'))
+        self.assertEqual(list(frame['ManholeID']), [str(manhole_id) for manhole_id in NETWORK.manhole_ids])
+
+    def test_new_column_between_checks(self):
+        # the revision is not checked again for an hour, the header row is
+        cache = self.makeCache(3600)
+        cache.read(TAB, ['ManholeID', '6/7/21'])
+        self.book.addDate("6/8/21")
+        frame = cache.read(TAB, ['6/8/21'])
+        self.assertEqual(list(frame['6/8/21']), self.book.getColumn('6/8/21'))
+        self.assertEqual(self.book.revision_count, 1)
+        with self.assertRaises(KeyError):
+            cache.read(TAB, ['6/9/21'])
+
+
+if __name__ == "__main__":
+    unittest.main()
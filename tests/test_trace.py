@@ -0,0 +1,308 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import random
+import unittest
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import cq_store
+import trace
+import fake_graphql
+from reference_cache import ReferenceCache
+from traceGraph import TraceGraph
+from network_artifact import build_network
+from test_trace_graph import looped_network
+
+
+# the fake GraphQL endpoint answers for this network, a Cq store and reference cache
+# in a temporary directory keep the tests off /tmp/cq_store.sqlite
+NETWORK = looped_network(600, 1, loops=20, shared_ids=15, shared_nodes=5)
+DATA = fake_graphql.FakeData(NETWORK, sampled_ratio=0.4, positive_ratio=0.3)
+# a Monday, the fake data has no samples on Sundays
+DATE = "6/7/21"
+state = dict()
+
+
+def setUpModule():
+    state['dir'] = tempfile.mkdtemp()
+    state['server'] = fake_graphql.serve(NETWORK, port=0, data=DATA)
+    threading.Thread(target=state['server'].serve_forever, daemon=True).start()
+    state['patched'] = (trace.QUERY_URL, trace.reference_cache, cq_store.STORE_PATH, cq_store._store)
+    trace.QUERY_URL = 'http://127.0.0.1:%d/query' % state['server'].server_address[1]
+    trace.reference_cache = ReferenceCache(os.path.join(state['dir'], 'reference'))
+    cq_store.STORE_PATH, cq_store._store = os.path.join(state['dir'], 'cq.sqlite'), None
+
+
+def tearDownModule():
+    trace.QUERY_URL, trace.reference_cache, cq_store.STORE_PATH, cq_store._store = state['patched']
+    state['server'].shutdown()
+    state['server'].server_close()
+    shutil.rmtree(state['dir'])
+
+
+class ModeMasksTest(unittest.TestCase):
+
+    def test_masks_match_affected_buildings(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        error_message, masks = tracing.get_mode_masks(DATE, "upstream")
+        self.assertIsNone(error_message)
+        for mode, bit in trace.MODE_BITS.items():
+            error_message, buildings = tracing.get_affected_buildings(DATE, mode)
+            self.assertIsNone(error_message)
+            self.assertEqual(set(label for label, mask in masks.items() if mask & bit), set(buildings))
+        self.assertTrue(any(masks.values()))
+
+    def test_masks_match_affected_manholes(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        error_message, masks = tracing.get_mode_masks(DATE, "downstream")
+        self.assertIsNone(error_message)
+        for mode in trace.MONITORED_MODES:
+            error_message, manholes = tracing.get_affected_manholes(DATE, mode)
+            self.assertIsNone(error_message)
+            bit = trace.MODE_BITS[mode]
+            self.assertEqual(set(label for label, mask in masks.items() if mask & bit), set(manholes))
+
+    def test_invalid_date(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        error_message, masks = tracing.get_mode_masks("6/6/21", "upstream")
+        self.assertIsNotNone(error_message)
+        self.assertEqual(masks, {})
+
+
+def day_records(day):
+    # the fake Cq records of one m/d/y day
+    start = datetime.strptime(day, "%m/%d/%y").isoformat() + "Z"
+    return DATA.getQpcrCqs({'startDate': start, 'endDate': start})
+
+
+def old_day_counts(tracing, day):
+    # the former getPositivityCounts: one read and one manhole map per day
+    cqs = dict()
+    for record in day_records(day):
+        cqs.setdefault(record['manholeID'], []).append(float(record['cqValue']))
+    if not cqs:
+        return None
+    residential = tracing.manhole_residential_map
+    positive = {manhole_id: sum(values) / len(values) > 0 for manhole_id, values in cqs.items()}
+    return {"r_total_cnt": sum(residential.get(m, False) for m in cqs),
+            "nr_total_cnt": sum(not residential.get(m, False) for m in cqs),
+            "r_pos_cnt": sum(positive[m] and residential.get(m, False) for m in cqs),
+            "nr_pos_cnt": sum(positive[m] and not residential.get(m, False) for m in cqs),
+            "total_cnt": len(cqs), "total_pos_cnt": sum(positive.values())}
+
+
+def rate(positive, total):
+    return '{:.2f}%'.format(positive / total * 100) if total > 0 else "N/A"
+
+
+def old_moving_average(tracing, day, day_window):
+    # the former getMovingAverage: step back a day at a time until day_window days have data
+    cnts, current = [], datetime.strptime(day, "%m/%d/%y")
+    while len(cnts) < day_window:
+        counts = old_day_counts(tracing, current.strftime("%-m/%-d/%y"))
+        if counts is not None:
+            cnts.append(counts)
+        current -= timedelta(days=1)
+    totals = {key: sum(cnt[key] for cnt in cnts) for key in cnts[0]}
+    return {"%d-day total positivity rate avg" % day_window: rate(totals["total_pos_cnt"], totals["total_cnt"]),
+            "%d-day residential positivity rate avg" % day_window: rate(totals["r_pos_cnt"], totals["r_total_cnt"]),
+            "%d-day non-residential positivity rate avg" % day_window: rate(totals["nr_pos_cnt"], totals["nr_total_cnt"]),
+            "total positivity rate": rate(cnts[0]["total_pos_cnt"], cnts[0]["total_cnt"]),
+            "residential positivity rate": rate(cnts[0]["r_pos_cnt"], cnts[0]["r_total_cnt"]),
+            "non-residential positivity rate": rate(cnts[0]["nr_pos_cnt"], cnts[0]["nr_total_cnt"])}
+
+
+class MovingAverageTest(unittest.TestCase):
+
+    def test_matches_day_by_day_average(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        # Sundays have no samples: the window skips them, also when it ends on one
+        # and when it is longer than the first range fetched
+        for day, day_window in (("6/7/21", 7), ("6/6/21", 7), ("6/12/21", 1), ("6/9/21", 20)):
+            error_message, result = tracing.getMovingAverage(day, day_window)
+            self.assertIsNone(error_message)
+            self.assertEqual(result, old_moving_average(tracing, day, day_window))
+
+    def test_positivity_counts_of_missing_day(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        error_message, counts = tracing.getPositivityCounts("6/6/21")
+        self.assertEqual(error_message, "invalid date")
+        self.assertEqual(set(counts.values()), {0})
+        error_message, counts = tracing.getPositivityCounts(DATE)
+        self.assertIsNone(error_message)
+        self.assertEqual(counts, old_day_counts(tracing, DATE))
+
+
+def old_manhole_map(df, date_value, mode):
+    # the former get_manhole_map: float() of every row, a row it fails on is empty
+    day_map, empty_count = {}, 0
+    for _, row in df[[date_value, "ManholeID"]].iterrows():
+        try:
+            sm_tag = -1 if mode == "detection" else 1
+            day_map[row["ManholeID"]] = int(float(row[date_value]) > 0) or sm_tag
+        except:
+            empty_count += 1
+            day_map[row["ManholeID"]] = 1 if mode == "monitoring" else 0
+    if empty_count == len(df):
+        raise trace.InvalidDateError
+    return day_map
+
+
+class ManholeStatusTest(unittest.TestCase):
+
+    def assertMatchesOldRules(self, values):
+        tracing = trace.Trace.__new__(trace.Trace)
+        df = pd.DataFrame({"ManholeID": ['M%d' % idx for idx in range(len(values))], DATE: values})
+        for mode in trace.MONITORED_MODES:
+            try:
+                expected = old_manhole_map(df, DATE, mode)
+            except trace.InvalidDateError:
+                with self.assertRaises(trace.InvalidDateError):
+                    tracing.get_manhole_status(DATE, df)
+                continue
+            manhole_ids, status = tracing.get_manhole_status(DATE, df)
+            self.assertEqual(dict(zip(manhole_ids.tolist(), status[mode].tolist())), expected, (mode, values))
+
+    def test_numeric_columns(self):
+        self.assertMatchesOldRules([0.0, 31.2, 0.0, 25.0])
+        self.assertMatchesOldRules([0, 0, 0])
+        self.assertMatchesOldRules([np.nan, 30.1, -1.0, np.inf])
+        self.assertMatchesOldRules(np.array([0, 33, 0], dtype=np.int64))
+
+    def test_object_columns(self):
+        # the sheet gives strings, empty cells and stray text
+        self.assertMatchesOldRules(['', '31.5', '0', 'pending', None, ' 28 ', '1e1', '-3'])
+        self.assertMatchesOldRules(['32.1', 0, 29.5, '', 'nan', 'inf', True, False])
+        self.assertMatchesOldRules(['', None, 'n/a'])
+        rng = random.Random(0)
+        cells = ['', None, '0', '0.0', '35.2', 'x', 12, 0, 0.0, 27.5, ' 3 ', 'NaN', '-inf']
+        for _ in range(50):
+            self.assertMatchesOldRules([rng.choice(cells) for _ in range(rng.randint(1, 12))])
+
+
+
+class DailyCountsTest(unittest.TestCase):
+
+    def test_range_matches_day_by_day_counts(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        # 5/30/21 and 6/6/21 are Sundays without samples
+        daily_counts = tracing.get_daily_counts(tracing.query_cqs("5/29/21", "6/7/21"))
+        days = [day.strftime("%-m/%-d/%y") for day in daily_counts.index]
+        self.assertEqual(days, ["6/7/21", "6/5/21", "6/4/21", "6/3/21", "6/2/21",
+                                "6/1/21", "5/31/21", "5/29/21"])
+        for day, (_, counts) in zip(days, daily_counts.iterrows()):
+            self.assertEqual({key: int(value) for key, value in counts.items()},
+                             old_day_counts(tracing, day))
+
+    def test_text_cq_values(self):
+        tracing = trace.Trace.__new__(trace.Trace)
+        tracing.manhole_residential_map = {'M1': True, 'M2': False}
+        db_df = pd.DataFrame({'manholeID': ['M1', 'M2', 'M1', 'M2', 'M3'],
+                              'date': ['6/1/21', '6/1/21', '6/2/21', '6/2/21', '6/2/21'],
+                              'cqValue': ['31.2', '', '0', None, '28']})
+        counts = tracing.get_daily_counts(db_df)
+        self.assertEqual(counts.loc['2021-06-01'].to_dict(), {
+            'total_cnt': 2, 'total_pos_cnt': 1, 'r_total_cnt': 1, 'nr_total_cnt': 1,
+            'r_pos_cnt': 1, 'nr_pos_cnt': 0})
+        self.assertEqual(counts.loc['2021-06-02'].to_dict(), {
+            'total_cnt': 3, 'total_pos_cnt': 1, 'r_total_cnt': 1, 'nr_total_cnt': 2,
+            'r_pos_cnt': 0, 'nr_pos_cnt': 1})
+
+
+
+class TraceMatrixTest(unittest.TestCase):
+
+    def test_matrix_matches_single_day_masks(self):
+        graph = TraceGraph(NETWORK)
+        # 6/6/21 is a Sunday without samples
+        error_message, matrix = trace.autoPilotMatrix("6/8/21", 4, graph=graph)
+        self.assertIsNone(error_message)
+        self.assertEqual(matrix["dates"], ["6/5/21", "6/6/21", "6/7/21", "6/8/21"])
+        self.assertEqual(matrix["missing_dates"], ["6/6/21"])
+        self.assertEqual(matrix["buildings"], list(NETWORK.building_ids))
+        for day, date_value in enumerate(matrix["dates"]):
+            if date_value in matrix["missing_dates"]:
+                for rows in matrix["modes"].values():
+                    self.assertEqual(set(row[day] for row in rows), {'-'})
+                continue
+            error_message, masks = trace.Trace(date_value, graph).get_mode_masks(date_value)
+            self.assertIsNone(error_message)
+            for mode, bit in trace.MODE_BITS.items():
+                affected = set(building for building, row in zip(matrix["buildings"], matrix["modes"][mode])
+                               if row[day] == '1')
+                self.assertEqual(affected, set(label for label, mask in masks.items() if mask & bit))
+
+    def test_only_missing_dates(self):
+        tracing = trace.Trace("6/7/21", TraceGraph(NETWORK), "6/6/21")
+        error_message, matrix = tracing.getTraceMatrix("6/6/21", "6/6/21")
+        self.assertIsNotNone(error_message)
+        self.assertIsNone(matrix)
+
+    def test_invalid_ranges(self):
+        graph = TraceGraph(NETWORK)
+        for day_window in (0, trace.MAX_MATRIX_DAYS + 1, "7"):
+            error_message, matrix = trace.autoPilotMatrix("6/8/21", day_window, graph=graph)
+            self.assertTrue(error_message.startswith("Invalid day_window"))
+        error_message, matrix = trace.autoPilotMatrix("2021-06-08", 7, graph=graph)
+        self.assertTrue(error_message.startswith("Invalid date"))
+        tracing = trace.Trace("6/8/21", graph, "6/7/21")
+        error_message, matrix = tracing.getTraceMatrix("6/8/21", "6/7/21")
+        self.assertTrue(error_message.startswith("Invalid date range"))
+
+
+class SamplerCoverageTest(unittest.TestCase):
+
+    def test_counts_match_catchment_rows(self):
+        graph = TraceGraph(NETWORK)
+        tracing = trace.Trace(DATE, graph)
+        error_message, records = trace.autoPilotSamplerCoverage(DATE, graph)
+        self.assertIsNone(error_message)
+        manhole_ids, status = tracing.get_manhole_status(DATE)
+        self.assertEqual([record['MANHOLE_ID'] for record in records], manhole_ids.tolist())
+        catchment = graph.getCatchment()
+        for record, sampled, detection in zip(records, status["sampling"], status["detection"]):
+            buildings = catchment.getBuildings(record['MANHOLE_ID'])
+            self.assertEqual(record['UPSTREAM_BUILDINGS'], len(buildings))
+            # the residential map is keyed by internalCaan
+            self.assertEqual(record['RESIDENTIAL_UPSTREAM_BUILDINGS'],
+                             sum(tracing.residential_map[str(building)] for building in buildings))
+            self.assertEqual(record['RESIDENTIAL'], tracing.manhole_residential_map.get(record['MANHOLE_ID'], False))
+            self.assertEqual((record['SAMPLED'], record['POSITIVE']), (sampled == 1, detection == 1))
+        self.assertTrue(any(record['RESIDENTIAL_UPSTREAM_BUILDINGS'] for record in records))
+        self.assertTrue(any(record['POSITIVE'] for record in records))
+
+    def test_numeric_building_ids(self):
+        # BIDs read from the shapefile as numbers match the internalCaan texts
+        ptr = NETWORK.building_ptr.tolist()
+        building_nodes = {1000 + k: set(NETWORK.building_idx[ptr[k]:ptr[k + 1]].tolist())
+                          for k in range(len(NETWORK.building_ids))}
+        network = build_network(NETWORK.coords.tolist(), *(nodes.tolist() for nodes in NETWORK.edge_pairs()),
+                                dict(zip(NETWORK.manhole_ids, NETWORK.manhole_nodes.tolist())), building_nodes)
+        tracing = trace.Trace.__new__(trace.Trace)
+        tracing.mh_graph, tracing.sampler_table = TraceGraph(network), None
+        tracing.residential_map = {str(building): building % 3 == 0 for building in building_nodes}
+        tracing.manhole_caan_mapping = {NETWORK.manhole_ids[0]: ['1000']}
+        tracing.manhole_residential_map = {NETWORK.manhole_ids[0]: True}
+        table = tracing.get_sampler_table()
+        catchment = tracing.mh_graph.getCatchment()
+        for manhole_id in network.manhole_ids:
+            buildings = catchment.getBuildings(manhole_id)
+            self.assertEqual(table.loc[manhole_id, 'upstream_buildings'], len(buildings))
+            self.assertEqual(table.loc[manhole_id, 'residential_buildings'],
+                             sum(building % 3 == 0 for building in buildings))
+        self.assertGreater(table['residential_buildings'].sum(), 0)
+        self.assertEqual(table.index[table['residential']].tolist(), [NETWORK.manhole_ids[0]])
+
+    def test_invalid_date(self):
+        tracing = trace.Trace(DATE, TraceGraph(NETWORK))
+        error_message, records = tracing.getSamplerCoverage("6/6/21")
+        self.assertTrue(error_message.startswith("Invalid date"))
+        self.assertEqual(records, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,258 @@
+import os
+import sys
+import random
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from network_artifact import build_network
+from synthetic_network import generate_network
+from graph_export import graph_edges
+from traceGraph import TraceEngine, ReachabilityIndex, TraceGraph, strongly_connected_components
+
+
+MODES = ("upstream", "downstream")
+ONLY_MODES = (None, "build", "manhole")
+
+
+def looped_network(node_count, seed, loops=0, shared_ids=0, shared_nodes=0):
+    """
+    generate_network with pipes back upstream (loops), buildings named like
+    manholes (shared_ids) and manholes on the node of another one (shared_nodes)
+    """
+    network = generate_network(node_count, seed, chain_ratio=0.9, manhole_every=4)
+    rng = random.Random(seed)
+    sources, targets = (nodes.tolist() for nodes in network.edge_pairs())
+    for _ in range(loops):
+        node = rng.randrange(1, node_count)
+        sources.append(rng.randrange(node))
+        targets.append(node)
+    manhole_nodes = dict(zip(network.manhole_ids, network.manhole_nodes.tolist()))
+    for idx, manhole_id in enumerate(rng.sample(network.manhole_ids, shared_nodes)):
+        manhole_nodes['D%07d' % idx] = manhole_nodes[manhole_id]
+    ptr = network.building_ptr.tolist()
+    building_nodes = {building_id: set(network.building_idx[ptr[k]:ptr[k + 1]].tolist())
+                      for k, building_id in enumerate(network.building_ids)}
+    for manhole_id in rng.sample(network.manhole_ids, shared_ids):
+        building_nodes.setdefault(manhole_id, set()).add(
+            rng.choice([manhole_nodes[manhole_id], rng.randrange(node_count)]))
+    return build_network(network.coords.tolist(), sources, targets, manhole_nodes, building_nodes)
+
+
+NETWORKS = [generate_network(600, 0, chain_ratio=0.9, manhole_every=4),
+            looped_network(600, 1, loops=20, shared_ids=15, shared_nodes=5),
+            looped_network(400, 2, loops=80, shared_ids=30, shared_nodes=10)]
+
+
+def random_traces(network, seed, count):
+    """
+    return (origins, barriers) lists of random manholes, origins sometimes building ids
+    """
+    rng = random.Random(seed)
+    manhole_ids, building_ids = list(network.manhole_ids), list(network.building_ids)
+    for _ in range(count):
+        origins = rng.sample(manhole_ids, rng.randint(1, 6))
+        if rng.random() < 0.2:
+            origins.append(rng.choice(building_ids))
+        barriers = rng.sample(manhole_ids, rng.choice([0, 0, 1, 4, 12]))
+        yield origins, barriers
+
+
+def unit_reach(next_ptr, next_idx, unit):
+    # units reachable from a unit over the region edges, itself included
+    seen, stack = {unit}, [unit]
+    while stack:
+        current = stack.pop()
+        for next_unit in next_idx[next_ptr[current]:next_ptr[current + 1]]:
+            if next_unit not in seen:
+                seen.add(next_unit)
+                stack.append(next_unit)
+    return seen
+
+
+class ReachabilityIndexTest(unittest.TestCase):
+
+    def test_trace_matches_engine(self):
+        for seed, network in enumerate(NETWORKS):
+            engine, index = TraceEngine(network), ReachabilityIndex(network)
+            for origins, barriers in random_traces(network, seed, 100):
+                for mode in MODES:
+                    for only_mode in ONLY_MODES:
+                        self.assertEqual(index.trace(origins, barriers, mode, only_mode),
+                                         engine.trace(origins, barriers, mode, only_mode))
+
+    def test_trace_modes_matches_engine(self):
+        for seed, network in enumerate(NETWORKS):
+            engine, index = TraceEngine(network), ReachabilityIndex(network)
+            traces = list(random_traces(network, seed, 90))
+            for start in range(0, len(traces), 3):
+                origins = [origins for origins, _ in traces[start:start + 3]]
+                barriers = [barriers for _, barriers in traces[start:start + 3]]
+                for mode in MODES:
+                    self.assertEqual(dict(index.traceModes(origins, barriers, mode, None)),
+                                     dict(engine.traceModes(origins, barriers, mode, None)))
+
+    def test_components_are_strongly_connected(self):
+        for network in NETWORKS:
+            index = ReachabilityIndex(network)
+            for mode in MODES:
+                _, _, next_ptr, next_idx = index.regions[mode]
+                unit_count = len(index.unit_nodes)
+                components = strongly_connected_components(unit_count, next_ptr, next_idx)
+                self.assertEqual(sorted(unit for component in components for unit in component),
+                                 list(range(unit_count)))
+                reach = [unit_reach(next_ptr, next_idx, unit) for unit in range(unit_count)]
+                component_of = {unit: k for k, component in enumerate(components) for unit in component}
+                for unit in range(unit_count):
+                    for other in reach[unit]:
+                        # mutual reachability within a component, components reached come first
+                        self.assertEqual(unit in reach[other], component_of[unit] == component_of[other])
+                        self.assertLessEqual(component_of[other], component_of[unit])
+
+    def test_closure_matches_walk(self):
+        for network in NETWORKS:
+            index = ReachabilityIndex(network)
+            for mode in MODES:
+                _, _, next_ptr, next_idx = index.regions[mode]
+                rows, unit_row = index.getClosure(mode)
+                for unit in range(len(index.unit_nodes)):
+                    row = rows[unit_row[unit]]
+                    closure = set(other for other in range(len(index.unit_nodes))
+                                  if row[other >> 3] & (0x80 >> (other & 7)))
+                    self.assertEqual(closure, unit_reach(next_ptr, next_idx, unit))
+
+    def test_regions_match_engine(self):
+        # a unit's buildings and next units are what the node walk finds before other units
+        for network in NETWORKS:
+            engine, index = TraceEngine(network), ReachabilityIndex(network)
+            for mode in MODES:
+                build_ptr, build_idx, next_ptr, next_idx = index.regions[mode]
+                ptr, idx = engine.adjacency[mode]
+                for unit, unit_node in enumerate(index.unit_nodes):
+                    buildings, next_units, seen, stack = set(), set(), {unit_node}, [unit_node]
+                    while stack:
+                        node = stack.pop()
+                        if node != unit_node and engine.node_building[node] >= 0:
+                            buildings.add(engine.node_building[node])
+                        for next_node in idx[ptr[node]:ptr[node + 1]]:
+                            if engine.node_manhole[next_node] >= 0:
+                                next_units.add(index.node_unit[next_node])
+                            elif next_node not in seen:
+                                seen.add(next_node)
+                                stack.append(next_node)
+                    self.assertEqual(set(build_idx[build_ptr[unit]:build_ptr[unit + 1]]), buildings)
+                    self.assertEqual(set(next_idx[next_ptr[unit]:next_ptr[unit + 1]]), next_units)
+
+    def test_reaches_matches_engine(self):
+        for seed, network in enumerate(NETWORKS):
+            engine, index = TraceEngine(network), ReachabilityIndex(network)
+            rng = random.Random(seed)
+            labels = list(network.manhole_ids) + list(network.building_ids)
+            for origins, barriers in random_traces(network, seed, 60):
+                manhole_id = origins[0]
+                for mode in MODES:
+                    traced = engine.trace([manhole_id], barriers, mode, None)
+                    for label in rng.sample(labels, 10) + [manhole_id] + list(traced)[:5]:
+                        self.assertEqual(index.reaches(label, manhole_id, barriers, mode),
+                                         label in traced)
+
+
+class CatchmentTableTest(unittest.TestCase):
+
+    def test_trace_buildings_matches_engine(self):
+        for seed, network in enumerate(NETWORKS):
+            engine, graph = TraceEngine(network), TraceGraph(network)
+            table = graph.getCatchment()
+            joins = 0
+            for origins, barriers in random_traces(network, seed, 300):
+                expected = engine.trace(origins, barriers, "upstream", "build")
+                buildings = table.traceBuildings(origins, barriers)
+                if buildings is not None:
+                    joins += 1
+                    self.assertEqual(buildings, expected)
+                self.assertEqual(graph.traceFrom(origins, barriers=barriers), expected)
+            self.assertGreater(joins, 0)
+
+    def test_rows_match_engine(self):
+        for network in NETWORKS:
+            engine, table = TraceEngine(network), TraceGraph(network).getCatchment()
+            for manhole_id in network.manhole_ids:
+                buildings = table.getBuildings(manhole_id)
+                for building_id in buildings:
+                    self.assertIn(manhole_id, table.getSamplers(building_id))
+                if manhole_id not in network.building_ids:
+                    self.assertEqual(buildings, engine.trace([manhole_id], (), "upstream", "build"))
+
+
+def flow_trace(graph, origins, barriers, mode, only_mode):
+    # the union of the original per origin getFlow walks
+    graph.barriers = set(barriers)
+    res = set()
+    for origin in origins:
+        if origin in graph.manhole_to_coords_map:
+            graph.getFlow(graph.manhole_to_coords_map[origin], set(), res, origin, mode, only_mode)
+    return res
+
+
+class GetFlowBaselineTest(unittest.TestCase):
+
+    def test_engines_match_get_flow(self):
+        for seed, network in enumerate(NETWORKS):
+            engine, index, graph = TraceEngine(network), ReachabilityIndex(network), TraceGraph(network)
+            for origins, barriers in random_traces(network, seed, 150):
+                for mode in MODES:
+                    for only_mode in ONLY_MODES:
+                        expected = flow_trace(graph, origins, barriers, mode, only_mode)
+                        self.assertEqual(engine.trace(origins, barriers, mode, only_mode), expected)
+                        self.assertEqual(index.trace(origins, barriers, mode, only_mode), expected)
+                        self.assertEqual(graph.traceFrom(origins, mode, only_mode, barriers), expected)
+
+    def test_trace_modes_match_get_flow(self):
+        for seed, network in enumerate(NETWORKS):
+            engine, index, graph = TraceEngine(network), ReachabilityIndex(network), TraceGraph(network)
+            traces = list(random_traces(network, seed, 60))
+            for start in range(0, len(traces), 3):
+                origins = [origins for origins, _ in traces[start:start + 3]]
+                barriers = [barriers for _, barriers in traces[start:start + 3]]
+                for mode in MODES:
+                    expected = dict()
+                    for bit, (mode_origins, mode_barriers) in enumerate(zip(origins, barriers)):
+                        for label in flow_trace(graph, mode_origins, mode_barriers, mode, None):
+                            expected[label] = expected.get(label, 0) | (1 << bit)
+                    self.assertEqual(dict(engine.traceModes(origins, barriers, mode, None)), expected)
+                    self.assertEqual(dict(index.traceModes(origins, barriers, mode, None)), expected)
+
+    def test_loop_back_to_origin_is_excluded(self):
+        # a pipe loop leads back to the origin, getFlow still leaves it out
+        coords = [(float(k), 0.0) for k in range(4)]
+        network = build_network(coords, [0, 1, 2, 2], [1, 2, 0, 3],
+                                {'M0': 0, 'M1': 1, 'M2': 2, 'M3': 3}, {'B1': {1}})
+        graph = TraceGraph(network)
+        for engine in (TraceEngine(network), ReachabilityIndex(network)):
+            self.assertEqual(engine.trace(['M0'], (), "downstream", None), {'M1', 'M2', 'M3', 'B1'})
+            self.assertEqual(engine.trace(['M0', 'M1'], (), "downstream", None), {'M0', 'M1', 'M2', 'M3', 'B1'})
+        self.assertEqual(flow_trace(graph, ['M0'], (), "downstream", None), {'M1', 'M2', 'M3', 'B1'})
+
+
+def edge_labels(nodes, sources, targets):
+    return set(zip((nodes[source] for source in sources.tolist()),
+                   (nodes[target] for target in targets.tolist())))
+
+
+class TraceGraphExportTest(unittest.TestCase):
+
+    def test_reach_edges_match_views(self):
+        # the exports of buildGraph list the same nodes and edges as the dict views
+        network = generate_network(3000, 2, chain_ratio=0.9)
+        graph = TraceGraph(network)
+        graph.barriers = set(network.manhole_ids[::3])
+        graph.buildGraph()
+        for g_type, view in (("manhole", graph.manhole_graph), ("trace", graph.trace_graph)):
+            nodes, sources, targets = graph.getEdges(g_type)
+            view_nodes, view_sources, view_targets = graph_edges(view)
+            self.assertEqual(len(nodes), len(set(nodes)))
+            self.assertEqual(set(nodes), set(view_nodes))
+            self.assertEqual(edge_labels(nodes, sources, targets),
+                             edge_labels(view_nodes, view_sources, view_targets))
+
+
+if __name__ == "__main__":
+    unittest.main()